@@ -0,0 +1,406 @@
+import json
+import os
+import time
+from PIL import Image
+import downscale_func
+import edit_pipeline_func
+import encoder_profile_func
+import export_scheduler_func
+import folder_scan_func
+import filename_allocator_func
+import geometry_func
+import image_job
+import instrumentation_func
+import job_table
+import tiled_process_func
+import util_func
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+class BatchSettings:
+    """
+    Export settings shared by every image job in a batch run.  Mirrors the values the GUI reads from the export tab
+    widgets so the engine never has to touch a widget.
+    """
+    def __init__(self):
+        self.export_dir = ""
+        self.file_format = "png"
+        self.prefix = ""
+        self.suffix = ""
+        self.base_filename = ""
+        self.append_number = False
+        self.resize_quality = downscale_func.RESIZE_QUALITY_DEFAULT
+        self.encoder_profile = encoder_profile_func.ENCODER_PROFILE_DEFAULT
+        # 0 means no file size limit
+        self.max_kb = 0
+        # Skip image jobs whose output is up to date with the export folder's manifest
+        self.skip_up_to_date = False
+        # "stat" compares source size and mtime, "content" a hash of the source file
+        self.fingerprint_mode = "stat"
+        # Images whose working memory would exceed this many MB are processed in tiles, 0 always processes them whole
+        self.tile_memory_mb = tiled_process_func.TILE_MEMORY_DEFAULT_MB
+
+        # 0 means "use the image job's own new width/height"
+        self.max_long_edge = 0
+
+
+def create_image_job(file):
+    """
+    Open the image file, read its header values (size, format, orientation) and create an img_job object with default
+    attribute values.
+    :param file: Absolute path to the image file
+    :return img_job_obj: (ImageJob)
+    """
+    # Image.open only parses the header, pixel data is never decoded here
+    with Image.open(file) as ip:
+        img_job_obj = create_image_job_from_header(file, ip.width, ip.height, ip.format,
+                                                   ip.getexif().get(EXIF_ORIENTATION_TAG, 1))
+
+    return img_job_obj
+
+
+def create_image_job_from_header(file, width, height, img_format, orientation=1):
+    """
+    Create an img_job object with default attribute values from already known header values, i.e. from the image
+    cache, without opening the file.
+    :param file: Absolute path to the image file
+    :param width: (int) As stored in the file
+    :param height: (int) As stored in the file
+    :param img_format: (str) Pillow format name
+    :param orientation: (int) EXIF orientation.  The job's sizes are of the image turned upright, so width and height
+    are swapped for orientations 5 to 8.
+    :return img_job_obj: (ImageJob)
+    """
+    width, height = geometry_func.calc_oriented_size((width, height), orientation)
+    img_job_obj = image_job.ImageJob()
+    img_job_obj.img_orig_height = img_job_obj.img_new_height = height
+    img_job_obj.img_orig_width = img_job_obj.img_new_width = width
+    img_job_obj.img_aspect_ratio = height / width
+    img_job_obj.img_aspect_ratio_inv = width / height
+    img_job_obj.img_format = img_format
+    img_job_obj.img_orientation = orientation
+    img_job_obj.img_path = file
+    img_job_obj.img_name = file.rpartition("/")[2].split(".")[0]
+
+    return img_job_obj
+
+
+def collect_image_files(folder, include_globs=None, exclude_globs=None, max_depth=0):
+    """
+    List every image file found inside the passed in folder.
+    :param folder: Directory to search
+    :param include_globs: (list) Only list files matching one of these patterns
+    :param exclude_globs: (list) Skip files and folders matching one of these patterns
+    :param max_depth: (int) Levels of subfolders to search, 0 for the top level only, None for no limit
+    :return image_files: (list) Normalized absolute paths, in folder scan order
+    """
+    return list(folder_scan_func.iter_image_files(folder, include_globs, exclude_globs, max_depth))
+
+
+def calc_output_size(img_job, settings):
+    """
+    Work out the export resolution for the image job.  A max long edge in the settings overrides the job's own new
+    width/height while keeping the aspect ratio.  Images are never upscaled by the long edge setting.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return (width, height):
+    """
+    width = img_job.img_new_width or img_job.img_orig_width
+    height = img_job.img_new_height or img_job.img_orig_height
+
+    if settings.max_long_edge and max(width, height) > settings.max_long_edge:
+        scale = settings.max_long_edge / max(width, height)
+        width = max(1, int(round(width * scale)))
+        height = max(1, int(round(height * scale)))
+
+    return width, height
+
+
+def save_pil_img(pil_img, export_path, settings, result):
+    """
+    Encode the pillow image to the export path with the settings' encoder profile and file size limit, then record
+    the output in the job's result.
+    :param pil_img: (Image)
+    :param export_path: Absolute output file path
+    :param settings: (BatchSettings)
+    :param result: (dict) Result of the image job, updated in place
+    :return:
+    """
+    encode_info = encoder_profile_func.save_encoded(pil_img, export_path, settings.file_format,
+                                                    settings.encoder_profile, settings.max_kb)
+    result["output"] = export_path.replace("\\", "/")
+    result["width"], result["height"] = pil_img.size
+    result["bytes"] = encode_info["bytes"]
+    result["quality"] = encode_info["quality"]
+    if not encode_info["is_within_max"]:
+        result["message"] = f"Larger than {settings.max_kb} KB even at the lowest quality."
+
+
+def get_export_filename(img_job, settings, filename_allocator=None):
+    """
+    Build the output filename of an image job from the export settings.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :param filename_allocator: (FilenameAllocator) Shared by the export run, required when append_number is set
+    :return filename_with_format:
+    """
+    base_filename = settings.base_filename if settings.base_filename else img_job.img_name
+    filename_with_inserts = util_func.get_filename_with_inserts(base_filename, settings.prefix, settings.suffix)
+    if settings.append_number:
+        return filename_allocator.allocate(filename_with_inserts, settings.file_format)
+
+    return f"{filename_with_inserts}.{settings.file_format}"
+
+
+def create_job_result(img_job):
+    """
+    Result dict of an image job before it has been processed.
+    :param img_job: (ImageJob)
+    :return result: (dict) source, output, status, message, width, height, bytes, quality and seconds
+    """
+    return {
+        "source": img_job.img_path,
+        "output": "",
+        "status": "ok",
+        "message": "",
+        "width": 0,
+        "height": 0,
+        "bytes": 0,
+        "quality": None,
+        "seconds": 0.0,
+    }
+
+
+def render_image_job(img_job, settings):
+    """
+    Decode the original file of an image job and apply its edit operations at the export resolution.  Module level so
+    it can be sent to worker processes.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return pil_img: (Image) Edited image, ready to encode
+    """
+    if tiled_process_func.is_tiled_job(img_job, settings):
+        return tiled_process_func.render_image_job_tiled(img_job, settings)
+
+    # Decode the original once and resample once, whatever size the preview was shown at
+    edit_ops = edit_pipeline_func.replace_resize_op(img_job.img_edit_ops, calc_output_size(img_job, settings))
+    with Image.open(img_job.img_path) as ip:
+        # Decoded inside apply_edit_ops even without any edit ops, so nothing is read after the file is closed
+        pil_img = edit_pipeline_func.apply_edit_ops(ip, edit_ops, settings.resize_quality,
+                                                    orientation=img_job.img_orientation)
+    if instrumentation_func.is_enabled():
+        instrumentation_func.count(instrumentation_func.COUNTER_BYTES_READ, os.path.getsize(img_job.img_path))
+
+    return pil_img
+
+
+def process_image_job(img_job, settings, filename_with_format=None):
+    """
+    Run a single image job through decode -> edit operations -> encode.  Never raises, errors are returned in the
+    result so one bad file does not stop the batch.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :param filename_with_format: Output filename already allocated for the job, built from the settings if not given
+    :return result: (dict) Summary of the processed job
+    """
+    start_time = time.perf_counter()
+    result = create_job_result(img_job)
+
+    filename_allocator = None
+    try:
+        if filename_with_format is None:
+            if settings.append_number:
+                filename_allocator = filename_allocator_func.FilenameAllocator(settings.export_dir)
+            filename_with_format = get_export_filename(img_job, settings, filename_allocator)
+        export_path = os.path.join(settings.export_dir, filename_with_format)
+
+        pil_img = render_image_job(img_job, settings)
+        save_pil_img(pil_img, export_path, settings, result)
+    except Exception as err:
+        result["status"] = "failed"
+        result["message"] = f"{type(err).__name__}: {err}"
+        if filename_allocator is not None and filename_with_format is not None:
+            filename_allocator.release(filename_with_format)
+
+    result["seconds"] = round(time.perf_counter() - start_time, 4)
+
+    return result
+
+
+class BatchProcess:
+    """
+    This class contains the GUI-free logic to process a list of image jobs with a shared set of export settings,
+    optionally spread across worker processes.
+    """
+    def __init__(self, settings, jobs=1, encode_jobs=None, memory_budget=None):
+        self.logger = instrumentation_func.get_logger(__name__)
+
+        self.settings = settings
+        self.jobs = max(1, jobs)
+        self.encode_jobs = encode_jobs
+        self.memory_budget = memory_budget
+        self.peak_in_flight_bytes = 0
+        self.results = []
+        self.unreadable_files = []
+        self.elapsed_seconds = 0.0
+
+    def run(self, all_image_jobs):
+        """
+        Process every image job through the export scheduler.  With more than one job requested decoding runs in a
+        process pool, otherwise in this process.
+        :param all_image_jobs: (list) ImageJob objects
+        :return results: (list) One result dict per image job, in input order
+        """
+        export_scheduler = export_scheduler_func.ExportScheduler(self.settings, self.jobs, self.encode_jobs,
+                                                                 self.memory_budget)
+        self.results = export_scheduler.run(all_image_jobs, on_result=self.log_result)
+        self.elapsed_seconds = export_scheduler.elapsed_seconds
+        self.peak_in_flight_bytes = export_scheduler.peak_in_flight_bytes
+
+        return self.results
+
+    def log_result(self, result):
+        if result["status"] == "ok":
+            self.logger.info(f"Exported [{result['source']}] -> [{result['output']}]")
+        elif result["status"] == "up_to_date":
+            self.logger.info(f"Up to date [{result['source']}] -> [{result['output']}]")
+        else:
+            self.logger.warning(f"Failed [{result['source']}]: {result['message']}")
+
+        return result
+
+    def create_report(self):
+        """
+        Build the JSON serializable summary of the last run.
+        :return report: (dict)
+        """
+        succeeded = len([result for result in self.results if result["status"] == "ok"])
+        up_to_date = len([result for result in self.results if result["status"] == "up_to_date"])
+        report = {
+            "export_dir": self.settings.export_dir,
+            "file_format": self.settings.file_format,
+            "jobs": self.jobs,
+            "peak_in_flight_bytes": self.peak_in_flight_bytes,
+            "total": len(self.results),
+            "succeeded": succeeded,
+            "up_to_date": up_to_date,
+            "failed": len(self.results) - succeeded - up_to_date,
+            "total_bytes": sum(result["bytes"] for result in self.results),
+            "unreadable": self.unreadable_files,
+            "elapsed_seconds": round(self.elapsed_seconds, 4),
+            "images_per_second": round(len(self.results) / self.elapsed_seconds, 2) if self.elapsed_seconds else 0,
+            "results": self.results,
+        }
+
+        return report
+
+    def write_report(self, report_path):
+        """
+        Write the summary of the last run to a JSON file.  A path of "-" prints it to stdout instead.
+        :param report_path:
+        :return:
+        """
+        report = json.dumps(self.create_report(), indent=2)
+        if report_path == "-":
+            print(report)
+        else:
+            with open(report_path, "w") as report_file:
+                report_file.write(report)
+
+
+def create_cli_settings(args):
+    """
+    Read the command line export options into a BatchSettings object.
+    :param args: argparse namespace from main.py
+    :return settings: (BatchSettings)
+    """
+    settings = BatchSettings()
+    settings.export_dir = args.output
+    settings.file_format = args.format.lower()
+    settings.prefix = args.prefix
+    settings.suffix = args.suffix
+    settings.base_filename = args.filename
+    settings.append_number = args.append_number
+    settings.max_long_edge = args.max_long_edge
+    settings.resize_quality = args.resize_quality
+    settings.encoder_profile = args.encoder_profile
+    settings.max_kb = args.max_kb
+    settings.skip_up_to_date = args.incremental
+    settings.fingerprint_mode = args.fingerprint
+    settings.tile_memory_mb = args.tile_memory_mb
+
+    return settings
+
+
+def get_cli_scan_options(args, settings):
+    """
+    Read the command line folder scan options.  The export folder is always excluded when it lies inside the input
+    folder, so images exported by an earlier run are never picked up.
+    :param args: argparse namespace from main.py
+    :param settings: (BatchSettings)
+    :return (include_globs, exclude_globs, max_depth):
+    """
+    max_depth = (args.max_depth if args.max_depth >= 0 else None) if args.recursive else 0
+    exclude_globs = folder_scan_func.parse_glob_list(args.exclude)
+    export_rel_dir = os.path.relpath(settings.export_dir, args.batch).replace("\\", "/")
+    if export_rel_dir != "." and not export_rel_dir.startswith(".."):
+        exclude_globs.append(export_rel_dir)
+
+    return folder_scan_func.parse_glob_list(args.include) or None, exclude_globs, max_depth
+
+
+def create_cli_image_jobs(image_files, args, batch_process):
+    """
+    Create the image jobs for a list of files and apply the command line edits to them.  Unreadable files are logged
+    and recorded in batch_process.unreadable_files.
+    :param image_files: (list) Absolute image paths
+    :param args: argparse namespace from main.py
+    :param batch_process: (BatchProcess)
+    :return all_image_jobs: (JobTable)
+    """
+    all_image_jobs = job_table.JobTable()
+    for file in image_files:
+        try:
+            img_job_obj = create_image_job(file)
+        except OSError as err:
+            batch_process.logger.warning(f"Could not read [{file}]: {err}.  Skipping.")
+            batch_process.unreadable_files.append({"source": file, "message": str(err)})
+            continue
+        img_job_obj.img_rotation = args.rotation
+        img_job_obj.img_contrast = args.contrast
+        img_job_obj.img_sharpness = args.sharpness
+        img_job_obj.img_brightness = args.brightness
+        all_image_jobs.append(img_job_obj)
+
+    for img_job_obj in all_image_jobs:
+        edit_pipeline_func.update_edit_ops(img_job_obj)
+
+    return all_image_jobs
+
+
+def run_batch_cli(args):
+    """
+    Entry point for main.py --batch.  Loads every image in the input folder, applies the command line edits and
+    exports them.
+    :param args: argparse namespace from main.py
+    :return exit_code: (int) 0 if every image exported, 1 otherwise
+    """
+    settings = create_cli_settings(args)
+    batch_process = BatchProcess(settings, args.jobs, args.encode_jobs, args.memory_budget_mb * 1024 * 1024)
+
+    image_files = collect_image_files(args.batch, *get_cli_scan_options(args, settings))
+    all_image_jobs = create_cli_image_jobs(image_files, args, batch_process)
+
+    batch_process.run(all_image_jobs)
+    report_path = args.report if args.report else os.path.join(settings.export_dir, "batch_report.json")
+    batch_process.write_report(report_path)
+    report = batch_process.create_report()
+    batch_process.logger.info(f"Exported {report['succeeded']}/{report['total']} images in "
+                              f"{report['elapsed_seconds']}s, {report['up_to_date']} already up to date")
+    if instrumentation_func.is_enabled():
+        batch_process.logger.info(f"Stage timings:\n{instrumentation_func.format_summary()}")
+    if args.metrics_out:
+        instrumentation_func.write_metrics(args.metrics_out)
+
+    return 0 if report["failed"] == 0 else 1
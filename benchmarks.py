@@ -0,0 +1,469 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import PIL
+from PIL import Image, ImageEnhance
+import downscale_func
+import edit_pipeline_func
+import encoder_profile_func
+import enhance_kernel_func
+import tiled_process_func
+from shared_image import SharedImage
+
+ENHANCE_CASES = [
+    # (contrast, sharpness, brightness)
+    (1.3, 1, 1),
+    (1.3, 1, 1.2),
+    (1, 1.8, 1),
+    (1.3, 1.8, 1.2),
+]
+
+# Synthetic corpus the suite runs on.  Every (size, format) pair gets BENCH_LOAD_COUNT files for the load benchmark,
+# the other benchmarks use the first file of each pair.
+BENCH_SIZES = ((1600, 1200), (4000, 3000))
+BENCH_FORMATS = ("jpeg", "png")
+BENCH_LOAD_COUNT = 40
+BENCH_SEED = 1234
+# Size of the preview QLabel the preview benchmarks render for
+BENCH_LABEL_SIZE = (800, 600)
+BENCH_EXPORT_LONG_EDGE = 2048
+BENCH_ROTATIONS = (90, 33)
+# Working memory of the tiled export cases, small enough to tile every corpus size
+BENCH_TILE_MEMORY_BYTES = 16 * 1024 * 1024
+BENCH_RESULTS_PATH = "benchmark_results.json"
+BENCH_BASELINE_PATH = "benchmark_baseline.json"
+# A case regresses when its best time is this fraction slower than the baseline, the peak RSS when it grows by more
+# than RSS_REGRESSION_THRESHOLD
+REGRESSION_THRESHOLD = 0.15
+RSS_REGRESSION_THRESHOLD = 0.25
+
+
+def create_synthetic_img(size, seed=BENCH_SEED):
+    """
+    Create a noisy, photo-like RGB test image so filters and encoders have real work to do.  The same size and seed
+    always give the same pixels.
+    :param size: (tuple) (width, height)
+    :param seed: (int)
+    :return pil_img: (Image)
+    """
+    width, height = size
+    noise = np.random.default_rng(seed).normal(128, 40, (height, width)).clip(0, 255).astype(np.uint8)
+    gradient = np.broadcast_to(np.linspace(0, 255, height, dtype=np.uint8)[:, None], (height, width))
+    blend = ((noise.astype(np.uint16) + gradient) // 2).astype(np.uint8)
+
+    return Image.fromarray(np.dstack((noise, gradient, blend)), "RGB")
+
+
+def create_corpus(corpus_dir, sizes=BENCH_SIZES, file_formats=BENCH_FORMATS, load_count=BENCH_LOAD_COUNT,
+                  seed=BENCH_SEED):
+    """
+    Write the synthetic image corpus.  Each image is encoded once and copied, the copies only feed the load
+    benchmark, which reads file headers.
+    :param corpus_dir: Folder to write into
+    :param sizes: (tuple) (width, height) sizes
+    :param file_formats: (tuple) i.e. jpeg, png
+    :param load_count: (int) Files per size and format
+    :param seed: (int)
+    :return corpus: (list) One dict per size and format, holding size, format and the file paths
+    """
+    corpus = []
+    for size in sizes:
+        pil_img = create_synthetic_img(size, seed)
+        for file_format in file_formats:
+            extension = "jpg" if file_format == "jpeg" else file_format
+            first_path = os.path.join(corpus_dir, f"{size[0]}x{size[1]}_000.{extension}").replace("\\", "/")
+            pil_img.save(first_path, format=encoder_profile_func.get_pil_format(file_format), quality=90)
+            paths = [first_path]
+            for index in range(1, load_count):
+                paths.append(first_path.replace("_000.", f"_{index:03d}."))
+                shutil.copyfile(first_path, paths[-1])
+            corpus.append({"size": size, "format": file_format, "paths": paths})
+
+    return corpus
+
+
+def time_func(func, repeats):
+    """
+    Run func repeats times and return the best wall clock time in milliseconds.
+    :param func: Callable taking no arguments
+    :param repeats: (int)
+    :return best_ms: (float)
+    """
+    best_ms = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        best_ms = min(best_ms, (time.perf_counter() - start_time) * 1000)
+
+    return best_ms
+
+
+def get_peak_rss_mb():
+    """
+    :return peak_rss_mb: (float) High water mark of this process' resident memory, None where it cannot be read
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in KB everywhere else
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def get_rss_bytes():
+    """
+    :return rss_bytes: (int) Current resident memory of this process, None where it cannot be read
+    """
+    try:
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def record_case(results, case_name, func, repeats, work_units, unit_name):
+    """
+    Time a benchmark case and add it to the results.
+    :param results: (dict) Case name to case result
+    :param case_name: (str)
+    :param func: Callable taking no arguments
+    :param repeats: (int)
+    :param work_units: (float) Amount of work done by one call, i.e. images or megapixels
+    :param unit_name: (str) Name of the work unit for the throughput, i.e. "images", "MP"
+    :return:
+    """
+    best_ms = time_func(func, repeats)
+    results[case_name] = {
+        "best_ms": round(best_ms, 3),
+        "throughput": round(work_units / (best_ms / 1000), 2) if best_ms else 0.0,
+        "throughput_unit": f"{unit_name}/s",
+        # The process high water mark once the case has run, cases run smallest image first
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+    print(f"{case_name:<55} {best_ms:>10.2f} ms {results[case_name]['throughput']:>10.2f} {unit_name}/s")
+
+
+def chained_enhance(pil_img, contrast, sharpness, brightness):
+    """
+    The enhancement chain EditImages used before the fused kernel, kept as the benchmark reference.
+    """
+    enhanced_img_contrast = ImageEnhance.Contrast(pil_img).enhance(contrast)
+    enhanced_img_sharpness = ImageEnhance.Sharpness(enhanced_img_contrast).enhance(sharpness)
+    return ImageEnhance.Brightness(enhanced_img_sharpness).enhance(brightness)
+
+
+def bench_enhance(size, repeats):
+    """
+    Compare the chained ImageEnhance calls with the fused kernel for every case in ENHANCE_CASES.
+    :param size: (tuple) (width, height) of the test image
+    :param repeats: (int)
+    :return results: (list) One dict per case
+    """
+    pil_img = create_synthetic_img(size)
+    results = []
+    for contrast, sharpness, brightness in ENHANCE_CASES:
+        chained_ms = time_func(lambda: chained_enhance(pil_img, contrast, sharpness, brightness), repeats)
+        fused_ms = time_func(lambda: enhance_kernel_func.apply_fused_enhance(pil_img, contrast, sharpness,
+                                                                             brightness), repeats)
+        results.append({
+            "case": f"contrast={contrast} sharpness={sharpness} brightness={brightness}",
+            "chained_ms": round(chained_ms, 2),
+            "fused_ms": round(fused_ms, 2),
+            "speedup": round(chained_ms / fused_ms, 2),
+        })
+
+    return results
+
+
+def bench_load(corpus, repeats, results):
+    """
+    Time LoadImages.create_image_jobs on every size and format of the corpus.  The image cache is left out so every
+    run probes the files.
+    """
+    from load_images_func import LoadImages
+
+    load_images = LoadImages()
+    load_images.image_cache = None
+
+    def load_all(paths):
+        load_images.clear_image_jobs()
+        load_images.create_image_jobs(paths)
+
+    for corpus_entry in corpus:
+        size_name = "{}x{}".format(*corpus_entry["size"])
+        record_case(results, f"load/create_image_jobs/{corpus_entry['format']}/{size_name}",
+                    lambda: load_all(corpus_entry["paths"]), repeats, len(corpus_entry["paths"]), "images")
+
+
+def bench_preview(corpus, repeats, results):
+    """
+    Time the preview path of EditImages: building the proxy pyramid, rendering the edits onto the proxy and the
+    pixmap conversions in both directions.
+    """
+    from PySide6.QtWidgets import QLabel
+    import batch_process_func
+    import edit_images_func
+
+    label_preview = QLabel()
+    label_preview.resize(*BENCH_LABEL_SIZE)
+    edit_images = edit_images_func.EditImages(label_preview)
+
+    for corpus_entry in corpus:
+        img_path = corpus_entry["paths"][0]
+        case_suffix = "{}/{}x{}".format(corpus_entry["format"], *corpus_entry["size"])
+        edit_images.img_job = batch_process_func.create_image_job(img_path)
+        edit_images.set_img_job_attr(0, 1.3, 1.8, 1.2)
+        megapixels = corpus_entry["size"][0] * corpus_entry["size"][1] / 1e6
+
+        record_case(results, f"preview/build_proxy_pyramid/{case_suffix}",
+                    lambda: edit_images.build_proxy_pyramid(edit_images.img_job, BENCH_LABEL_SIZE), repeats,
+                    megapixels, "MP")
+
+        img_job = edit_images.img_job
+        proxy_level, proxy_img = edit_images.get_preview_proxy_level(img_job, BENCH_LABEL_SIZE)
+        proxy_megapixels = proxy_img.width * proxy_img.height / 1e6
+
+        def render_all_stages():
+            edit_images.stage_cache.clear()
+            return edit_images.render_preview(img_job, edit_pipeline_func.without_resize_op(img_job.img_edit_ops),
+                                              BENCH_LABEL_SIZE)
+
+        record_case(results, f"preview/render_preview/{case_suffix}", render_all_stages, repeats, proxy_megapixels,
+                    "MP")
+
+        # A new brightness on every call, contrast and sharpness come from the stage cache after the first one
+        brightness_values = iter(range(1, repeats + 2))
+
+        def change_brightness():
+            edit_images.set_img_job_attr(0, 1.3, 1.8, 1.2 + next(brightness_values) / 100)
+            return edit_images.render_preview(img_job, edit_pipeline_func.without_resize_op(img_job.img_edit_ops),
+                                              BENCH_LABEL_SIZE)
+
+        record_case(results, f"preview/render_preview_brightness_staged/{case_suffix}", change_brightness, repeats,
+                    proxy_megapixels, "MP")
+        edit_images.set_img_job_attr(0, 1.3, 1.8, 1.2)
+        record_case(results, f"preview/convert_pil_to_pixmap/{case_suffix}",
+                    lambda: edit_images.convert_pil_to_pixmap(proxy_img), repeats, proxy_megapixels, "MP")
+
+        # Cache the default pixmap the way the GUI does once its background render arrives
+        default_img = edit_images.render_preview(img_job, [], BENCH_LABEL_SIZE)
+        default_pixmap = edit_images.apply_preview_render(edit_images.render_generation, img_job,
+                                                          edit_images.get_preview_cache_key([]),
+                                                          SharedImage.from_pil(default_img))
+        record_case(results, f"preview/convert_pixmap_to_pil/{case_suffix}", edit_images.convert_pixmap_to_pil,
+                    repeats, default_pixmap.width() * default_pixmap.height() / 1e6, "MP")
+
+
+def bench_export(corpus, repeats, results, export_dir):
+    """
+    Time the full resolution export operations: enhance, rotation, resize at every quality setting and encoding the
+    file in every format.
+    """
+    for corpus_entry in corpus:
+        if corpus_entry["format"] != BENCH_FORMATS[0]:
+            continue
+        size = corpus_entry["size"]
+        size_name = "{}x{}".format(*size)
+        megapixels = size[0] * size[1] / 1e6
+        with Image.open(corpus_entry["paths"][0]) as ip:
+            pil_img = ip.convert("RGB")
+
+        enhance_ops = edit_pipeline_func.fuse_edit_ops([(edit_pipeline_func.EDIT_OP_CONTRAST, 1.3),
+                                                        (edit_pipeline_func.EDIT_OP_SHARPNESS, 1.8),
+                                                        (edit_pipeline_func.EDIT_OP_BRIGHTNESS, 1.2)])
+        record_case(results, f"export/enhance/{size_name}",
+                    lambda: edit_pipeline_func.apply_edit_op(pil_img, *enhance_ops[0]), repeats, megapixels, "MP")
+        for rotation in BENCH_ROTATIONS:
+            record_case(results, f"export/rotate_{rotation}/{size_name}",
+                        lambda: edit_pipeline_func.apply_edit_op(pil_img, edit_pipeline_func.EDIT_OP_ROTATE, rotation),
+                        repeats, megapixels, "MP")
+
+        # Always a downscale, to half size for corpus images smaller than the usual export
+        scale = min(BENCH_EXPORT_LONG_EDGE, max(size) // 2) / max(size)
+        target_size = (round(size[0] * scale), round(size[1] * scale))
+        for resize_quality in downscale_func.RESIZE_QUALITY_PRESETS:
+            record_case(results, f"export/resize_{resize_quality}/{size_name}",
+                        lambda: downscale_func.resize_img(pil_img, target_size, resize_quality), repeats, megapixels,
+                        "MP")
+        for rotation in BENCH_ROTATIONS:
+            # Resize and rotation fused into a single resample
+            resize_rotate_ops = [(edit_pipeline_func.EDIT_OP_RESIZE, target_size),
+                                 (edit_pipeline_func.EDIT_OP_ROTATE, rotation)]
+            record_case(results, f"export/resize_rotate_{rotation}/{size_name}",
+                        lambda: edit_pipeline_func.apply_edit_ops(pil_img, resize_rotate_ops), repeats, megapixels,
+                        "MP")
+
+        # Decode, resize, rotate and enhance of the file in tiles, against the same ops on the whole image
+        tiled_ops = [(edit_pipeline_func.EDIT_OP_RESIZE, target_size), (edit_pipeline_func.EDIT_OP_ROTATE, 33),
+                     (edit_pipeline_func.EDIT_OP_CONTRAST, 1.3), (edit_pipeline_func.EDIT_OP_SHARPNESS, 1.8)]
+        tiled_process = tiled_process_func.TiledProcess(BENCH_TILE_MEMORY_BYTES, temp_dir=export_dir)
+
+        def apply_whole():
+            with Image.open(corpus_entry["paths"][0]) as ip:
+                return edit_pipeline_func.apply_edit_ops(ip, tiled_ops)
+
+        def apply_tiled():
+            with Image.open(corpus_entry["paths"][0]) as ip:
+                return tiled_process.apply_edit_ops(ip, tiled_ops)
+
+        record_case(results, f"export/whole_edit/{size_name}", apply_whole, repeats, megapixels, "MP")
+        record_case(results, f"export/tiled_edit/{size_name}", apply_tiled, repeats, megapixels, "MP")
+
+        resized_img = downscale_func.resize_img(pil_img, target_size)
+        resized_megapixels = target_size[0] * target_size[1] / 1e6
+        for file_format in ("jpeg", "png", "webp"):
+            export_path = os.path.join(export_dir, f"export_{size_name}.{file_format}")
+            record_case(results, f"export/save_{file_format}/{size_name}",
+                        lambda: encoder_profile_func.save_encoded(resized_img, export_path, file_format), repeats,
+                        resized_megapixels, "MP")
+
+
+def run_suite(sizes=BENCH_SIZES, load_count=BENCH_LOAD_COUNT, repeats=5, corpus_dir=None):
+    """
+    Generate the corpus and run every benchmark, headless.
+    :param sizes: (tuple) (width, height) sizes of the corpus
+    :param load_count: (int) Files per size and format for the load benchmark
+    :param repeats: (int) Runs per case, the best is kept
+    :param corpus_dir: Folder to write the corpus to, defaults to a temporary folder removed afterwards
+    :return report: (dict) Environment and per case results
+    """
+    # Qt must be told before it is first imported, nothing is ever shown
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6 import __version__ as pyside_version
+    from PySide6.QtWidgets import QApplication
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    work_dir = tempfile.mkdtemp(prefix="image_editor_bench_")
+    corpus_dir = corpus_dir or os.path.join(work_dir, "corpus")
+    export_dir = os.path.join(work_dir, "export")
+    os.makedirs(corpus_dir, exist_ok=True)
+    os.makedirs(export_dir, exist_ok=True)
+
+    results = {}
+    start_time = time.perf_counter()
+    try:
+        corpus = create_corpus(corpus_dir, sizes, BENCH_FORMATS, load_count)
+        bench_load(corpus, repeats, results)
+        bench_preview(corpus, repeats, results)
+        bench_export(corpus, repeats, results, export_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "pyside": pyside_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "qt_platform": app.platformName(),
+        },
+        "config": {"sizes": [list(size) for size in sizes], "load_count": load_count, "repeats": repeats,
+                   "seed": BENCH_SEED},
+        "elapsed_seconds": round(time.perf_counter() - start_time, 2),
+        "peak_rss_mb": get_peak_rss_mb(),
+        "results": results,
+    }
+
+
+def compare_to_baseline(report, baseline, threshold=REGRESSION_THRESHOLD, rss_threshold=RSS_REGRESSION_THRESHOLD):
+    """
+    Compare a report with a stored baseline report.  Only cases present in both are compared.
+    :param report: (dict) Report from run_suite
+    :param baseline: (dict) Earlier report from run_suite
+    :param threshold: (float) Allowed slowdown of a case, 0.15 is 15%
+    :param rss_threshold: (float) Allowed growth of the peak RSS
+    :return regressions: (list) Messages, empty when nothing regressed
+    """
+    regressions = []
+    if baseline.get("config") != report["config"] or baseline.get("environment") != report["environment"]:
+        print("Warning: the baseline was recorded with a different configuration or environment.")
+
+    print(f"\n{'case':<55} {'baseline':>10} {'current':>10} {'change':>8}")
+    for case_name, case_result in report["results"].items():
+        baseline_result = baseline.get("results", {}).get(case_name)
+        if baseline_result is None:
+            print(f"{case_name:<55} {'-':>10} {case_result['best_ms']:>10.2f}      new")
+            continue
+
+        change = case_result["best_ms"] / baseline_result["best_ms"] - 1 if baseline_result["best_ms"] else 0.0
+        is_regression = change > threshold
+        print(f"{case_name:<55} {baseline_result['best_ms']:>10.2f} {case_result['best_ms']:>10.2f} "
+              f"{change:>+7.1%}{'  REGRESSION' if is_regression else ''}")
+        if is_regression:
+            regressions.append(f"{case_name}: {baseline_result['best_ms']} ms -> {case_result['best_ms']} ms "
+                               f"({change:+.1%}, allowed {threshold:+.0%})")
+
+    if report["peak_rss_mb"] and baseline.get("peak_rss_mb"):
+        rss_change = report["peak_rss_mb"] / baseline["peak_rss_mb"] - 1
+        print(f"{'peak RSS (MB)':<55} {baseline['peak_rss_mb']:>10.1f} {report['peak_rss_mb']:>10.1f} "
+              f"{rss_change:>+7.1%}")
+        if rss_change > rss_threshold:
+            regressions.append(f"peak RSS: {baseline['peak_rss_mb']} MB -> {report['peak_rss_mb']} MB "
+                               f"({rss_change:+.1%}, allowed {rss_threshold:+.0%})")
+
+    return regressions
+
+
+def parse_size_list(size_text):
+    """
+    :param size_text: (str) i.e. "1600x1200,4000x3000"
+    :return sizes: (tuple) (width, height) tuples
+    """
+    return tuple(tuple(int(value) for value in size.lower().split("x")) for size in size_text.split(",") if size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image processing hot paths.")
+    parser.add_argument("--sizes", default=",".join("{}x{}".format(*size) for size in BENCH_SIZES),
+                        help="Comma separated corpus image sizes, i.e. 1600x1200,4000x3000.")
+    parser.add_argument("--load-count", type=int, default=BENCH_LOAD_COUNT,
+                        help="Files per size and format for the load benchmark.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--corpus-dir", default="", help="Write the synthetic corpus here instead of a temp folder.")
+    parser.add_argument("--output", default=BENCH_RESULTS_PATH, help="Path of the JSON results.")
+    parser.add_argument("--baseline", default="",
+                        help=f"Compare with this results file, i.e. {BENCH_BASELINE_PATH}.  Exits 1 on a regression.")
+    parser.add_argument("--update-baseline", action="store_true", help="Also write the results to --baseline.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Allowed slowdown per case before it counts as a regression, 0.15 is 15%%.")
+    parser.add_argument("--rss-threshold", type=float, default=RSS_REGRESSION_THRESHOLD,
+                        help="Allowed growth of the peak RSS before it counts as a regression.")
+    parser.add_argument("--enhance-kernel", action="store_true",
+                        help="Only compare the chained ImageEnhance calls with the fused kernel.")
+    parser.add_argument("--width", type=int, default=4000, help="Image width for --enhance-kernel.")
+    parser.add_argument("--height", type=int, default=3000, help="Image height for --enhance-kernel.")
+    args = parser.parse_args()
+
+    if args.enhance_kernel:
+        for result in bench_enhance((args.width, args.height), args.repeats):
+            print(f"{result['case']:<45} chained {result['chained_ms']:>9.2f} ms   fused {result['fused_ms']:>9.2f} ms"
+                  f"   x{result['speedup']}")
+        sys.exit(0)
+
+    report = run_suite(parse_size_list(args.sizes), args.load_count, args.repeats, args.corpus_dir or None)
+    with open(args.output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"\nPeak RSS {report['peak_rss_mb']} MB, results written to [{args.output}]")
+
+    exit_code = 0
+    if args.baseline and os.path.isfile(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(report, json.load(baseline_file), args.threshold, args.rss_threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        exit_code = 1 if regressions else 0
+    elif args.baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline written to [{args.baseline}]")
+
+    sys.exit(exit_code)
@@ -1,9 +1,17 @@
-import logging
 import math
-import sys
-from PySide6.QtGui import QTransform, QPixmap
-from PySide6.QtCore import Qt
-from PIL import Image, ImageEnhance, ImageQt
+import sqlite3
+from PySide6.QtCore import QThreadPool
+import edit_pipeline_func
+import instrumentation_func
+import pixmap_cache_func
+import preview_proxy_func
+from preview_render_worker import PreviewRenderWorker
+from proxy_prefetch_worker import ProxyPrefetchWorker
+from shared_image import SharedImage
+
+PIXMAP_KIND_PROXY = "proxy"
+PIXMAP_KIND_DEFAULT = "default"
+PIXMAP_KIND_ENHANCED = "enhanced"
 
 
 class EditImages:
@@ -11,21 +19,41 @@ class EditImages:
     This class contains the function logic to the GUI widgets that pertain to the act of editing
     the image files.
     """
-    def __init__(self, label_preview_widget):
-        self.logger = logging.getLogger(__name__)
-        self.setup_logger()
+    def __init__(self, label_preview_widget, image_cache=None,
+                 pixmap_cache_budget=pixmap_cache_func.PIXMAP_CACHE_BUDGET_BYTES,
+                 proxy_cache_budget=pixmap_cache_func.PROXY_CACHE_BUDGET_BYTES,
+                 stage_cache_budget=pixmap_cache_func.STAGE_CACHE_BUDGET_BYTES):
+        self.logger = instrumentation_func.get_logger(__name__)
 
         self.active_job_index = 0
         self.img_job = None
         self.label_preview_widget = label_preview_widget
+        self.image_cache = image_cache
+
+        # Pixmaps of every job live here rather than on the ImageJob, so memory stays within budget.  Only the GUI
+        # thread creates, caches and evicts pixmaps.
+        self.pixmap_cache = pixmap_cache_func.PixmapCache(pixmap_cache_budget)
+        # Proxy images of every job, filled from the prefetch thread as well as the GUI thread
+        self.proxy_cache = pixmap_cache_func.PixmapCache(proxy_cache_budget,
+                                                         instrumentation_func.COUNTER_PROXY_CACHE_HITS,
+                                                         instrumentation_func.COUNTER_PROXY_CACHE_MISSES)
+        # Output of every stage of the preview renders, see edit_pipeline_func.apply_edit_ops_staged().  Belongs to
+        # the render path, which only runs on the render thread, and never holds a pixmap.
+        self.stage_cache = pixmap_cache_func.PixmapCache(stage_cache_budget,
+                                                         instrumentation_func.COUNTER_STAGE_CACHE_HITS,
+                                                         instrumentation_func.COUNTER_STAGE_CACHE_MISSES)
 
-    def setup_logger(self):
-        log_format = logging.Formatter("%(asctime)s: %(module)s: %(levelname)s: %(message)s",
-                                       datefmt="%Y-%m-%d %H:%M:%S")
-        self.logger.setLevel(logging.DEBUG)
-        stream_handler = logging.StreamHandler(sys.stdout)
-        stream_handler.setFormatter(log_format)
-        self.logger.addHandler(stream_handler)
+        # Preview renders run one at a time off the GUI thread.  Every request bumps the generation so results of
+        # superseded requests can be recognised and dropped.
+        self.render_generation = 0
+        self.render_thread_pool = QThreadPool()
+        self.render_thread_pool.setMaxThreadCount(1)
+
+        # Proxies of the image jobs likely to be selected next are decoded ahead of time, one at a time
+        self.prefetch_thread_pool = QThreadPool()
+        self.prefetch_thread_pool.setMaxThreadCount(1)
+        # 1 when the user last stepped forward through the images, -1 when back
+        self.prefetch_direction = 1
 
     def set_active_img_job(self, combobox_active_image, load_images_obj):
         """
@@ -35,23 +63,170 @@ class EditImages:
         :param load_images_obj: LoadImages() class object
         :return:
         """
-        self.active_job_index = combobox_active_image.currentIndex() - 1
+        active_job_index = combobox_active_image.currentIndex() - 1
+        if self.img_job is not None and active_job_index != self.active_job_index:
+            self.prefetch_direction = 1 if active_job_index > self.active_job_index else -1
+        self.active_job_index = active_job_index
         self.img_job = load_images_obj.all_image_jobs[self.active_job_index]
 
-    def create_default_pixmap_object(self, image_url_list):
+    def get_default_pixmap(self):
+        """
+        Get the unedited preview pixmap of the active image job from the pixmap cache.  Nothing is decoded or rendered
+        here, a miss is rendered in the background by request_preview_render().
+        :return scaled_pixmap: None when it is not cached
+        """
+        return self.pixmap_cache.get(self.get_preview_cache_key([]))
+
+    def get_enhanced_pixmap(self):
+        """
+        Get the edited preview pixmap of the active image job from the pixmap cache.  Nothing is decoded or rendered
+        here, a miss is rendered in the background by request_preview_render().
+        :return scaled_pixmap: None if the job has no edits that show in the preview or it is not cached
+        """
+        preview_edit_ops = edit_pipeline_func.without_resize_op(self.img_job.img_edit_ops)
+        if not preview_edit_ops:
+            return None
+
+        return self.pixmap_cache.get(self.get_preview_cache_key(preview_edit_ops))
+
+    def has_preview_edits(self):
+        return bool(edit_pipeline_func.without_resize_op(self.img_job.img_edit_ops))
+
+    def get_preview_cache_key(self, preview_edit_ops):
+        """
+        Key in the pixmap cache of the active image job's preview with the given edit operations.
+        :param preview_edit_ops: (list) (op_name, value) tuples, empty for the unedited preview
+        :return cache_key: (tuple)
+        """
+        if not preview_edit_ops:
+            return self.img_job.img_id, PIXMAP_KIND_DEFAULT
+        return self.img_job.img_id, PIXMAP_KIND_ENHANCED, tuple(preview_edit_ops)
+
+    @staticmethod
+    def get_stage_cache_key(img_job, proxy_level, proxy_img):
+        """
+        Key prefix in the stage cache of the preview stage outputs rendered from a proxy, see
+        edit_pipeline_func.apply_edit_ops_staged().  The size tells a pyramid built from a cached thumbnail apart from
+        one decoded from the file.
+        """
+        return img_job.img_id, proxy_level, proxy_img.size
+
+    def get_proxy_pyramid(self, img_job, label_size):
+        """
+        Get the preview proxy pyramid of an image job from the proxy cache, loading it on a miss.  A prefetch of the
+        job still decoding is not waited for, the proxy is loaded here as well.  Safe to call off the GUI thread.
+        :param img_job: (ImageJob)
+        :param label_size: (tuple) (width, height) of the preview label
+        :return proxy_pyramid: (list) Pillow images, largest first
+        """
+        proxy_pyramid = self.proxy_cache.get((img_job.img_id, PIXMAP_KIND_PROXY))
+        if proxy_pyramid is None:
+            proxy_pyramid = self.load_proxy_pyramid(img_job, label_size)
+
+        return proxy_pyramid
+
+    def load_proxy_pyramid(self, img_job, label_size):
+        """
+        Load the proxy pyramid of an image job into the proxy cache.  A cached thumbnail is used when the file has
+        been seen before, so nothing is decoded, otherwise it is decoded from the file.  Safe to call off the GUI
+        thread.
+        :param img_job: (ImageJob)
+        :param label_size: (tuple) (width, height) of the preview label
+        :return proxy_pyramid: (list) Pillow images, largest first
+        """
+        thumbnail_img = None
+        if self.image_cache is not None:
+            thumbnail_img = self.image_cache.get_thumbnail(img_job.img_path)
+        if thumbnail_img is None or not preview_proxy_func.is_proxy_filling(thumbnail_img, label_size):
+            return self.build_proxy_pyramid(img_job, label_size)
+
+        proxy_pyramid = preview_proxy_func.build_proxy_pyramid_from_img(thumbnail_img)
+        img_job.img_proxy_from_cache = True
+
+        return self.proxy_cache.put((img_job.img_id, PIXMAP_KIND_PROXY), proxy_pyramid)
+
+    def build_proxy_pyramid(self, img_job, label_size):
+        """
+        Decode the proxy pyramid from the image file, add it to the proxy cache and store the level that fills the
+        QLabel as the cached thumbnail.  Safe to call off the GUI thread.
+        :param img_job: (ImageJob)
+        :param label_size: (tuple) (width, height) of the preview label
+        :return proxy_pyramid: (list) Pillow images, largest first
+        """
+        img_path = img_job.img_path
+        proxy_pyramid = preview_proxy_func.build_proxy_pyramid(img_path, label_size, img_job.img_orientation)
+        img_job.img_proxy_from_cache = False
+        self.proxy_cache.put((img_job.img_id, PIXMAP_KIND_PROXY), proxy_pyramid)
+
+        if self.image_cache is not None:
+            thumbnail_img = proxy_pyramid[preview_proxy_func.select_proxy_level(proxy_pyramid, label_size)]
+            try:
+                self.image_cache.put_thumbnail(img_path, thumbnail_img)
+            except (OSError, sqlite3.Error) as err:
+                self.logger.warning(f"Could not cache the thumbnail of [{img_path}]: {err}")
+
+        return proxy_pyramid
+
+    def get_label_size(self):
+        label_size = self.label_preview_widget.size()
+        return label_size.width(), label_size.height()
+
+    def get_preview_proxy_level(self, img_job, label_size, rotation=0):
         """
-        Get the image path from the list widget in the load tab, create the pixmap, save it in the img_job
-        default_pixmap attr, scale it to fit to QLabel.
-        :param image_url_list: QListWidget containing full abs image file paths
-        :return scaled_pixmap:
+        Get the smallest proxy level of an image job that still fills the QLabel once rotated.  Interactive edits run
+        on this image rather than the full resolution original.  Safe to call off the GUI thread.
+        :param img_job: (ImageJob)
+        :param label_size: (tuple) (width, height) of the preview label
+        :param rotation: (int) Degrees
+        :return (proxy_level, proxy_img):
         """
-        item = image_url_list.item(self.active_job_index)
-        self.img_job.img_pixmap = QPixmap(item.text())
-        self.img_job.img_enhanced_pixmap = self.img_job.img_pixmap
+        proxy_pyramid = self.get_proxy_pyramid(img_job, label_size)
+        proxy_level = preview_proxy_func.select_proxy_level(proxy_pyramid, label_size, rotation)
+        proxy_img = proxy_pyramid[proxy_level]
 
-        scaled_default_pixmap = self.scale_pixmap(self.img_job.img_pixmap)
+        # A cached thumbnail only covers the unrotated QLabel, go back to the file once a rotation needs more pixels
+        if img_job.img_proxy_from_cache and not preview_proxy_func.is_proxy_filling(proxy_img, label_size, rotation):
+            proxy_pyramid = self.build_proxy_pyramid(img_job, label_size)
+            proxy_level = preview_proxy_func.select_proxy_level(proxy_pyramid, label_size, rotation)
+            proxy_img = proxy_pyramid[proxy_level]
 
-        return scaled_default_pixmap
+        return proxy_level, proxy_img
+
+    def request_prefetch(self, all_image_jobs, visible_rows=()):
+        """
+        Queue background decodes of the proxies of the image jobs most likely to be selected next, see
+        preview_proxy_func.calc_prefetch_order().  Prefetches queued for an earlier selection that have not started
+        yet are dropped.
+        :param all_image_jobs: (list) ImageJob objects, in image list order
+        :param visible_rows: (iterable) Rows of the image list scrolled into view
+        :return:
+        """
+        self.prefetch_thread_pool.clear()
+        active_index = self.active_job_index if self.img_job is not None else -1
+        label_size = self.get_label_size()
+
+        for index in preview_proxy_func.calc_prefetch_order(active_index, len(all_image_jobs),
+                                                            self.prefetch_direction, visible_rows):
+            img_job = all_image_jobs[index]
+            if self.proxy_cache.contains((img_job.img_id, PIXMAP_KIND_PROXY)):
+                continue
+            worker = ProxyPrefetchWorker(img_job, label_size, self.prefetch_proxy_pyramid)
+            worker.signals.failed.connect(self.log_prefetch_failure)
+            self.prefetch_thread_pool.start(worker)
+
+    def prefetch_proxy_pyramid(self, img_job, label_size):
+        """
+        Runs on the prefetch thread.  Load the proxy pyramid of an image job into the proxy cache unless it is there
+        already.  Only pillow images are touched here, never a pixmap.
+        :param img_job: (ImageJob)
+        :param label_size: (tuple) (width, height) of the preview label
+        :return:
+        """
+        if not self.proxy_cache.contains((img_job.img_id, PIXMAP_KIND_PROXY)):
+            self.load_proxy_pyramid(img_job, label_size)
+
+    def log_prefetch_failure(self, img_job, message):
+        self.logger.warning(f"Could not prefetch the preview of [{img_job.img_path}]: {message}")
 
     def calc_img_wh(self, new_img_res_val, is_calculating_height):
         """
@@ -65,88 +240,125 @@ class EditImages:
             new_img_height = int(round(new_img_res_val * self.img_job.img_aspect_ratio, 0))
 
             # Store value into image job for export
-            self.img_job.img_new_height = str(new_img_height)
+            self.img_job.img_new_width = new_img_res_val
+            self.img_job.img_new_height = new_img_height
+            edit_pipeline_func.update_edit_ops(self.img_job)
             return new_img_height
         else:
             new_img_width = math.ceil(new_img_res_val * self.img_job.img_aspect_ratio_inv)
 
             # Store value into image job for export
-            self.img_job.img_new_width = str(new_img_width)
+            self.img_job.img_new_width = new_img_width
+            self.img_job.img_new_height = new_img_res_val
+            edit_pipeline_func.update_edit_ops(self.img_job)
             return new_img_width
 
-    def calc_img_rotation(self, rotation_value, is_attr_modified):
+    def render_preview(self, img_job, preview_edit_ops, label_size, should_stop=None):
         """
-        Rotates the pixmap, rescales it and returns it.  Pixmap state is
-        :param rotation_value: (int) User entered rotation value
-        :param is_attr_modified: (bool) Flag if pixmap attr has been modified or not
-        :return scaled_pixmap: Pixmap that has been rotated
+        Runs on the render thread.  Load the proxy of an image job and apply its preview edit operations, scaled to the
+        QLabel by the same single resample as the rotation.  The output of every stage is memoized in the stage cache
+        so only the stages downstream of a change are rerun.  Only pillow images are touched here, never a pixmap.
+        :param img_job: (ImageJob)
+        :param preview_edit_ops: (list) (op_name, value) tuples without the resize op, empty for the unedited preview
+        :param label_size: (tuple) (width, height) of the preview label
+        :param should_stop: (callable) Returns True once the render is no longer wanted
+        :return preview_img: (Image) None if should_stop() returned True
         """
-        rotated_pixmap = self.img_job.img_enhanced_pixmap.transformed(QTransform().rotate(rotation_value))
-        scaled_pixmap = self.scale_pixmap(rotated_pixmap)
-        self.img_job.img_enhanced_pixmap = scaled_pixmap
+        proxy_level, proxy_img = self.get_preview_proxy_level(img_job, label_size,
+                                                              edit_pipeline_func.get_rotation(preview_edit_ops))
+        fitted_edit_ops = edit_pipeline_func.fit_edit_ops(preview_edit_ops, proxy_img.size, label_size)
 
-        if not is_attr_modified:
-            self.img_job.img_rotation = rotation_value
+        return edit_pipeline_func.apply_edit_ops_staged(proxy_img, fitted_edit_ops, self.stage_cache,
+                                                        self.get_stage_cache_key(img_job, proxy_level, proxy_img),
+                                                        should_stop=should_stop)
 
-        return scaled_pixmap
-
-    def calc_img_enhance(self, *args):
+    def request_preview_render(self, on_rendered, is_default=False):
         """
-        Executes image enhancements based on user data entered
-        :param args: [rotation_value, contrast_value, sharpness_value, brightness_value, pil_img]
-        :return:
+        Queue a background render of the active image job's preview, from loading its proxy onwards.  Queued renders
+        that have not started yet are cancelled, a render already running stops at its next stage.
+        :param on_rendered: Slot receiving (generation, img_job, cache_key, shared_img) once the render is done
+        :param is_default: (bool) Render the unedited preview rather than the edited one
+        :return generation: (int) Generation of the new request
         """
-        # image = self.convert_pixmap_to_pil()
+        self.render_generation += 1
+        self.render_thread_pool.clear()
 
-        enhanced_img_contrast = ImageEnhance.Contrast(args[4]).enhance(args[1])
-        enhanced_img_sharpness = ImageEnhance.Sharpness(enhanced_img_contrast).enhance(args[2])
-        enhanced_img_brightness = ImageEnhance.Brightness(enhanced_img_sharpness).enhance(args[3])
+        preview_edit_ops = [] if is_default else edit_pipeline_func.without_resize_op(self.img_job.img_edit_ops)
+        worker = PreviewRenderWorker(self.render_generation, self.img_job, preview_edit_ops,
+                                     self.get_preview_cache_key(preview_edit_ops), self.get_label_size(),
+                                     self.is_render_stale, self.render_preview)
+        worker.signals.finished.connect(on_rendered)
+        worker.signals.failed.connect(self.log_render_failure)
+        self.render_thread_pool.start(worker)
 
-        self.convert_pil_to_pixmap(enhanced_img_brightness)
+        return self.render_generation
 
-        rotated_pixmap = self.calc_img_rotation(args[0], False)
+    def is_render_stale(self, generation):
+        return generation != self.render_generation
 
-        return rotated_pixmap
-
-    def convert_pixmap_to_pil(self, is_exporting_image):
+    def apply_preview_render(self, generation, img_job, cache_key, shared_img):
         """
-        Converts from a pixmap image to a Pillow Image
-        :return image: (Image)
+        Called on the GUI thread with a finished background render, the pixmap is created and cached here.  Stale
+        renders, or renders of an image job that is no longer active, are dropped.
+        :param generation: (int) Generation the render was requested with
+        :param img_job: (ImageJob) Job the render belongs to
+        :param cache_key: (tuple) Pixmap cache key of the render, see get_preview_cache_key()
+        :param shared_img: (SharedImage) Rendered preview, already scaled to the QLabel
+        :return preview_pixmap: Pixmap to display, None if the render was dropped
         """
-        if is_exporting_image:
-            pil_img = self.img_job.img_enhanced_pixmap.toImage()
-            image = Image.fromqimage(pil_img)
-        else:
-            pil_img = self.img_job.img_pixmap.toImage()
-            image = Image.fromqimage(pil_img)
-        return image
+        if self.is_render_stale(generation) or img_job is not self.img_job:
+            return None
+
+        return self.pixmap_cache.put(cache_key, shared_img.to_pixmap())
 
-    def convert_pil_to_pixmap(self, pil_img):
+    def log_render_failure(self, generation, message):
+        self.logger.error(f"Preview render {generation} failed: {message}")
+
+    def convert_pixmap_to_pil(self):
         """
-        Converts a given pillow Image to a Pixmap and updates the self.img_job.img_enhanced_pixmap attr.
-        :param pil_img: (Image)
-        :return:
+        Converts the default preview pixmap to a Pillow Image.  This path still copies: the pixmap is read back as
+        RGB32 or ARGB32_Premultiplied, which Pillow cannot map, so SharedImage.from_qimage() converts it once.  The
+        image is a view of that converted QImage.
+        :return image: (Image) RGBA, or RGBX without an alpha channel.  None when the default pixmap is not cached.
         """
-        image_qt = ImageQt.ImageQt(pil_img)
-        self.img_job.img_enhanced_pixmap = QPixmap.fromImage(image_qt)
+        default_pixmap = self.get_default_pixmap()
+        if default_pixmap is None:
+            return None
+
+        q_img = default_pixmap.toImage()
+        with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+            image = SharedImage.from_qimage(q_img).to_pil()
+        return image
 
-    def scale_pixmap(self, pixmap):
+    @staticmethod
+    def convert_pil_to_pixmap(pil_img):
         """
-        Take in a pixmap and scale it to fit properly into the QLabel for visual display to the user.
-        :param pixmap:
-        :return:
+        Converts a given pillow Image to a Pixmap.  Pillow packs the pixels once into a buffer the QImage wraps as is.
+        :param pil_img: (Image)
+        :return pixmap:
         """
-        scaled_pixmap = pixmap.scaled(
-            self.label_preview_widget.size(),
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
-        )
-
-        return scaled_pixmap
+        with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+            return SharedImage.from_pil(pil_img).to_pixmap()
 
     def reset_edit_attributes(self):
         self.active_job_index = 0
         self.img_job = None
+        self.render_generation += 1
+        self.render_thread_pool.clear()
+        self.prefetch_thread_pool.clear()
+        self.pixmap_cache.clear()
+        self.proxy_cache.clear()
+        self.stage_cache.clear()
+
+    def discard_img_job(self, img_id):
+        """
+        Drop the cached previews of an image job, i.e. once it has been removed from the list.
+        :param img_id: (int) ImageJob.img_id
+        :return:
+        """
+        self.pixmap_cache.discard(img_id)
+        self.proxy_cache.discard(img_id)
+        self.stage_cache.discard(img_id)
 
     def set_img_job_attr(self, *args):
         """
@@ -158,3 +370,15 @@ class EditImages:
         self.img_job.img_contrast = args[1]
         self.img_job.img_sharpness = args[2]
         self.img_job.img_brightness = args[3]
+        edit_pipeline_func.update_edit_ops(self.img_job)
+
+    def set_img_job_res(self, new_img_width, new_img_height):
+        """
+        Save user entered export resolution to the img_job attributes when the aspect ratio is not being kept.
+        :param new_img_width: (int)
+        :param new_img_height: (int)
+        :return:
+        """
+        self.img_job.img_new_width = new_img_width
+        self.img_job.img_new_height = new_img_height
+        edit_pipeline_func.update_edit_ops(self.img_job)
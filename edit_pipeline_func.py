@@ -0,0 +1,372 @@
+from PIL import Image
+import downscale_func
+import enhance_kernel_func
+import geometry_func
+import instrumentation_func
+
+EDIT_OP_RESIZE = "resize"
+EDIT_OP_CONTRAST = "contrast"
+EDIT_OP_SHARPNESS = "sharpness"
+EDIT_OP_BRIGHTNESS = "brightness"
+EDIT_OP_ROTATE = "rotate"
+# Consecutive contrast, sharpness and brightness ops are fused into one of these before being applied
+EDIT_OP_ENHANCE = "enhance"
+# The resize and rotate ops are folded into one of these, applied first, so the image is resampled once
+EDIT_OP_GEOMETRY = "geometry"
+ENHANCE_OP_ORDER = (EDIT_OP_CONTRAST, EDIT_OP_SHARPNESS, EDIT_OP_BRIGHTNESS)
+
+
+def build_edit_ops(img_job):
+    """
+    Build the ordered list of edit operations from the image job's edit attributes.  Operations that would not change
+    the image are left out.  Resizing runs first so every following operation works on the smallest image possible.
+    :param img_job: (ImageJob)
+    :return edit_ops: (list) (op_name, value) tuples in the order they are applied
+    """
+    edit_ops = []
+
+    new_size = (img_job.img_new_width or img_job.img_orig_width, img_job.img_new_height or img_job.img_orig_height)
+    if new_size != (img_job.img_orig_width, img_job.img_orig_height):
+        edit_ops.append((EDIT_OP_RESIZE, new_size))
+    if img_job.img_contrast != 1:
+        edit_ops.append((EDIT_OP_CONTRAST, img_job.img_contrast))
+    if img_job.img_sharpness != 1:
+        edit_ops.append((EDIT_OP_SHARPNESS, img_job.img_sharpness))
+    if img_job.img_brightness != 1:
+        edit_ops.append((EDIT_OP_BRIGHTNESS, img_job.img_brightness))
+    if img_job.img_rotation % 360 != 0:
+        edit_ops.append((EDIT_OP_ROTATE, img_job.img_rotation))
+
+    return edit_ops
+
+
+def update_edit_ops(img_job):
+    """
+    Rebuild the image job's edit operation list.  Call after any edit attribute changes.
+    :param img_job: (ImageJob)
+    :return:
+    """
+    img_job.img_edit_ops = build_edit_ops(img_job)
+
+
+def replace_resize_op(edit_ops, new_size):
+    """
+    Return a copy of the edit operations with the resize target swapped for the passed in size, i.e. when the batch
+    settings override the job's own resolution.
+    :param edit_ops: (list) (op_name, value) tuples
+    :param new_size: (tuple) (width, height)
+    :return edit_ops: (list)
+    """
+    return [(EDIT_OP_RESIZE, new_size)] + [op for op in edit_ops if op[0] != EDIT_OP_RESIZE]
+
+
+def without_resize_op(edit_ops):
+    """
+    Return a copy of the edit operations without the resize step.  Used by the preview, which is scaled to the label
+    instead.
+    :param edit_ops: (list) (op_name, value) tuples
+    :return edit_ops: (list)
+    """
+    return [op for op in edit_ops if op[0] != EDIT_OP_RESIZE]
+
+
+def get_rotation(edit_ops):
+    """
+    Total rotation of the edit operations.
+    :param edit_ops: (list) (op_name, value) tuples
+    :return rotation: (int) Degrees
+    """
+    return sum(value for op_name, value in edit_ops if op_name == EDIT_OP_ROTATE)
+
+
+def fit_edit_ops(edit_ops, img_size, fit_size):
+    """
+    Return a copy of the edit operations resizing to whatever fits fit_size once rotated, i.e. the preview label, so
+    the preview is scaled by the same single resample as the rotation.
+    :param edit_ops: (list) (op_name, value) tuples
+    :param img_size: (tuple) (width, height) of the image the edit operations are applied to
+    :param fit_size: (tuple) (width, height) to fit
+    :return edit_ops: (list)
+    """
+    return replace_resize_op(edit_ops, geometry_func.calc_fit_size(img_size, get_rotation(edit_ops), fit_size))
+
+
+def apply_edit_op(pil_img, op_name, value, resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT, mask=None):
+    """
+    Apply a single edit operation to the pillow image.
+    :param pil_img: (Image)
+    :param op_name: (str) One of the EDIT_OP_* names
+    :param value: Operation value.  Geometry values are (target_size, rotation), a target_size of None keeps the size.
+    :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+    :param mask: (Image) L mode mask the enhance ops are limited to, see geometry_func.build_coverage_mask()
+    :return pil_img: (Image)
+    """
+    if op_name == EDIT_OP_GEOMETRY:
+        target_size, rotation = value
+        with instrumentation_func.span(instrumentation_func.STAGE_GEOMETRY):
+            pil_img = geometry_func.apply_geometry(pil_img, target_size or pil_img.size, rotation, resize_quality)
+    elif op_name == EDIT_OP_RESIZE:
+        with instrumentation_func.span(instrumentation_func.STAGE_SCALE):
+            pil_img = downscale_func.resize_img(pil_img, value, resize_quality)
+    elif op_name == EDIT_OP_ENHANCE:
+        with instrumentation_func.span(instrumentation_func.STAGE_ENHANCE):
+            pil_img = enhance_kernel_func.apply_fused_enhance(pil_img, *value, mask=mask)
+    elif op_name in ENHANCE_OP_ORDER:
+        pil_img = apply_edit_op(pil_img, *fuse_edit_ops([(op_name, value)])[0], resize_quality, mask)
+    elif op_name == EDIT_OP_ROTATE:
+        # QTransform rotates clockwise for positive values, as does apply_geometry()
+        with instrumentation_func.span(instrumentation_func.STAGE_ROTATE):
+            pil_img = geometry_func.apply_geometry(pil_img, pil_img.size, value, resize_quality)
+    else:
+        raise ValueError(f"Unknown edit operation [{op_name}]")
+
+    return pil_img
+
+
+def fuse_geometry_ops(edit_ops):
+    """
+    Fold the resize op and every rotate op into a single geometry op placed first.  The image is then resampled once,
+    straight to its output size and angle, instead of once per op, and the following ops work on the output size.
+    Enhancing commutes with right angle rotations.  For other angles the enhance ops are limited to the rotated
+    image's area, see apply_edit_ops(), so the corners stay black as when rotating last.
+    :param edit_ops: (list) (op_name, value) tuples
+    :return fused_edit_ops: (list) (op_name, value) tuples, the geometry value is (target_size, rotation)
+    """
+    target_size = None
+    rotation = 0
+    fused_edit_ops = []
+    for op_name, value in edit_ops:
+        if op_name == EDIT_OP_RESIZE:
+            target_size = tuple(value)
+        elif op_name == EDIT_OP_ROTATE:
+            rotation += value
+        else:
+            fused_edit_ops.append((op_name, value))
+
+    rotation %= 360
+    if target_size is None and rotation == 0:
+        return fused_edit_ops
+
+    return [(EDIT_OP_GEOMETRY, (target_size, rotation))] + fused_edit_ops
+
+
+def fuse_edit_ops(edit_ops):
+    """
+    Merge each run of consecutive contrast, sharpness and brightness ops into a single enhance op so they are applied
+    in one fused kernel.  A run only continues while the ops stay in contrast -> sharpness -> brightness order.
+    :param edit_ops: (list) (op_name, value) tuples
+    :return fused_edit_ops: (list) (op_name, value) tuples, enhance values are (contrast, sharpness, brightness)
+    """
+    fused_edit_ops = []
+    enhance_values = None
+    last_enhance_index = -1
+
+    for op_name, value in edit_ops:
+        if op_name in ENHANCE_OP_ORDER:
+            op_index = ENHANCE_OP_ORDER.index(op_name)
+            if enhance_values is None or op_index <= last_enhance_index:
+                enhance_values = [1, 1, 1]
+                fused_edit_ops.append((EDIT_OP_ENHANCE, enhance_values))
+            enhance_values[op_index] = value
+            last_enhance_index = op_index
+        else:
+            fused_edit_ops.append((op_name, value))
+            enhance_values = None
+            last_enhance_index = -1
+
+    return [(op_name, tuple(value) if op_name == EDIT_OP_ENHANCE else value) for op_name, value in fused_edit_ops]
+
+
+def convert_to_edit_mode(pil_img):
+    """
+    Convert palette, CMYK and other modes to the L, RGB or RGBA modes every edit operation supports.
+    :param pil_img: (Image)
+    :return pil_img: (Image)
+    """
+    if pil_img.mode not in ("RGB", "RGBA", "L"):
+        with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+            pil_img = pil_img.convert("RGBA" if "transparency" in pil_img.info or "A" in pil_img.mode else "RGB")
+
+    return pil_img
+
+
+def decode_img(pil_img):
+    """
+    Decode an opened image that is still lazily bound to its file.  Images already in memory are returned as they are.
+    :param pil_img: (Image)
+    :return pil_img: (Image)
+    """
+    if getattr(pil_img, "fp", None) is not None:
+        with instrumentation_func.span(instrumentation_func.STAGE_DECODE):
+            pil_img.load()
+
+    return pil_img
+
+
+def get_geometry_target_size(fused_edit_ops):
+    """
+    :param fused_edit_ops: (list) From fuse_geometry_ops()
+    :return target_size: (tuple) (width, height) the geometry op scales to, None when it keeps the size
+    """
+    if fused_edit_ops and fused_edit_ops[0][0] == EDIT_OP_GEOMETRY:
+        return fused_edit_ops[0][1][0]
+
+    return None
+
+
+def order_edit_ops(fused_edit_ops, img_size):
+    """
+    Settle where the geometry op runs once the decoded size is known, and whether the enhance ops after it need a
+    coverage mask.
+    :param fused_edit_ops: (list) From fuse_geometry_ops() and fuse_edit_ops()
+    :param img_size: (tuple) (width, height) of the decoded image
+    :return (fused_edit_ops, coverage): coverage is the (target_size, rotation) to build the coverage mask of the
+    enhance ops from, None when they cover the whole image
+    """
+    if not fused_edit_ops or fused_edit_ops[0][0] != EDIT_OP_GEOMETRY or len(fused_edit_ops) == 1:
+        return fused_edit_ops, None
+    target_size, rotation = fused_edit_ops[0][1]
+    if geometry_func.is_right_angle(rotation):
+        return fused_edit_ops, None
+
+    target_size = target_size or tuple(img_size)
+    if target_size == tuple(img_size):
+        # Rotated without scaling, the unrotated image has fewer pixels to enhance than the rotated canvas
+        return fused_edit_ops[1:] + fused_edit_ops[:1], None
+
+    return fused_edit_ops, (target_size, rotation)
+
+
+def apply_edit_ops(pil_img, edit_ops, resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT, should_stop=None,
+                   orientation=1):
+    """
+    Apply every edit operation to the pillow image, with resizing and rotation fused into one geometry op applied
+    first.  When it downscales a JPEG that is not loaded yet, the JPEG is decoded at a reduced scale.
+    :param pil_img: (Image)
+    :param edit_ops: (list) (op_name, value) tuples, sizes are of the image turned upright
+    :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+    :param should_stop: (callable) Checked before each operation, once it returns True the remaining operations are
+    skipped and None is returned
+    :param orientation: (int) EXIF orientation of pil_img, it is turned upright once decoded
+    :return pil_img: (Image)
+    """
+    fused_edit_ops = fuse_edit_ops(fuse_geometry_ops(edit_ops))
+    draft_size = get_geometry_target_size(fused_edit_ops)
+    if draft_size is not None:
+        downscale_func.prepare_downscale_decode(pil_img, geometry_func.calc_oriented_size(draft_size, orientation),
+                                                resize_quality)
+    decode_img(pil_img)
+    pil_img = geometry_func.apply_orientation(pil_img, orientation)
+    if edit_ops:
+        pil_img = convert_to_edit_mode(pil_img)
+
+    fused_edit_ops, coverage = order_edit_ops(fused_edit_ops, pil_img.size)
+    coverage_mask = geometry_func.build_coverage_mask(*coverage) if coverage is not None else None
+
+    for op_name, value in fused_edit_ops:
+        if should_stop is not None and should_stop():
+            return None
+        pil_img = apply_edit_op(pil_img, op_name, value, resize_quality, coverage_mask)
+
+    return pil_img
+
+
+def split_edit_stages(fused_edit_ops, is_masked=False):
+    """
+    Split fused edit ops into stages of a single parameter each, so the output of a stage only depends on the stages
+    before it.  Enhance ops become one stage per factor that is not 1, in contrast -> sharpness -> brightness order.
+    :param fused_edit_ops: (list) From fuse_geometry_ops(), fuse_edit_ops() and order_edit_ops()
+    :param is_masked: (bool) The enhance ops are limited to a coverage mask, see order_edit_ops()
+    :return (stages, composite_stages): stages is a list of (stage_name, value).  composite_stages maps the stage count
+    ending each masked enhance run to the stage count it starts at, the run's output is composited onto its input.
+    """
+    stages = []
+    composite_stages = {}
+    for op_name, value in fused_edit_ops:
+        if op_name != EDIT_OP_ENHANCE:
+            stages.append((op_name, value))
+            continue
+        run_start = len(stages)
+        stages.extend((stage_name, factor) for stage_name, factor in zip(ENHANCE_OP_ORDER, value) if factor != 1)
+        if is_masked and len(stages) > run_start:
+            composite_stages[len(stages)] = run_start
+
+    return stages, composite_stages
+
+
+def apply_edit_stage(pil_img, stage_name, value, resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT, mask=None):
+    """
+    Apply a single stage from split_edit_stages().  Enhance stages are not composited with the mask, only the contrast
+    mean is taken over it.
+    :param pil_img: (Image)
+    :param stage_name: (str) EDIT_OP_GEOMETRY or one of ENHANCE_OP_ORDER
+    :param value: Stage value
+    :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+    :param mask: (Image) L mode coverage mask
+    :return pil_img: (Image)
+    """
+    if stage_name not in ENHANCE_OP_ORDER:
+        return apply_edit_op(pil_img, stage_name, value, resize_quality)
+
+    with instrumentation_func.span(instrumentation_func.STAGE_ENHANCE):
+        if stage_name == EDIT_OP_CONTRAST:
+            return enhance_kernel_func.apply_tone_lut(pil_img, value, 1, mask)
+        if stage_name == EDIT_OP_SHARPNESS:
+            return enhance_kernel_func.apply_sharpen(pil_img, value)
+        return enhance_kernel_func.apply_tone_lut(pil_img, 1, value)
+
+
+def apply_edit_ops_staged(pil_img, edit_ops, stage_cache, cache_key,
+                          resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT, should_stop=None):
+    """
+    apply_edit_ops() for an image already in memory, i.e. a preview proxy, memoizing the output of every stage in
+    stage_cache.  A stage's output is keyed by cache_key plus its own and every upstream stage's parameters, so a
+    change only reruns the stages from the changed one on, i.e. a new brightness is one lookup table pass over the
+    cached sharpened image, and returning to earlier values is served from the cache.  The result is identical to
+    apply_edit_ops().
+    :param pil_img: (Image) Decoded image, never modified
+    :param edit_ops: (list) (op_name, value) tuples
+    :param stage_cache: (PixmapCache) LRU cache of pillow images only the stage outputs are kept in
+    :param cache_key: (tuple) Identifies pil_img and starts with its img_id, i.e. (img_id, proxy_level, size)
+    :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+    :param should_stop: (callable) Checked before each stage is computed, once it returns True None is returned
+    :return pil_img: (Image) Shared with the cache, copy it before any in place edit
+    """
+    if edit_ops:
+        pil_img = convert_to_edit_mode(pil_img)
+    fused_edit_ops, coverage = order_edit_ops(fuse_edit_ops(fuse_geometry_ops(edit_ops)), pil_img.size)
+    stages, composite_stages = split_edit_stages(fused_edit_ops, coverage is not None)
+    # Outputs used by this render, by stage count.  Held here too so an eviction half way through cannot lose them.
+    stage_imgs = {0: pil_img}
+    # Only built once a stage that needs it is rerun
+    coverage_masks = []
+
+    def get_coverage_mask():
+        if coverage is None:
+            return None
+        if not coverage_masks:
+            coverage_masks.append(geometry_func.build_coverage_mask(*coverage))
+        return coverage_masks[0]
+
+    def get_stage_img(stage_count):
+        if stage_count in stage_imgs:
+            return stage_imgs[stage_count]
+
+        stage_key = cache_key + (tuple(stages[:stage_count]),)
+        stage_img = stage_cache.get(stage_key)
+        if stage_img is None:
+            upstream_img = get_stage_img(stage_count - 1)
+            if upstream_img is None or (should_stop is not None and should_stop()):
+                return None
+            stage_name, value = stages[stage_count - 1]
+            stage_img = apply_edit_stage(upstream_img, stage_name, value, resize_quality,
+                                         get_coverage_mask() if stage_name == EDIT_OP_CONTRAST else None)
+            if stage_count in composite_stages:
+                stage_img = Image.composite(stage_img, get_stage_img(composite_stages[stage_count]),
+                                            get_coverage_mask())
+            stage_cache.put(stage_key, stage_img)
+        stage_imgs[stage_count] = stage_img
+
+        return stage_img
+
+    return get_stage_img(len(stages))
@@ -0,0 +1,160 @@
+import io
+import os
+import instrumentation_func
+
+JPEG_COMPATIBLE_MODES = ("RGB", "L", "CMYK")
+LOSSY_FORMATS = ("JPEG", "WEBP")
+
+ENCODER_PROFILE_DEFAULT = "default"
+# Save options per profile and pillow format name.  "default" keeps pillow's own defaults.  The quality of the lossy
+# formats is also the upper bound the max file size search starts from.
+ENCODER_PROFILES = {
+    ENCODER_PROFILE_DEFAULT: {},
+    "web": {
+        "JPEG": {"quality": 82, "optimize": True, "progressive": True},
+        "WEBP": {"quality": 80, "method": 4},
+        "PNG": {"optimize": True},
+    },
+    "smallest": {
+        "JPEG": {"quality": 70, "optimize": True, "progressive": True},
+        "WEBP": {"quality": 70, "method": 6},
+        "PNG": {"optimize": True, "compress_level": 9},
+    },
+    "archive": {
+        "JPEG": {"quality": 95, "subsampling": 0, "optimize": True},
+        "WEBP": {"lossless": True, "quality": 100, "method": 4},
+        "PNG": {"compress_level": 6},
+    },
+}
+# Quality range searched when fitting an image into a maximum file size
+MAX_SIZE_QUALITY_MIN = 5
+MAX_SIZE_QUALITY_MAX = 95
+
+
+def get_pil_format(file_format):
+    """
+    :param file_format: (str) Export format as shown to the user, i.e. png, jpeg, jpg, webp
+    :return pil_format: (str) i.e. PNG, JPEG, WEBP
+    """
+    return file_format.upper().replace("JPG", "JPEG")
+
+
+def get_save_options(file_format, encoder_profile=ENCODER_PROFILE_DEFAULT):
+    """
+    Pillow save options of an encoder profile for a format.
+    :param file_format: (str) i.e. png, jpeg, webp
+    :param encoder_profile: (str) Key of ENCODER_PROFILES
+    :return save_options: (dict) A copy, safe to modify
+    """
+    return dict(ENCODER_PROFILES[encoder_profile].get(get_pil_format(file_format), {}))
+
+
+def get_format_mode(mode, file_format):
+    """
+    :param mode: (str) Pillow image mode
+    :param file_format: (str) i.e. png, jpeg, webp
+    :return mode: (str) Mode the image is saved in, the given one when the format can hold it
+    """
+    if get_pil_format(file_format) == "JPEG" and mode not in JPEG_COMPATIBLE_MODES:
+        return "RGB"
+
+    return mode
+
+
+def convert_for_format(pil_img, file_format):
+    """
+    Convert the image mode when the chosen format cannot hold it.
+    :param pil_img: (Image)
+    :param file_format: (str) i.e. png, jpeg, webp
+    :return pil_img: (Image)
+    """
+    format_mode = get_format_mode(pil_img.mode, file_format)
+    if format_mode != pil_img.mode:
+        with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+            pil_img = pil_img.convert(format_mode)
+
+    return pil_img
+
+
+def encode_to_bytes(pil_img, file_format, save_options):
+    """
+    Encode the image into an in-memory buffer.
+    :param pil_img: (Image)
+    :param file_format: (str) i.e. png, jpeg, webp
+    :param save_options: (dict) Pillow save options
+    :return encoded_bytes: (bytes)
+    """
+    buffer = io.BytesIO()
+    pil_img.save(buffer, format=get_pil_format(file_format), **save_options)
+
+    return buffer.getvalue()
+
+
+def encode_within_max_bytes(pil_img, file_format, save_options, max_bytes):
+    """
+    Encode the image at the highest quality whose output fits in max_bytes, binary searching the quality with every
+    attempt encoded in memory.  Lossless formats are encoded once.
+    :param pil_img: (Image)
+    :param file_format: (str) i.e. png, jpeg, webp
+    :param save_options: (dict) Pillow save options, a quality in them caps the search
+    :param max_bytes: (int)
+    :return (encoded_bytes, quality, is_within_max): quality is None for lossless formats.  If even the lowest quality
+    does not fit, the lowest quality encode is returned with is_within_max False.
+    """
+    if get_pil_format(file_format) not in LOSSY_FORMATS or save_options.get("lossless"):
+        encoded_bytes = encode_to_bytes(pil_img, file_format, save_options)
+        return encoded_bytes, None, len(encoded_bytes) <= max_bytes
+
+    def encode_at(quality):
+        return encode_to_bytes(pil_img, file_format, {**save_options, "quality": quality})
+
+    high_quality = save_options.get("quality", MAX_SIZE_QUALITY_MAX)
+    best_bytes = encode_at(high_quality)
+    if len(best_bytes) <= max_bytes:
+        return best_bytes, high_quality, True
+
+    best_quality = None
+    low_quality = MAX_SIZE_QUALITY_MIN
+    high_quality -= 1
+    while low_quality <= high_quality:
+        quality = (low_quality + high_quality) // 2
+        encoded_bytes = encode_at(quality)
+        if len(encoded_bytes) <= max_bytes:
+            best_bytes, best_quality = encoded_bytes, quality
+            low_quality = quality + 1
+        else:
+            high_quality = quality - 1
+
+    if best_quality is None:
+        return encode_at(MAX_SIZE_QUALITY_MIN), MAX_SIZE_QUALITY_MIN, False
+
+    return best_bytes, best_quality, True
+
+
+def save_encoded(pil_img, export_path, file_format, encoder_profile=ENCODER_PROFILE_DEFAULT, max_kb=0):
+    """
+    Encode the image with an encoder profile and write it to the export path.
+    :param pil_img: (Image)
+    :param export_path: Absolute output file path
+    :param file_format: (str) i.e. png, jpeg, webp
+    :param encoder_profile: (str) Key of ENCODER_PROFILES
+    :param max_kb: (int) Maximum file size in KB, 0 for no limit
+    :return encode_info: (dict) bytes written, quality used (None if not set) and is_within_max
+    """
+    pil_img = convert_for_format(pil_img, file_format)
+    save_options = get_save_options(file_format, encoder_profile)
+
+    with instrumentation_func.span(instrumentation_func.STAGE_ENCODE):
+        if not max_kb:
+            pil_img.save(export_path, format=get_pil_format(file_format), **save_options)
+            encode_info = {"bytes": os.path.getsize(export_path), "quality": save_options.get("quality"),
+                           "is_within_max": True}
+        else:
+            encoded_bytes, quality, is_within_max = encode_within_max_bytes(pil_img, file_format, save_options,
+                                                                            max_kb * 1024)
+            with open(export_path, "wb") as export_file:
+                export_file.write(encoded_bytes)
+            encode_info = {"bytes": len(encoded_bytes), "quality": quality, "is_within_max": is_within_max}
+    instrumentation_func.count(instrumentation_func.COUNTER_BYTES_WRITTEN, encode_info["bytes"])
+
+    return encode_info
@@ -0,0 +1,150 @@
+from PIL import Image, ImageFilter
+
+# ImageFilter.SMOOTH, the degenerate image ImageEnhance.Sharpness blends against
+SMOOTH_KERNEL = (1, 1, 1,
+                 1, 5, 1,
+                 1, 1, 1)
+SMOOTH_KERNEL_SCALE = 13
+
+
+def calc_grey_histogram(pil_img, mask=None):
+    """
+    :param pil_img: (Image)
+    :param mask: (Image) L mode mask of the pixels to count, None for all of them
+    :return histogram: (list) 256 pixel counts of the grey levels
+    """
+    grey_img = pil_img if pil_img.mode == "L" else pil_img.convert("L")
+
+    return grey_img.histogram(mask)
+
+
+def calc_contrast_mean(pil_img, mask=None):
+    """
+    Mean grey level ImageEnhance.Contrast uses as its degenerate value.
+    :param pil_img: (Image)
+    :param mask: (Image) L mode mask of the pixels to average, None for all of them
+    :return mean: (int)
+    """
+    return calc_histogram_mean(calc_grey_histogram(pil_img, mask))
+
+
+def calc_histogram_mean(histogram):
+    """
+    :param histogram: (list) 256 pixel counts, i.e. the sum of the grey histograms of every tile of an image
+    :return mean: (int) Rounded like calc_contrast_mean()
+    """
+    pixel_count = sum(histogram)
+    mean = sum(level * count for level, count in enumerate(histogram)) / pixel_count if pixel_count else 0
+
+    return int(mean + 0.5)
+
+
+def build_band_lut(contrast, brightness, contrast_mean):
+    """
+    Run the Image.blend() calls of ImageEnhance.Contrast and ImageEnhance.Brightness over a ramp of all 256 levels, so
+    every entry is rounded exactly like the chained calls round a pixel.
+    :param contrast: (float) Contrast factor
+    :param brightness: (float) Brightness factor
+    :param contrast_mean: (int) Grey level the contrast blends against
+    :return band_lut: (list) 256 entries
+    """
+    ramp_img = Image.new("L", (256, 1))
+    ramp_img.putdata(range(256))
+    if contrast != 1:
+        ramp_img = Image.blend(Image.new("L", ramp_img.size, contrast_mean), ramp_img, contrast)
+    if brightness != 1:
+        ramp_img = Image.blend(Image.new("L", ramp_img.size, 0), ramp_img, brightness)
+
+    return list(ramp_img.getdata())
+
+
+def build_tone_lut(pil_img, contrast, brightness, mask=None, contrast_mean=None):
+    """
+    Build the per-channel lookup table doing contrast then brightness in one Image.point() pass.  Alpha bands are
+    passed through untouched, as ImageEnhance does.
+    :param pil_img: (Image) Source image, used for the contrast mean and band layout
+    :param contrast: (float) Contrast factor
+    :param brightness: (float) Brightness factor
+    :param mask: (Image) L mode mask of the pixels the contrast mean is taken over, None for all of them
+    :param contrast_mean: (int) Contrast mean already taken, i.e. over the whole image a tile belongs to
+    :return tone_lut: (list) 256 entries per band
+    """
+    mean = 0
+    if contrast != 1:
+        mean = contrast_mean if contrast_mean is not None else calc_contrast_mean(pil_img, mask)
+    band_lut = build_band_lut(contrast, brightness, mean)
+
+    tone_lut = []
+    for band in pil_img.getbands():
+        tone_lut.extend(range(256) if band == "A" else band_lut)
+
+    return tone_lut
+
+
+def build_sharpen_kernel(sharpness):
+    """
+    Fold ImageEnhance.Sharpness (a blend between the SMOOTH filtered image and the source) into a single 3x3
+    convolution kernel.
+    :param sharpness: (float) Sharpness factor
+    :return kernel: (ImageFilter.Kernel)
+    """
+    weights = [(1 - sharpness) * weight / SMOOTH_KERNEL_SCALE for weight in SMOOTH_KERNEL]
+    weights[4] += sharpness
+
+    return ImageFilter.Kernel((3, 3), weights, scale=1)
+
+
+def apply_sharpen(pil_img, sharpness):
+    """
+    Sharpen with the single convolution of build_sharpen_kernel().  Alpha bands are passed through untouched, as
+    ImageEnhance does.
+    :param pil_img: (Image)
+    :param sharpness: (float) Sharpness factor
+    :return sharpened_img: (Image)
+    """
+    if sharpness == 1:
+        return pil_img
+
+    alpha_band = pil_img.getchannel("A") if "A" in pil_img.getbands() else None
+    sharpened_img = pil_img.filter(build_sharpen_kernel(sharpness))
+    if alpha_band is not None:
+        sharpened_img.putalpha(alpha_band)
+
+    return sharpened_img
+
+
+def apply_tone_lut(pil_img, contrast, brightness, mask=None, contrast_mean=None):
+    if contrast == 1 and brightness == 1:
+        return pil_img
+
+    return pil_img.point(build_tone_lut(pil_img, contrast, brightness, mask, contrast_mean))
+
+
+def apply_fused_enhance(pil_img, contrast, sharpness, brightness, mask=None, contrast_mean=None):
+    """
+    Apply contrast, sharpness and brightness without the degenerate images the chained ImageEnhance calls allocate.
+    Contrast and brightness are folded into one Image.point() lookup table and sharpness into one convolution kernel.
+    When sharpening, brightness gets its own lookup table pass after the convolution so highlights clip in the same
+    place as the chained calls.  Without sharpening the result is identical to the chained calls.  The sharpen kernel
+    rounds once where the SMOOTH filter and its blend round twice, so with sharpening it is within three levels.
+    :param pil_img: (Image) L, RGB or RGBA image
+    :param contrast: (float) Contrast factor
+    :param sharpness: (float) Sharpness factor
+    :param brightness: (float) Brightness factor
+    :param mask: (Image) L mode mask of the image area, i.e. a rotated image inside its canvas.  The contrast mean is
+    taken over the masked pixels only and pixels outside the mask are left as they were.
+    :param contrast_mean: (int) Use this contrast mean instead of taking it from pil_img, i.e. for a tile
+    :return enhanced_img: (Image)
+    """
+    if sharpness == 1:
+        enhanced_img = apply_tone_lut(pil_img, contrast, brightness, mask, contrast_mean)
+    else:
+        enhanced_img = apply_tone_lut(pil_img, contrast, 1, mask, contrast_mean)
+        enhanced_img = apply_tone_lut(apply_sharpen(enhanced_img, sharpness), 1, brightness)
+
+    if enhanced_img is pil_img:
+        enhanced_img = pil_img.copy()
+    elif mask is not None:
+        enhanced_img = Image.composite(enhanced_img, pil_img, mask)
+
+    return enhanced_img
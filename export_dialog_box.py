@@ -6,21 +6,24 @@ class ExportDialogBox(QDialog):
     Called when the user clicks on button to export images to files.  If there are any issues, this class will open
     a new popup window with messages to inform the user.
     """
-    def __init__(self, messages):
+    def __init__(self, messages, title="Warning! Missing Fields",
+                 key_message="Cannot process export due to missing fields:"):
         """
         Defines the attributes for the QDialog window.
         :param messages: Predetermined messages to handle the various issues for export.  Found in gui_main.py in the
         export_image_to_file func.
+        :param title: Window title
+        :param key_message: Line shown above the messages
         """
         super().__init__()
 
         self.message_list = messages
 
-        self.setWindowTitle("Warning! Missing Fields")
+        self.setWindowTitle(title)
         self.setMinimumSize(500, 100)
 
         layout = QVBoxLayout()
-        label_key_msg = QLabel("Cannot process export due to missing fields:")
+        label_key_msg = QLabel(key_message)
         layout.addWidget(label_key_msg)
 
         self.label_message = QLabel(messages)
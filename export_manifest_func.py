@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import batch_process_func
+import edit_pipeline_func
+import image_cache_func
+import tiled_process_func
+import util_func
+
+MANIFEST_NAME = ".export_manifest.json"
+# Bump when a pipeline change alters the output of an unchanged recipe, so every output is rebuilt once
+MANIFEST_VERSION = 3
+FINGERPRINT_STAT = "stat"
+FINGERPRINT_CONTENT = "content"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def calc_content_hash(file):
+    """
+    :param file: Absolute path
+    :return content_hash: (str) sha256 hex digest of the file contents
+    """
+    content_hash = hashlib.sha256()
+    with open(file, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(HASH_CHUNK_SIZE), b""):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def calc_recipe_hash(img_job, settings):
+    """
+    Hash everything that decides what an image job's output looks like: the edit operations at the export size, the
+    output format and encoder options and the output file name.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return recipe_hash: (str) sha256 hex digest
+    """
+    base_filename = settings.base_filename if settings.base_filename else img_job.img_name
+    recipe = {
+        "version": MANIFEST_VERSION,
+        "edit_ops": edit_pipeline_func.replace_resize_op(img_job.img_edit_ops,
+                                                         batch_process_func.calc_output_size(img_job, settings)),
+        "file_format": settings.file_format,
+        "resize_quality": settings.resize_quality,
+        "encoder_profile": settings.encoder_profile,
+        "max_kb": settings.max_kb,
+        "filename": util_func.get_filename_with_inserts(base_filename, settings.prefix, settings.suffix),
+        "append_number": settings.append_number,
+        "is_tiled": tiled_process_func.is_tiled_job(img_job, settings),
+    }
+
+    return hashlib.sha256(json.dumps(recipe, sort_keys=True).encode()).hexdigest()
+
+
+class ExportManifest:
+    """
+    This class contains the logic for the manifest kept in an export folder.  Every exported image records the
+    fingerprint of its source file, the hash of its recipe and its output file.  Like make, the next export skips
+    every image whose source, recipe and output are all unchanged since and only rebuilds the dirty ones.
+    """
+    def __init__(self, export_dir, fingerprint_mode=FINGERPRINT_STAT):
+        """
+        :param export_dir: Export folder the manifest lives in
+        :param fingerprint_mode: (str) FINGERPRINT_STAT compares source size and mtime.  FINGERPRINT_CONTENT compares
+        a hash of the contents, so touched or copied sources whose bytes did not change are still up to date.
+        """
+        self.manifest_path = os.path.join(export_dir, MANIFEST_NAME)
+        self.fingerprint_mode = fingerprint_mode
+        # {normalized source path: entry dict}
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.entries = manifest.get("entries", {})
+
+    def save(self):
+        """
+        Write the manifest, replacing the old one in a single step so an interrupted save never leaves it half
+        written.
+        :return:
+        """
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, manifest_file, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def get_source_fingerprint(self, file):
+        """
+        :param file: Absolute path to the source image
+        :return fingerprint: (dict) file_size and mtime_ns, plus content_hash in content mode
+        """
+        file_size, mtime_ns = image_cache_func.get_file_signature(file)
+        fingerprint = {"file_size": file_size, "mtime_ns": mtime_ns}
+        if self.fingerprint_mode == FINGERPRINT_CONTENT:
+            entry = self.entries.get(image_cache_func.ImageCache.normalize_path(file))
+            if (entry is not None and entry.get("content_hash") and
+                    (entry["file_size"], entry["mtime_ns"]) == (file_size, mtime_ns)):
+                # Unchanged size and mtime, the file is not read again
+                fingerprint["content_hash"] = entry["content_hash"]
+            else:
+                fingerprint["content_hash"] = calc_content_hash(file)
+
+        return fingerprint
+
+    def is_source_unchanged(self, entry, fingerprint):
+        # Entries recorded in stat mode have no content hash yet, they are compared by size and mtime
+        if self.fingerprint_mode == FINGERPRINT_CONTENT and entry.get("content_hash"):
+            return (entry["file_size"] == fingerprint["file_size"] and
+                    entry["content_hash"] == fingerprint["content_hash"])
+
+        return (entry["file_size"], entry["mtime_ns"]) == (fingerprint["file_size"], fingerprint["mtime_ns"])
+
+    @staticmethod
+    def is_output_unchanged(entry):
+        try:
+            return image_cache_func.get_file_signature(entry["output"]) == (entry["output_size"],
+                                                                            entry["output_mtime_ns"])
+        except OSError:
+            return False
+
+    def check_image_job(self, img_job, settings):
+        """
+        Work out whether an image job's output is up to date.
+        :param img_job: (ImageJob)
+        :param settings: (BatchSettings)
+        :return (up_to_date_output, recipe_hash, fingerprint): up_to_date_output is the path of the existing output,
+        None when the job has to be exported.  fingerprint is None when the source cannot be read.
+        """
+        recipe_hash = calc_recipe_hash(img_job, settings)
+        try:
+            fingerprint = self.get_source_fingerprint(img_job.img_path)
+        except OSError:
+            return None, recipe_hash, None
+
+        entry = self.entries.get(image_cache_func.ImageCache.normalize_path(img_job.img_path))
+        if entry is None or entry["recipe_hash"] != recipe_hash or not self.is_source_unchanged(entry, fingerprint):
+            return None, recipe_hash, fingerprint
+        if not settings.append_number:
+            expected_output = os.path.join(settings.export_dir,
+                                           batch_process_func.get_export_filename(img_job, settings))
+            if image_cache_func.ImageCache.normalize_path(expected_output) != entry["output"]:
+                return None, recipe_hash, fingerprint
+        if not self.is_output_unchanged(entry):
+            return None, recipe_hash, fingerprint
+
+        return entry["output"], recipe_hash, fingerprint
+
+    def record(self, result, recipe_hash, fingerprint):
+        """
+        Record a successfully exported or up to date image job.
+        :param result: (dict) Result dict of the export, status "ok" or "up_to_date"
+        :param recipe_hash: (str) From check_image_job()
+        :param fingerprint: (dict) From check_image_job(), taken before the export started
+        :return:
+        """
+        output = image_cache_func.ImageCache.normalize_path(result["output"])
+        try:
+            output_size, output_mtime_ns = image_cache_func.get_file_signature(output)
+        except OSError:
+            return
+
+        self.entries[image_cache_func.ImageCache.normalize_path(result["source"])] = {
+            **fingerprint,
+            "recipe_hash": recipe_hash,
+            "output": output,
+            "output_size": output_size,
+            "output_mtime_ns": output_mtime_ns,
+        }
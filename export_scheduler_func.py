@@ -0,0 +1,284 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import batch_process_func
+import downscale_func
+import export_manifest_func
+import filename_allocator_func
+import geometry_func
+import instrumentation_func
+import tiled_process_func
+
+# Jobs in flight per worker, enough to keep every stage busy without holding the whole batch in memory
+EXPORT_JOBS_IN_FLIGHT_PER_WORKER = 2
+# Ceiling for the estimated pixel memory of every image in flight, decoded or waiting to be encoded
+EXPORT_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024
+# Bytes per pixel assumed for the estimate, images are edited as RGBA at most
+EXPORT_BYTES_PER_PIXEL = 4
+# Most worker processes an export started from the GUI spawns.  Every one is a fresh interpreter, and the GUI process
+# needs cores left to stay responsive while it runs.
+GUI_EXPORT_MAX_DECODE_WORKERS = 4
+
+
+def decode_image_job(img_job, settings, is_collecting_metrics=False):
+    """
+    Decode and edit stage of the export, runs in a worker process.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :param is_collecting_metrics: (bool) Record the stage timings in this process and hand them back, for worker
+    processes whose measurements would otherwise never reach the parent
+    :return (pil_img, seconds, metrics_snapshot): metrics_snapshot is None unless collecting
+    """
+    if is_collecting_metrics:
+        instrumentation_func.enable()
+    start_time = time.perf_counter()
+    pil_img = batch_process_func.render_image_job(img_job, settings)
+    seconds = time.perf_counter() - start_time
+
+    return pil_img, seconds, instrumentation_func.METRICS.pop_snapshot() if is_collecting_metrics else None
+
+
+def calc_job_bytes(img_job, settings):
+    """
+    Estimate the pixel memory an image job holds while in flight, the decoded original plus the edited image waiting
+    to be encoded.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return nbytes: (int)
+    """
+    output_size = batch_process_func.calc_output_size(img_job, settings)
+    decode_pixels = img_job.img_orig_width * img_job.img_orig_height
+    if img_job.img_format == "JPEG":
+        draft_scale = downscale_func.calc_draft_scale((img_job.img_orig_width, img_job.img_orig_height), output_size,
+                                                      settings.resize_quality)
+        decode_pixels //= draft_scale * draft_scale
+    if img_job.img_orientation in geometry_func.EXIF_ORIENTATION_TRANSPOSES:
+        # Turning the decoded image upright holds a second copy of it
+        decode_pixels *= 2
+
+    return (decode_pixels + output_size[0] * output_size[1]) * EXPORT_BYTES_PER_PIXEL
+
+
+def calc_export_progress(completed, total, elapsed_seconds):
+    """
+    :param completed: (int) Image jobs finished so far
+    :param total: (int) Image jobs in the export
+    :param elapsed_seconds: (float)
+    :return (images_per_second, eta_seconds): eta_seconds is None until the first image has finished
+    """
+    if not completed or not elapsed_seconds:
+        return 0.0, None
+    images_per_second = completed / elapsed_seconds
+
+    return images_per_second, (total - completed) / images_per_second
+
+
+class ExportScheduler:
+    """
+    This class contains the logic to export image jobs as a streaming pipeline.  Decoding, editing and resampling run in
+    a process pool, encoding and writing the files run on a thread pool in this process so they overlap with the next
+    decodes.  Images too big to process whole are processed in tiles on their own thread in this process, their result
+    is backed by a temporary file that would otherwise be copied back from the worker.  New image jobs only enter the
+    pipeline while the estimated memory of the jobs in flight stays within the memory budget, so a slow stage holds back
+    the ones before it and memory stays flat however many images are exported.  Progress is reported per finished image
+    and the run can be cancelled between images.
+    """
+    def __init__(self, settings, decode_workers=None, encode_workers=None, memory_budget=None):
+        """
+        :param settings: (BatchSettings)
+        :param decode_workers: (int) Worker processes, 1 decodes in this process.  Defaults to the CPU count, no more
+        are started than there are images to decode.
+        :param encode_workers: (int) Encode/write threads.  Defaults to half the decode workers.
+        :param memory_budget: (int) Bytes of estimated pixel memory allowed in flight.  Defaults to
+        EXPORT_MEMORY_BUDGET_BYTES.
+        """
+        self.settings = settings
+        self.decode_workers = max(1, decode_workers or os.cpu_count() or 1)
+        self.encode_workers = max(1, encode_workers or self.decode_workers // 2)
+        self.memory_budget = memory_budget or EXPORT_MEMORY_BUDGET_BYTES
+        self.cancel_event = threading.Event()
+
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+
+        self.results = []
+        self.elapsed_seconds = 0.0
+
+    def cancel(self):
+        """
+        Stop starting new image jobs.  Jobs already in flight still finish, the rest are marked cancelled.  Safe to
+        call from any thread.
+        """
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    @staticmethod
+    def create_decode_executor(decode_workers):
+        if decode_workers == 1:
+            return ThreadPoolExecutor(max_workers=1)
+
+        # Qt may have threads running in this process, forking it is not safe so workers are spawned fresh
+        return ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def run(self, all_image_jobs, on_result=None, on_progress=None):
+        """
+        Export every image job.  Blocks until every job has finished or the run was cancelled.  With
+        settings.skip_up_to_date, jobs whose output is up to date with the export manifest are not exported again and
+        get the status "up_to_date".
+        :param all_image_jobs: (list) ImageJob objects
+        :param on_result: Called with each result dict as soon as its image job finishes
+        :param on_progress: Called with (completed, total, images_per_second, eta_seconds) after each image job
+        :return results: (list) One result dict per image job, in input order
+        """
+        os.makedirs(self.settings.export_dir, exist_ok=True)
+        start_time = time.perf_counter()
+        total = len(all_image_jobs)
+        self.results = [None] * total
+        completed = 0
+
+        # Image jobs whose output is up to date are finished before anything starts, only the rest enter the pipeline
+        export_manifest = None
+        manifest_checks = [(None, None, None)] * total
+        pending_indices = list(range(total))
+        if self.settings.skip_up_to_date:
+            export_manifest = export_manifest_func.ExportManifest(self.settings.export_dir,
+                                                                  self.settings.fingerprint_mode)
+            manifest_checks = [export_manifest.check_image_job(job, self.settings) for job in all_image_jobs]
+            pending_indices = []
+            for index, (up_to_date_output, _, _) in enumerate(manifest_checks):
+                if up_to_date_output is None:
+                    pending_indices.append(index)
+                    continue
+                result = batch_process_func.create_job_result(all_image_jobs[index])
+                result["status"] = "up_to_date"
+                result["output"] = up_to_date_output
+                self.results[index] = result
+                completed += 1
+                if on_result is not None:
+                    on_result(result)
+            if on_progress is not None and completed:
+                on_progress(completed, total, 0.0, None)
+
+        # Filenames are allocated in this process as each job is admitted, so numbered exports can run in parallel
+        # too.  Numbered filenames are reserved with a placeholder file, released again if the job does not export.
+        filename_allocator = None
+        if self.settings.append_number:
+            filename_allocator = filename_allocator_func.FilenameAllocator(self.settings.export_dir)
+        filename_list = [None] * total
+
+        done_queue = queue.Queue()
+        job_bytes_list = [0] * total
+        is_tiled_list = [False] * total
+        for index in pending_indices:
+            is_tiled_list[index] = tiled_process_func.is_tiled_job(all_image_jobs[index], self.settings)
+            # A tiled job's working memory is its tile budget, whatever the size of the image
+            job_bytes_list[index] = (self.settings.tile_memory_mb * 1024 * 1024 if is_tiled_list[index] else
+                                     calc_job_bytes(all_image_jobs[index], self.settings))
+        # No more worker processes than there are images for them, each one costs an interpreter start
+        untiled_count = len([index for index in pending_indices if not is_tiled_list[index]])
+        decode_workers = max(1, min(self.decode_workers, untiled_count))
+        # Decodes in this process record straight into the shared metrics, worker processes send theirs back
+        is_collecting_metrics = decode_workers > 1 and instrumentation_func.is_enabled()
+        max_in_flight = (decode_workers + self.encode_workers) * EXPORT_JOBS_IN_FLIGHT_PER_WORKER
+        next_pending = 0
+        in_flight = 0
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+
+        with self.create_decode_executor(decode_workers) as decode_executor, \
+                ThreadPoolExecutor(max_workers=1) as tiled_executor, \
+                ThreadPoolExecutor(max_workers=self.encode_workers) as encode_executor:
+
+            def encode_image_job(index, decode_future):
+                result = batch_process_func.create_job_result(all_image_jobs[index])
+                try:
+                    pil_img, decode_seconds, metrics_snapshot = decode_future.result()
+                    if metrics_snapshot is not None:
+                        instrumentation_func.METRICS.merge(metrics_snapshot)
+                    encode_start_time = time.perf_counter()
+                    export_path = os.path.join(self.settings.export_dir, filename_list[index])
+                    batch_process_func.save_pil_img(pil_img, export_path, self.settings, result)
+                    result["seconds"] = round(decode_seconds + time.perf_counter() - encode_start_time, 4)
+                except Exception as err:
+                    result["status"] = "failed"
+                    result["message"] = f"{type(err).__name__}: {err}"
+                    release_filename(index)
+                done_queue.put((index, result))
+
+            def release_filename(index):
+                if filename_allocator is not None and filename_list[index] is not None:
+                    filename_allocator.release(filename_list[index])
+
+            def can_submit_image_job(pending):
+                if pending >= len(pending_indices) or self.is_cancelled() or in_flight >= max_in_flight:
+                    return False
+                # A job bigger than the whole budget still runs, on its own
+                job_bytes = job_bytes_list[pending_indices[pending]]
+                return in_flight == 0 or self.in_flight_bytes + job_bytes <= self.memory_budget
+
+            def submit_image_job(index):
+                self.in_flight_bytes += job_bytes_list[index]
+                self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+                try:
+                    filename_list[index] = batch_process_func.get_export_filename(all_image_jobs[index],
+                                                                                 self.settings, filename_allocator)
+                    if is_tiled_list[index]:
+                        # Spreads its tiles over every core itself
+                        decode_future = tiled_executor.submit(decode_image_job, all_image_jobs[index], self.settings)
+                    else:
+                        decode_future = decode_executor.submit(decode_image_job, all_image_jobs[index],
+                                                               self.settings, is_collecting_metrics)
+                except Exception as err:
+                    # I.e. the export folder is not writable or the process pool broke, the job fails on its own
+                    result = batch_process_func.create_job_result(all_image_jobs[index])
+                    result["status"] = "failed"
+                    result["message"] = f"{type(err).__name__}: {err}"
+                    release_filename(index)
+                    done_queue.put((index, result))
+                    return
+                # The encode is queued from the decode callback, so it never waits behind a slower earlier image
+                decode_future.add_done_callback(
+                    lambda future: encode_executor.submit(encode_image_job, index, future))
+
+            while can_submit_image_job(next_pending):
+                submit_image_job(pending_indices[next_pending])
+                next_pending += 1
+                in_flight += 1
+
+            while in_flight:
+                index, result = done_queue.get()
+                in_flight -= 1
+                completed += 1
+                self.in_flight_bytes -= job_bytes_list[index]
+                self.results[index] = result
+                if on_result is not None:
+                    on_result(result)
+                if on_progress is not None:
+                    on_progress(completed, total,
+                                *calc_export_progress(completed, total, time.perf_counter() - start_time))
+
+                while can_submit_image_job(next_pending):
+                    submit_image_job(pending_indices[next_pending])
+                    next_pending += 1
+                    in_flight += 1
+
+        for index in pending_indices[next_pending:]:
+            result = batch_process_func.create_job_result(all_image_jobs[index])
+            result["status"] = "cancelled"
+            self.results[index] = result
+
+        if export_manifest is not None:
+            for result, (_, recipe_hash, fingerprint) in zip(self.results, manifest_checks):
+                # Up to date entries are recorded again too, so they pick up a touched source's new mtime
+                if result["status"] in ("ok", "up_to_date") and fingerprint is not None:
+                    export_manifest.record(result, recipe_hash, fingerprint)
+            export_manifest.save()
+
+        self.elapsed_seconds = time.perf_counter() - start_time
+
+        return self.results
@@ -0,0 +1,37 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+
+class ExportSignals(QObject):
+    """
+    Signals for ExportWorker.  QRunnable is not a QObject so it cannot own signals itself.
+    """
+    # (completed, total, images per second, eta seconds or None)
+    progress = Signal(int, int, float, object)
+    # (list of result dict) one per image job, in the order the jobs were passed in
+    finished = Signal(object)
+    # (error message) the export could not run at all
+    failed = Signal(str)
+
+
+class ExportWorker(QRunnable):
+    """
+    Runs an ExportScheduler off the GUI thread and reports its progress back through signals.
+    """
+    def __init__(self, export_scheduler, all_image_jobs):
+        """
+        :param export_scheduler: (ExportScheduler) Configured with the export settings
+        :param all_image_jobs: (list) ImageJob objects to export
+        """
+        super().__init__()
+
+        self.export_scheduler = export_scheduler
+        self.all_image_jobs = all_image_jobs
+        self.signals = ExportSignals()
+
+    def run(self):
+        try:
+            results = self.export_scheduler.run(self.all_image_jobs, on_progress=self.signals.progress.emit)
+        except Exception as err:
+            self.signals.failed.emit(f"{type(err).__name__}: {err}")
+            return
+        self.signals.finished.emit(results)
@@ -0,0 +1,138 @@
+import heapq
+import os
+import threading
+
+
+def split_increm_num(filename):
+    """
+    Split an exported filename into the name it was numbered from and its incremental number, i.e.
+    "prefix_cat_03.png" -> ("prefix_cat", 3).
+    :param filename: Filename without directory
+    :return (filename_with_inserts, increm_num): increm_num is None if the filename carries no number
+    """
+    filename_with_inserts, _, increm_num = filename.split(".")[0].rpartition("_")
+    if not filename_with_inserts or not increm_num.isdigit():
+        return filename, None
+
+    return filename_with_inserts, int(increm_num)
+
+
+class FilenameAllocator:
+    """
+    This class contains the logic to hand out incremental export filenames for one export run.  The export directory
+    is scanned once up front, after that every filename is allocated from an in-memory index of the numbers in use per
+    name.  Numbers missing between the lowest and highest one in use are handed out first, then the number after the
+    highest.  Safe to share between threads, and allocated files are reserved on disk so concurrent exporters
+    writing to the same directory never collide.
+    """
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        self.lock = threading.Lock()
+
+        # {filename_with_inserts: [used_nums (set), gap_heap (list), next_num (int)]}
+        self.increm_num_index = {}
+        self.used_nums_by_name = {}
+        self.scan_export_dir()
+
+    def scan_export_dir(self):
+        """
+        Index the incremental numbers of every file already in the export directory.
+        :return:
+        """
+        if not os.path.isdir(self.export_dir):
+            return
+
+        with os.scandir(self.export_dir) as dir_entries:
+            for entry in dir_entries:
+                if entry.is_file():
+                    filename_with_inserts, increm_num = split_increm_num(entry.name)
+                    if increm_num is not None:
+                        self.used_nums_by_name.setdefault(filename_with_inserts, set()).add(increm_num)
+
+    def get_name_state(self, filename_with_inserts):
+        """
+        Number state of a name, built on first use from the scanned directory.  Caller must hold self.lock.
+        :param filename_with_inserts:
+        :return name_state: (list) [used_nums, gap_heap, next_num]
+        """
+        name_state = self.increm_num_index.get(filename_with_inserts)
+        if name_state is None:
+            used_nums = self.used_nums_by_name.pop(filename_with_inserts, set())
+            if used_nums:
+                gap_heap = [num for num in range(min(used_nums) + 1, max(used_nums)) if num not in used_nums]
+                next_num = max(used_nums) + 1
+            else:
+                gap_heap = []
+                next_num = 1
+            name_state = [used_nums, gap_heap, next_num]
+            self.increm_num_index[filename_with_inserts] = name_state
+
+        return name_state
+
+    def take_increm_num(self, name_state):
+        """
+        Lowest free gap, or the number after the highest one in use.  Caller must hold self.lock.
+        :param name_state:
+        :return increm_num: (int)
+        """
+        used_nums, gap_heap, next_num = name_state
+        while gap_heap:
+            increm_num = heapq.heappop(gap_heap)
+            if increm_num not in used_nums:
+                break
+        else:
+            while next_num in used_nums:
+                next_num += 1
+            increm_num = next_num
+            name_state[2] = next_num + 1
+        used_nums.add(increm_num)
+
+        return increm_num
+
+    def allocate(self, filename_with_inserts, chosen_file_format, reserve=True):
+        """
+        Hand out the next free incremental filename.
+        :param filename_with_inserts:
+        :param chosen_file_format:
+        :param reserve: (bool) Create an empty placeholder file so no other exporter can take the same filename
+        :return filename_with_format:
+        """
+        with self.lock:
+            name_state = self.get_name_state(filename_with_inserts)
+            while True:
+                increm_num = "{:02d}".format(self.take_increm_num(name_state))
+                filename_with_format = f"{filename_with_inserts}_{increm_num}.{chosen_file_format}"
+                if not reserve:
+                    return filename_with_format
+
+                try:
+                    # O_EXCL makes the create atomic, it fails if another thread or process got there first
+                    file_descriptor = os.open(os.path.join(self.export_dir, filename_with_format),
+                                              os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    continue
+                os.close(file_descriptor)
+
+                return filename_with_format
+
+    def release(self, filename_with_format):
+        """
+        Give back a reserved filename whose export failed.  The placeholder is removed, unless something was written
+        to it, and its number can be handed out again.
+        :param filename_with_format:
+        :return:
+        """
+        export_path = os.path.join(self.export_dir, filename_with_format)
+        filename_with_inserts, increm_num = split_increm_num(filename_with_format)
+        with self.lock:
+            try:
+                if os.path.getsize(export_path) > 0:
+                    return
+                os.remove(export_path)
+            except FileNotFoundError:
+                pass
+
+            name_state = self.increm_num_index.get(filename_with_inserts)
+            if name_state is not None and increm_num in name_state[0]:
+                name_state[0].discard(increm_num)
+                heapq.heappush(name_state[1], increm_num)
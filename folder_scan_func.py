@@ -0,0 +1,114 @@
+import fnmatch
+import itertools
+import os
+import util_func
+
+SCAN_CHUNK_SIZE = 256
+
+
+def parse_glob_list(glob_text):
+    """
+    Split a user entered list of glob patterns, i.e. "*.jpg; raw/*", on semicolons and commas.
+    :param glob_text: (str)
+    :return glob_list: (list) Patterns, empty entries dropped
+    """
+    return [pattern.strip() for pattern in glob_text.replace(",", ";").split(";") if pattern.strip()]
+
+
+def matches_any_glob(rel_path, glob_list):
+    """
+    Check a path against glob patterns.  Patterns containing a "/" are matched against the path relative to the scan
+    root, the others against the file or folder name alone.
+    :param rel_path: (str) Path relative to the scan root, "/" separated
+    :param glob_list: (list) Glob patterns
+    :return: (bool)
+    """
+    name = rel_path.rpartition("/")[2]
+    for pattern in glob_list:
+        if fnmatch.fnmatch(rel_path if "/" in pattern else name, pattern):
+            return True
+
+    return False
+
+
+def iter_image_files(root_dir, include_globs=None, exclude_globs=None, max_depth=None, on_skipped=None):
+    """
+    Walk a folder tree and yield the image files in it as they are found, without listing the whole tree first.
+    Folders are visited depth first and the entries of every folder in name order, so the order is stable between
+    runs.  Symlinked folders are not followed.
+    :param root_dir: Folder to scan
+    :param include_globs: (list) Only yield files matching one of these patterns.  None yields every image file.
+    :param exclude_globs: (list) Skip files and whole folders matching one of these patterns
+    :param max_depth: (int) Levels of subfolders to descend into, 0 for the top level only, None for no limit
+    :param on_skipped: Called with the path of every file that is not an image
+    :return: Generator of normalized absolute image paths
+    """
+    exclude_globs = exclude_globs or []
+    root_dir = os.path.abspath(root_dir)
+    # (folder path, path relative to the root, depth), popped from the end so the first subfolder is scanned next
+    dir_stack = [(root_dir, "", 0)]
+
+    while dir_stack:
+        dir_path, rel_dir, depth = dir_stack.pop()
+        try:
+            with os.scandir(dir_path) as dir_entries:
+                entries = sorted(dir_entries, key=lambda dir_entry: dir_entry.name)
+        except OSError:
+            continue
+
+        sub_dirs = []
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if exclude_globs and matches_any_glob(rel_path, exclude_globs):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if max_depth is None or depth < max_depth:
+                    sub_dirs.append((entry.path, rel_path, depth + 1))
+            elif entry.is_file():
+                if not util_func.is_file_image(entry.name):
+                    if on_skipped is not None:
+                        on_skipped(entry.path)
+                elif include_globs is None or matches_any_glob(rel_path, include_globs):
+                    yield entry.path.replace("\\", "/")
+
+        dir_stack.extend(reversed(sub_dirs))
+
+
+def iter_chunks(iterable, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Group the items of any iterable, i.e. a folder scan, into lists of at most chunk_size items.
+    :param iterable:
+    :param chunk_size: (int)
+    :return: Generator of lists
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def is_scan_match(root_dir, path, include_globs=None, exclude_globs=None, max_depth=None):
+    """
+    Check whether a single path would be yielded by iter_image_files with the same options, i.e. for a file reported
+    by a folder watcher.
+    :param root_dir: Folder being scanned
+    :param path: Absolute path of the file
+    :param include_globs: (list)
+    :param exclude_globs: (list)
+    :param max_depth: (int) None for no limit
+    :return: (bool)
+    """
+    rel_path = os.path.relpath(path, os.path.abspath(root_dir)).replace("\\", "/")
+    if rel_path.startswith("..") or not util_func.is_file_image(rel_path):
+        return False
+
+    rel_parts = rel_path.split("/")
+    if max_depth is not None and len(rel_parts) - 1 > max_depth:
+        return False
+    if exclude_globs:
+        for part_count in range(1, len(rel_parts) + 1):
+            if matches_any_glob("/".join(rel_parts[:part_count]), exclude_globs):
+                return False
+
+    return include_globs is None or matches_any_glob(rel_path, include_globs)
@@ -0,0 +1,284 @@
+import math
+import numpy as np
+from PIL import Image
+import downscale_func
+
+# Clockwise right angle rotations, done by reordering pixels without any interpolation
+RIGHT_ANGLE_TRANSPOSES = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+# Transpose turning the stored pixels upright for every EXIF orientation but the default of 1.  Orientations 5 to 8
+# swap the width and height.
+EXIF_ORIENTATION_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+SWAPPING_TRANSPOSES = (Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270, Image.Transpose.TRANSPOSE,
+                       Image.Transpose.TRANSVERSE)
+# Filter of the single affine resample per resize quality, transform() only offers nearest, bilinear and bicubic
+GEOMETRY_RESAMPLE = {
+    downscale_func.RESIZE_QUALITY_FAST: Image.BILINEAR,
+    downscale_func.RESIZE_QUALITY_BALANCED: Image.BICUBIC,
+    downscale_func.RESIZE_QUALITY_BEST: Image.BICUBIC,
+}
+
+
+def is_right_angle(rotation):
+    return rotation % 90 == 0
+
+
+def calc_oriented_size(size, orientation):
+    """
+    Size of an image once its EXIF orientation is applied.  Swapping back is the same swap, so this also gives the
+    stored size of an upright size.
+    :param size: (tuple) (width, height)
+    :param orientation: (int) EXIF orientation
+    :return (width, height):
+    """
+    if EXIF_ORIENTATION_TRANSPOSES.get(orientation) in SWAPPING_TRANSPOSES:
+        return size[1], size[0]
+
+    return tuple(size)
+
+
+def apply_orientation(pil_img, orientation):
+    """
+    Transpose the image upright according to its EXIF orientation.  Lossless, pixels are only reordered.
+    :param pil_img: (Image) Decoded image
+    :param orientation: (int) EXIF orientation
+    :return pil_img: (Image) The image itself when it is upright already
+    """
+    if orientation not in EXIF_ORIENTATION_TRANSPOSES:
+        return pil_img
+
+    return pil_img.transpose(EXIF_ORIENTATION_TRANSPOSES[orientation])
+
+
+def calc_rotated_size(size, rotation):
+    """
+    Size of the bounding box of an image of the given size once rotated.
+    :param size: (tuple) (width, height)
+    :param rotation: (int) Degrees
+    :return (width, height):
+    """
+    radians = math.radians(rotation)
+    cos_val = abs(math.cos(radians))
+    sin_val = abs(math.sin(radians))
+    width, height = size
+
+    return width * cos_val + height * sin_val, width * sin_val + height * cos_val
+
+
+def calc_expanded_size(size, rotation):
+    """
+    Whole pixel size of the canvas holding an image of the given size once rotated, rounded the same way as
+    Image.rotate(expand=True).
+    :param size: (tuple) (width, height)
+    :param rotation: (int) Degrees
+    :return (width, height):
+    """
+    if is_right_angle(rotation):
+        return tuple(size) if rotation % 180 == 0 else (size[1], size[0])
+
+    rotated_width, rotated_height = calc_rotated_size(size, rotation)
+    center_x, center_y = size[0] / 2, size[1] / 2
+    # The small tolerance absorbs float error that would otherwise round a whole number up by one pixel
+    return (math.ceil(center_x + rotated_width / 2 - 1e-9) - math.floor(center_x - rotated_width / 2 + 1e-9),
+            math.ceil(center_y + rotated_height / 2 - 1e-9) - math.floor(center_y - rotated_height / 2 + 1e-9))
+
+
+def calc_fit_size(size, rotation, fit_size):
+    """
+    Size to scale an image to so it fits fit_size once rotated, keeping its aspect ratio like Qt.KeepAspectRatio.
+    :param size: (tuple) (width, height) of the image
+    :param rotation: (int) Degrees the image will be rotated by
+    :param fit_size: (tuple) (width, height) to fit, i.e. the preview label
+    :return (width, height): Size before rotation
+    """
+    rotated_width, rotated_height = calc_rotated_size(size, rotation)
+    scale = min(fit_size[0] / rotated_width, fit_size[1] / rotated_height)
+    while True:
+        fitted_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+        expanded_width, expanded_height = calc_expanded_size(fitted_size, rotation)
+        # Rounding out to whole pixels can grow the rotated canvas past fit_size, shrink until it fits
+        if (expanded_width <= fit_size[0] and expanded_height <= fit_size[1]) or fitted_size == (1, 1):
+            return fitted_size
+        scale *= min(fit_size[0] / expanded_width, fit_size[1] / expanded_height, 1 - 1e-3)
+
+
+def calc_untransposed_box(box, size, method):
+    """
+    Region of an image a region of its transpose comes from.
+    :param box: (tuple) (left, top, right, bottom) in the transposed image
+    :param size: (tuple) (width, height) of the image before transposing
+    :param method: (Image.Transpose)
+    :return box: (tuple) (left, top, right, bottom) in the image before transposing
+    """
+    left, top, right, bottom = box
+    width, height = size
+    if method == Image.Transpose.FLIP_LEFT_RIGHT:
+        return width - right, top, width - left, bottom
+    if method == Image.Transpose.FLIP_TOP_BOTTOM:
+        return left, height - bottom, right, height - top
+    if method == Image.Transpose.ROTATE_180:
+        return width - right, height - bottom, width - left, height - top
+    if method == Image.Transpose.ROTATE_270:
+        return top, height - right, bottom, height - left
+    if method == Image.Transpose.ROTATE_90:
+        return width - bottom, left, width - top, right
+    if method == Image.Transpose.TRANSPOSE:
+        return top, left, bottom, right
+    if method == Image.Transpose.TRANSVERSE:
+        return width - bottom, height - right, width - top, height - left
+
+    raise ValueError(f"Unsupported transpose [{method}]")
+
+
+def calc_unrotated_box(box, size, rotation):
+    """
+    Region of an image a region of its right angle rotation comes from, i.e. the source of one output tile.
+    :param box: (tuple) (left, top, right, bottom) in the rotated image
+    :param size: (tuple) (width, height) of the image before rotating
+    :param rotation: (int) Clockwise degrees, a multiple of 90
+    :return box: (tuple) (left, top, right, bottom) in the image before rotating
+    """
+    rotation %= 360
+    if not rotation:
+        return tuple(box)
+
+    return calc_untransposed_box(box, size, RIGHT_ANGLE_TRANSPOSES[rotation])
+
+
+def build_geometry_matrix(source_box, target_size, rotation, output_size):
+    """
+    Compose crop, scale and rotation into one affine matrix.  Like Image.transform() expects, it maps output
+    coordinates back onto the source.
+    :param source_box: (tuple) (left, top, right, bottom) region of the source to use, may be fractional
+    :param target_size: (tuple) (width, height) the region is scaled to before rotating
+    :param rotation: (float) Clockwise degrees
+    :param output_size: (tuple) (width, height) of the output canvas, the rotated image is centred in it
+    :return matrix: (tuple) (a, b, c, d, e, f) for Image.AFFINE
+    """
+    left, top, right, bottom = source_box
+    scale_x = (right - left) / target_size[0]
+    scale_y = (bottom - top) / target_size[1]
+    radians = math.radians(rotation)
+    # Rounded like Image.rotate() so right angles come out exact
+    cos_val = round(math.cos(radians), 15)
+    sin_val = round(math.sin(radians), 15)
+
+    # source = source centre + scale * rotate(-rotation) * (output - output centre)
+    a, b = cos_val * scale_x, sin_val * scale_x
+    d, e = -sin_val * scale_y, cos_val * scale_y
+    output_center_x, output_center_y = output_size[0] / 2, output_size[1] / 2
+    c = (left + right) / 2 - a * output_center_x - b * output_center_y
+    f = (top + bottom) / 2 - d * output_center_x - e * output_center_y
+
+    return a, b, c, d, e, f
+
+
+def apply_geometry(pil_img, target_size, rotation, resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT,
+                   crop_box=None):
+    """
+    Crop, scale and rotate the image with a single resample.  Right angles are resized once then transposed, which
+    is lossless.  Other angles go through one affine transform.  Large downscales first shrink by a whole factor
+    with reduce(), as resize() does with its reducing gap, so the transform never shrinks by 2x or more and does not
+    alias.  Corners uncovered by a rotation are left black, or transparent for RGBA.
+    :param pil_img: (Image)
+    :param target_size: (tuple) (width, height) of the cropped image once scaled, before rotating
+    :param rotation: (float) Clockwise degrees
+    :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+    :param crop_box: (tuple) (left, top, right, bottom) region to keep, None for the whole image
+    :return pil_img: (Image) Of calc_expanded_size(target_size, rotation)
+    """
+    rotation %= 360
+    target_size = tuple(target_size)
+
+    if is_right_angle(rotation):
+        pil_img = downscale_func.resize_img(pil_img, target_size, resize_quality, crop_box)
+        if rotation:
+            pil_img = pil_img.transpose(RIGHT_ANGLE_TRANSPOSES[rotation])
+        return pil_img
+
+    source_box = crop_box if crop_box else (0, 0, pil_img.width, pil_img.height)
+    reduce_factor = int(min((source_box[2] - source_box[0]) / target_size[0],
+                            (source_box[3] - source_box[1]) / target_size[1]))
+    if reduce_factor >= 2:
+        pil_img = pil_img.reduce(reduce_factor, box=tuple(round(value) for value in source_box))
+        source_box = (0, 0, (source_box[2] - source_box[0]) / reduce_factor,
+                      (source_box[3] - source_box[1]) / reduce_factor)
+
+    output_size = calc_expanded_size(target_size, rotation)
+    matrix = build_geometry_matrix(source_box, target_size, rotation, output_size)
+
+    return pil_img.transform(output_size, Image.AFFINE, matrix, resample=GEOMETRY_RESAMPLE[resize_quality])
+
+
+def offset_matrix(matrix, left, top):
+    """
+    Shift an Image.AFFINE matrix so it renders the region of the output starting at (left, top), i.e. one tile.
+    :param matrix: (tuple) (a, b, c, d, e, f)
+    :param left: (int)
+    :param top: (int)
+    :return matrix: (tuple)
+    """
+    a, b, c, d, e, f = matrix
+
+    return a, b, c + a * left + b * top, d, e, f + d * left + e * top
+
+
+def build_coverage_mask(target_size, rotation, box=None):
+    """
+    Mask of the output pixels apply_geometry() fills from the image, 255 inside the rotated image and 0 in the
+    uncovered corners.  Lets later edits leave the corners alone.
+    :param target_size: (tuple) (width, height) passed to apply_geometry()
+    :param rotation: (float) Clockwise degrees
+    :param box: (tuple) (left, top, right, bottom) region of the output to build the mask for, i.e. a tile.  None
+    for all of it.
+    :return mask: (Image) L mode, of calc_expanded_size(target_size, rotation) or the box size
+    """
+    target_size = tuple(target_size)
+    output_size = calc_expanded_size(target_size, rotation)
+    a, b, c, d, e, f = build_geometry_matrix((0, 0, *target_size), target_size, rotation, output_size)
+    left, top, right, bottom = box if box is not None else (0, 0, *output_size)
+    y_centers = np.arange(top, bottom, dtype=np.float64) + 0.5
+
+    # Same test as Image.transform(): a pixel is covered when its centre maps inside the image.  Worked out exactly
+    # rather than by transforming a white image, so the mask of a tile always agrees with the whole mask.
+    def is_covered(columns):
+        x_centers = columns + 0.5
+        x_in = a * x_centers + b * y_centers + c
+        y_in = d * x_centers + e * y_centers + f
+        return (x_in >= 0) & (x_in < target_size[0]) & (y_in >= 0) & (y_in < target_size[1])
+
+    # The covered pixels of a row are one run, its ends are solved per row then settled with the exact test
+    first_centers = np.full(len(y_centers), -np.inf)
+    last_centers = np.full(len(y_centers), np.inf)
+    for slope, offsets, limit in ((a, b * y_centers + c, target_size[0]), (d, e * y_centers + f, target_size[1])):
+        if slope == 0:
+            first_centers = np.where((offsets >= 0) & (offsets < limit), first_centers, np.inf)
+            continue
+        zero_centers, limit_centers = -offsets / slope, (limit - offsets) / slope
+        first_centers = np.maximum(first_centers, np.minimum(zero_centers, limit_centers))
+        last_centers = np.minimum(last_centers, np.maximum(zero_centers, limit_centers))
+    first_columns = np.clip(np.ceil(first_centers - 0.5), left - 2, right + 2).astype(np.int64)
+    last_columns = np.clip(np.floor(last_centers - 0.5), left - 3, right + 1).astype(np.int64)
+    for _ in range(2):
+        first_columns = np.where(is_covered(first_columns - 1), first_columns - 1, first_columns)
+        first_columns = np.where(~is_covered(first_columns) & (first_columns <= last_columns), first_columns + 1,
+                                 first_columns)
+        last_columns = np.where(is_covered(last_columns + 1), last_columns + 1, last_columns)
+        last_columns = np.where(~is_covered(last_columns) & (first_columns <= last_columns), last_columns - 1,
+                                last_columns)
+
+    columns = np.arange(left, right)
+    is_covered_mask = (columns >= first_columns[:, None]) & (columns <= last_columns[:, None])
+
+    return Image.fromarray(is_covered_mask.view(np.uint8) * np.uint8(255), "L")
@@ -1,13 +1,20 @@
+import os
 import sys
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QThreadPool, QTimer
 from PySide6 import QtGui
 from PySide6.QtWidgets import (QGridLayout, QLayout, QPushButton, QLabel, QListWidget, QLineEdit,
                                QWidget, QTabWidget, QMenuBar, QDoubleSpinBox, QComboBox,
-                               QSpinBox, QMenu, QCheckBox)
+                               QSpinBox, QMenu, QCheckBox, QProgressBar, QPlainTextEdit, QFileDialog)
 from load_images_func import LoadImages
 from edit_images_func import EditImages
 from export_images_func import ExportImages
 from export_dialog_box import ExportDialogBox
+from export_worker import ExportWorker
+import batch_process_func
+import export_scheduler_func
+import folder_scan_func
+import instrumentation_func
+import pixmap_cache_func
 import util_func
 
 
@@ -15,7 +22,10 @@ class GuiMain(QWidget):
     """
     The UI class.  Sets up the GUI for the Image Editing application.
     """
-    def __init__(self):
+    def __init__(self, pixmap_cache_budget=pixmap_cache_func.PIXMAP_CACHE_BUDGET_BYTES):
+        """
+        :param pixmap_cache_budget: (int) Bytes of preview pixmaps kept in memory
+        """
         super().__init__()
         self.setWindowTitle("Photo Editor")
         self.setMinimumSize(500, 350)
@@ -33,10 +43,13 @@ class GuiMain(QWidget):
         self.tab_load_images = QWidget(self)
         self.tab_edit_images = QWidget(self)
         self.tab_export_images = QWidget(self)
+        self.tab_metrics = QWidget(self)
         self.tab_widget = QTabWidget(self)
         self.tab_widget.addTab(self.tab_load_images, "Tab 1")
         self.tab_widget.addTab(self.tab_edit_images, "Tab 2")
         self.tab_widget.addTab(self.tab_export_images, "Tab 3")
+        self.tab_widget.addTab(self.tab_metrics, "Tab 4")
+        self.tab_widget.currentChanged.connect(self.refresh_metrics_summary)
 
         # Initialize image load widgets
         self.button_browse_image_files = QPushButton(text="Add Image File(s)")
@@ -46,10 +59,23 @@ class GuiMain(QWidget):
         self.image_url_list = QListWidget()
         self.image_url_list.setFixedSize(500, 250)
         self.image_url_list.setSelectionMode(QListWidget.SelectionMode.MultiSelection)
+        # Every row is one line of text, so Qt can skip measuring each item when hundreds of thousands are loaded
+        self.image_url_list.setUniformItemSizes(True)
+        self.image_url_list.verticalScrollBar().valueChanged.connect(self.request_proxy_prefetch)
         self.button_clear_url_list = QPushButton(text="Clear File(s)")
         self.button_clear_url_list.clicked.connect(self.clean_url_list)
         self.button_remove_selected_url = QPushButton(text="Remove Selected File(s)")
         self.button_remove_selected_url.clicked.connect(self.remove_selected_urls)
+        self.checkbox_include_subfolders = QCheckBox(text="Include Subfolders")
+        self.checkbox_include_subfolders.setChecked(True)
+        self.spinbox_max_depth = QSpinBox()
+        self.spinbox_max_depth.setRange(0, 99)
+        self.spinbox_max_depth.setPrefix("Max Depth: ")
+        self.spinbox_max_depth.setSpecialValueText("Max Depth: No limit")
+        self.line_edit_include_globs = QLineEdit()
+        self.line_edit_include_globs.setPlaceholderText("Include patterns, i.e. *.jpg; 2024/*")
+        self.line_edit_exclude_globs = QLineEdit()
+        self.line_edit_exclude_globs.setPlaceholderText("Exclude patterns, i.e. export; .*")
 
         # Initialize image edit widgets
         self.label_image_preview = QLabel()
@@ -117,6 +143,20 @@ class GuiMain(QWidget):
         self.combobox_image_format.addItem("JPEG")
         self.combobox_image_format.addItem("BMP")
         self.combobox_image_format.addItem("GIF")
+        self.combobox_image_format.addItem("WEBP")
+        self.combobox_encoder_profile = QComboBox()
+        self.combobox_encoder_profile.addItems(["Default", "Web", "Smallest", "Archive"])
+        self.combobox_encoder_profile.setToolTip("Encoder options: quality, progressive JPEG, PNG compression level.")
+        self.spinbox_max_kb = QSpinBox()
+        self.spinbox_max_kb.setRange(0, 1000000)
+        self.spinbox_max_kb.setSuffix(" KB")
+        self.spinbox_max_kb.setSpecialValueText("No limit")
+        self.spinbox_max_kb.setToolTip("Export each image at the highest JPEG/WEBP quality that fits in this size.")
+        self.combobox_resize_quality = QComboBox()
+        self.combobox_resize_quality.addItems(["Fast", "Balanced", "Best"])
+        self.combobox_resize_quality.setCurrentText("Balanced")
+        self.combobox_resize_quality.setToolTip("Fast and Balanced decode JPEGs at a reduced scale when downsizing.  "
+                                                "Best always decodes at full resolution.")
         self.combobox_export_all_or_one = QComboBox()
         self.combobox_export_all_or_one.addItem("Export Current Active Image")
         self.combobox_export_all_or_one.addItem("Export All Images")
@@ -133,11 +173,47 @@ class GuiMain(QWidget):
         self.checkbox_use_orig_filename.clicked.connect(self.toggle_user_filename)
         self.checkbox_append_number = QCheckBox()
         self.checkbox_append_number.setChecked(False)
+        self.checkbox_skip_up_to_date = QCheckBox(text="Skip Up-To-Date Images")
+        self.checkbox_skip_up_to_date.setChecked(False)
+        self.checkbox_skip_up_to_date.setToolTip("Only export images whose source file or edits changed since they "
+                                                 "were last exported to this folder.")
+        self.button_cancel_export = QPushButton(text="Cancel Export")
+        self.button_cancel_export.setEnabled(False)
+        self.button_cancel_export.clicked.connect(self.cancel_export)
+        self.progress_bar_export = QProgressBar()
+        self.progress_bar_export.setValue(0)
+        self.label_export_progress = QLabel()
+        self.export_scheduler = None
+        self.export_worker = None
+        self.export_warnings = []
+
+        # Initialize metrics widgets
+        self.checkbox_enable_metrics = QCheckBox(text="Record Stage Timings")
+        self.checkbox_enable_metrics.setToolTip("Time decode, enhance, rotate, scale, convert and encode, and count "
+                                                "bytes and cache hits.  Costs close to nothing while unchecked.")
+        self.checkbox_enable_metrics.toggled.connect(self.toggle_metrics)
+        self.text_metrics_summary = QPlainTextEdit()
+        self.text_metrics_summary.setReadOnly(True)
+        self.text_metrics_summary.setFixedSize(500, 300)
+        self.text_metrics_summary.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.button_reset_metrics = QPushButton(text="Reset")
+        self.button_reset_metrics.clicked.connect(self.reset_metrics)
+        self.button_export_metrics_json_lines = QPushButton(text="Export JSON Lines")
+        self.button_export_metrics_json_lines.clicked.connect(
+            lambda: self.export_metrics(instrumentation_func.METRICS_FORMAT_JSON_LINES))
+        self.button_export_metrics_prometheus = QPushButton(text="Export Prometheus")
+        self.button_export_metrics_prometheus.clicked.connect(
+            lambda: self.export_metrics(instrumentation_func.METRICS_FORMAT_PROMETHEUS))
+        # Refreshes the summary while the metrics tab is showing and recording is on
+        self.timer_metrics = QTimer(self)
+        self.timer_metrics.setInterval(1000)
+        self.timer_metrics.timeout.connect(self.refresh_metrics_summary)
 
         # Populate the window tab objects with widgets
         self.init_tab_load_images()
         self.init_tab_edit_images()
         self.init_tab_export_images()
+        self.init_tab_metrics()
 
         # Add the tab widget to a main layout and set the layout so it shows up
         main_layout = QGridLayout()
@@ -147,7 +223,7 @@ class GuiMain(QWidget):
 
         # Instantiate func classes to access data logic
         self.load_images = LoadImages()
-        self.edit_images = EditImages(self.label_image_preview)
+        self.edit_images = EditImages(self.label_image_preview, self.load_images.image_cache, pixmap_cache_budget)
         self.export_images = ExportImages()
 
     def create_menu_bar(self):
@@ -161,13 +237,16 @@ class GuiMain(QWidget):
 
         # Create the menu actions
         exit_action = QtGui.QAction("Exit", self)
+        clear_cache_action = QtGui.QAction("Clear Image Cache", self)
         reset_current_image = QtGui.QAction("Reset Current Image", self)
         reset_all_images = QtGui.QAction("Reset All Images", self)
 
         # Create the function call when the action is triggered.
         exit_action.triggered.connect(self.exit_action_triggered)
+        clear_cache_action.triggered.connect(self.clear_cache_action_triggered)
 
         # Add the action to the menu
+        file_menu.addAction(clear_cache_action)
         file_menu.addAction(exit_action)
         edit_menu.addAction(reset_current_image)
         edit_menu.addAction(reset_all_images)
@@ -184,6 +263,14 @@ class GuiMain(QWidget):
         """
         sys.exit()
 
+    def clear_cache_action_triggered(self):
+        """
+        Remove every entry from the on-disk image metadata and thumbnail cache.
+        :return:
+        """
+        if self.load_images.image_cache is not None:
+            self.load_images.image_cache.invalidate()
+
     def init_tab_load_images(self):
         """
         Initialize the grid layout for the Load Image tab and add the widgets.  Then name the tab and
@@ -197,6 +284,10 @@ class GuiMain(QWidget):
         layout_load_images.addWidget(self.image_url_list, 1, 0, 1, 0)
         layout_load_images.addWidget(self.button_remove_selected_url, 2, 0)
         layout_load_images.addWidget(self.button_clear_url_list, 2, 1)
+        layout_load_images.addWidget(self.checkbox_include_subfolders, 3, 0)
+        layout_load_images.addWidget(self.spinbox_max_depth, 3, 1)
+        layout_load_images.addWidget(self.line_edit_include_globs, 4, 0)
+        layout_load_images.addWidget(self.line_edit_exclude_globs, 4, 1)
         for n in range(0, 1):
             layout_load_images.setRowStretch(n, 0)
             layout_load_images.setColumnStretch(n, 0)
@@ -261,6 +352,9 @@ class GuiMain(QWidget):
         label_append_number = QLabel(text="Append Incremental Number?")
         label_export_file_format = QLabel("File Format:")
         label_export_method = QLabel("Export Method:")
+        label_resize_quality = QLabel("Resize Quality:")
+        label_encoder_profile = QLabel("Encoder Profile:")
+        label_max_kb = QLabel("Max File Size:")
 
         layout_export_images = QGridLayout()
         layout_export_images.setSizeConstraint(QLayout.SetFixedSize)
@@ -268,8 +362,12 @@ class GuiMain(QWidget):
         layout_export_images.addWidget(self.button_browse_export_dir, 0, 2)
         layout_export_images.addWidget(label_export_file_format, 1, 0)
         layout_export_images.addWidget(self.combobox_image_format, 1, 1)
+        layout_export_images.addWidget(label_resize_quality, 1, 2)
+        layout_export_images.addWidget(self.combobox_resize_quality, 1, 3)
         layout_export_images.addWidget(label_export_method, 2, 0)
         layout_export_images.addWidget(self.combobox_export_all_or_one, 2, 1)
+        layout_export_images.addWidget(label_encoder_profile, 2, 2)
+        layout_export_images.addWidget(self.combobox_encoder_profile, 2, 3)
         layout_export_images.addWidget(label_use_orig_filename, 3, 0)
         layout_export_images.addWidget(self.checkbox_use_orig_filename, 3, 1)
         layout_export_images.addWidget(self.line_edit_filename, 3, 2)
@@ -277,7 +375,13 @@ class GuiMain(QWidget):
         layout_export_images.addWidget(self.line_edit_suffix, 4, 1, 1, 1)
         layout_export_images.addWidget(label_append_number, 5, 0)
         layout_export_images.addWidget(self.checkbox_append_number, 5, 1)
+        layout_export_images.addWidget(label_max_kb, 5, 2)
+        layout_export_images.addWidget(self.spinbox_max_kb, 5, 3)
         layout_export_images.addWidget(self.button_export_files, 6, 0)
+        layout_export_images.addWidget(self.button_cancel_export, 6, 1)
+        layout_export_images.addWidget(self.checkbox_skip_up_to_date, 6, 2, 1, 2)
+        layout_export_images.addWidget(self.progress_bar_export, 7, 0, 1, 4)
+        layout_export_images.addWidget(self.label_export_progress, 8, 0, 1, 4)
 
         for n in range(0, 1):
             layout_export_images.setRowStretch(n, 0)
@@ -286,6 +390,71 @@ class GuiMain(QWidget):
         self.tab_widget.setTabText(2, "Export Images")
         self.tab_export_images.setLayout(layout_export_images)
 
+    def init_tab_metrics(self):
+        """
+        Initialize the grid layout for the Metrics tab and add the widgets.  Then name the tab and add the grid to the
+        tab.
+        :return:
+        """
+        layout_metrics = QGridLayout()
+        layout_metrics.setSizeConstraint(QLayout.SetFixedSize)
+        layout_metrics.addWidget(self.checkbox_enable_metrics, 0, 0)
+        layout_metrics.addWidget(self.button_reset_metrics, 0, 2)
+        layout_metrics.addWidget(self.text_metrics_summary, 1, 0, 1, 3)
+        layout_metrics.addWidget(self.button_export_metrics_json_lines, 2, 0)
+        layout_metrics.addWidget(self.button_export_metrics_prometheus, 2, 1)
+
+        # Recording may already be on from the command line
+        self.checkbox_enable_metrics.setChecked(instrumentation_func.is_enabled())
+        self.tab_widget.setTabText(3, "Metrics")
+        self.tab_metrics.setLayout(layout_metrics)
+
+    def toggle_metrics(self, is_checked):
+        """
+        Executed when the user toggles the metrics checkbox.  Turns recording of stage timings and counters on or off.
+        :param is_checked: (bool)
+        :return:
+        """
+        instrumentation_func.enable(is_checked)
+        if is_checked:
+            self.timer_metrics.start()
+        else:
+            self.timer_metrics.stop()
+        self.refresh_metrics_summary()
+
+    def refresh_metrics_summary(self):
+        """
+        Show the current stage timings and counters in the metrics tab.  Skipped while another tab is showing.
+        :return:
+        """
+        if self.tab_widget.currentWidget() is not self.tab_metrics:
+            return
+
+        if instrumentation_func.is_enabled():
+            self.text_metrics_summary.setPlainText(instrumentation_func.format_summary())
+        else:
+            self.text_metrics_summary.setPlainText("Recording is off.  Check \"Record Stage Timings\" to start.")
+
+    def reset_metrics(self):
+        instrumentation_func.METRICS.reset()
+        self.refresh_metrics_summary()
+
+    def export_metrics(self, metrics_format):
+        """
+        Executed when the user clicks on one of the metrics export buttons.  Asks for a file and writes the current
+        measurements to it.
+        :param metrics_format: (str) instrumentation_func.METRICS_FORMAT_JSON_LINES or METRICS_FORMAT_PROMETHEUS
+        :return:
+        """
+        if metrics_format == instrumentation_func.METRICS_FORMAT_PROMETHEUS:
+            default_name, name_filter = "metrics.prom", "Prometheus text (*.prom *.txt)"
+        else:
+            default_name, name_filter = "metrics.jsonl", "JSON Lines (*.jsonl)"
+
+        metrics_path, _ = QFileDialog.getSaveFileName(self, "Export Metrics", default_name, name_filter)
+        if metrics_path:
+            instrumentation_func.write_metrics(metrics_path, metrics_format=metrics_format)
+
     def populate_list_with_files(self):
         """
         Calls browse_for_files from LoadImages class to let user open file dialog and select 1 or more files
@@ -294,7 +463,7 @@ class GuiMain(QWidget):
         """
         self.load_images.browse_for_files()
         selected_files = self.load_images.selected_files_abs_paths
-        self.load_images.check_list_for_duplicates(self.image_url_list, selected_files)
+        self.load_images.check_list_for_duplicates(selected_files)
         refined_file_list = self.load_images.refined_file_list
 
         # Add the img paths to the appropriate ui widgets
@@ -306,23 +475,22 @@ class GuiMain(QWidget):
 
     def populate_list_with_dir_files(self):
         """
-        Calls browse_for_folder from LoadImages class to let user open file dialog and select a directory.  The files
-        are parsed then stored in the dir_selected_files_abs_paths attr.
+        Calls browse_for_folder from LoadImages class to let user open file dialog and select a directory.  The folder
+        tree is scanned in the background with the scan options from the load tab, duplicates are dropped as they are
+        found and the images are added to the widgets in batches.
         :return:
         """
-        # User selects folder, then we process files to check for duplicates.  Refined_File_List contains the new unique
-        # items to be added.
-        self.load_images.browse_for_folder()
-        dir_selected_files = self.load_images.dir_selected_files_abs_paths
-        self.load_images.check_list_for_duplicates(self.image_url_list, dir_selected_files)
-        refined_file_list = self.load_images.refined_file_list
-
-        # Add the img paths to the appropriate ui widgets
-        if refined_file_list:
-            self.add_img_path_to_widgets(refined_file_list)
+        selected_dir = self.load_images.browse_for_folder()
+        if not selected_dir:
+            return
 
-        # Reset vars for next load pass and populate the active img combobox
-        self.load_images.reset_load_attributes()
+        max_depth = 0
+        if self.checkbox_include_subfolders.isChecked():
+            max_depth = self.spinbox_max_depth.value() or None
+        include_globs = folder_scan_func.parse_glob_list(self.line_edit_include_globs.text()) or None
+        exclude_globs = folder_scan_func.parse_glob_list(self.line_edit_exclude_globs.text())
+        self.load_images.start_folder_probe(selected_dir, self.add_img_jobs_to_widgets, self.report_unreadable_files,
+                                            include_globs, exclude_globs, max_depth)
 
     def populate_active_image_combobox(self, img_path):
         """
@@ -335,16 +503,42 @@ class GuiMain(QWidget):
 
     def add_img_path_to_widgets(self, refined_file_list):
         """
-        So long as we have new unique items to add, create a new image job object for each item and add the
-        img_path attr to the list widget and the truncated path to the edit tab combobox.
+        So long as we have new unique items to add, probe each file in the background.  Image jobs are added to the
+        widgets in batches as they become ready.
         :param refined_file_list:
         :return:
         """
-        self.load_images.create_image_jobs(refined_file_list)
+        self.load_images.start_image_probe(refined_file_list, self.add_img_jobs_to_widgets,
+                                           self.report_unreadable_files)
+
+    def add_img_jobs_to_widgets(self, generation, img_job_batch):
+        """
+        Receives a batch of probed image jobs.  Store them and add the img_path attr to the list widget and the
+        truncated path to the edit tab combobox.  Batches of a load started before the list was cleared are dropped.
+        :param generation: (int) Probe generation of the batch
+        :param img_job_batch: (list) ImageJob objects
+        :return:
+        """
+        if not self.load_images.add_image_jobs(img_job_batch, generation):
+            return
 
-        for path in refined_file_list:
-            self.image_url_list.addItem(path)
-            self.populate_active_image_combobox(path)
+        img_paths = [job.img_path for job in img_job_batch]
+        self.image_url_list.addItems(img_paths)
+        self.combobox_active_image.addItems([util_func.truncate_file_path(path) for path in img_paths])
+
+    def report_unreadable_files(self, generation, failed_files):
+        """
+        Show one popup listing every file that could not be read during a load, unless the list was cleared since.
+        :param generation: (int) Probe generation of the load
+        :param failed_files: (list) (path, error message) tuples
+        :return:
+        """
+        if self.load_images.is_probe_stale(generation):
+            return
+        message_list = "\n".join(f"{path}: {error_message}" for path, error_message in failed_files)
+        message_dialog_box = ExportDialogBox(message_list, "Warning! Unreadable Files",
+                                             "These files could not be read and were skipped:")
+        message_dialog_box.exec_()
 
     def clean_url_list(self):
         """
@@ -352,21 +546,42 @@ class GuiMain(QWidget):
         default item.
         :return:
         """
+        # Cancels loads still running, so none of their images show up in the cleared list
+        self.load_images.clear_image_jobs()
         self.image_url_list.clear()
         self.load_images.reset_load_attributes()
         self.edit_images.reset_edit_attributes()
-        self.load_images.all_image_jobs = []
         while self.combobox_active_image.count() > 1:
             self.combobox_active_image.removeItem(1)
 
     def remove_selected_urls(self):
         """
-        Remove all selected items from the list widget
+        Remove all selected items from the list widget, along with their image jobs, active image combobox entries
+        and cached pixmaps.
         :return:
         """
-        selected_items = self.image_url_list.selectedItems()
-        for item in selected_items:
-            self.image_url_list.takeItem(self.image_url_list.row(item))
+        selected_rows = sorted(self.image_url_list.row(item) for item in self.image_url_list.selectedItems())
+        if not selected_rows:
+            return
+
+        active_row = self.combobox_active_image.currentIndex() - 1
+        removed_jobs = self.load_images.remove_image_jobs(selected_rows)
+        for img_job in removed_jobs:
+            self.edit_images.discard_img_job(img_job.img_id)
+
+        # Keep the combobox quiet while its rows shift, the active image is refreshed once below
+        self.combobox_active_image.blockSignals(True)
+        for row in reversed(selected_rows):
+            self.image_url_list.takeItem(row)
+            self.combobox_active_image.removeItem(row + 1)
+        if active_row in selected_rows:
+            self.combobox_active_image.setCurrentIndex(0)
+        self.combobox_active_image.blockSignals(False)
+
+        if active_row in selected_rows:
+            self.display_selected_image()
+        else:
+            self.edit_images.active_job_index = self.combobox_active_image.currentIndex() - 1
 
     def display_selected_image(self):
         """
@@ -379,28 +594,59 @@ class GuiMain(QWidget):
             display_pixmap = self.get_img_job_pixmap()
             self.set_resolution_values()
             self.set_edit_control_values()
-            self.label_image_preview.setPixmap(display_pixmap)
+            if display_pixmap is None:
+                # Shown by display_rendered_preview() once rendered in the background
+                self.label_image_preview.clear()
+            else:
+                self.label_image_preview.setPixmap(display_pixmap)
             self.is_attr_modified = False
+            self.request_proxy_prefetch()
         else:
             self.reset_edit_controls()
             self.label_image_preview.clear()
 
+    def request_proxy_prefetch(self):
+        """
+        Triggers when an image is displayed or the image list is scrolled.  Decode the previews of the images most
+        likely to be selected next in the background, so stepping to them shows them straight away.
+        :return:
+        """
+        if self.load_images.all_image_jobs:
+            self.edit_images.request_prefetch(self.load_images.all_image_jobs, self.get_visible_url_rows())
+
+    def get_visible_url_rows(self):
+        """
+        :return rows: (range) Rows of the image list widget scrolled into view
+        """
+        viewport_rect = self.image_url_list.viewport().rect()
+        first_index = self.image_url_list.indexAt(viewport_rect.topLeft())
+        if not first_index.isValid():
+            return range(0)
+        last_index = self.image_url_list.indexAt(viewport_rect.bottomLeft())
+        last_row = last_index.row() if last_index.isValid() else self.image_url_list.count() - 1
+
+        return range(first_index.row(), last_row + 1)
+
     def get_img_job_pixmap(self):
+        """
+        Get the pixmap to display for the selected image job from the edit images pixmap cache.  When it has been
+        evicted, or was never shown, it is rendered in the background and shown once ready.
+        :return display_pixmap: None while it is being rendered
+        """
         self.edit_images.set_active_img_job(self.combobox_active_image, self.load_images)
         self.img_job = self.edit_images.img_job
 
-        if self.img_job.img_enhanced_pixmap is None:
-            self.is_previewing_default = True
-            self.button_toggle_preview.setEnabled(False)
-            if self.img_job.img_pixmap is None:
-                display_pixmap = self.edit_images.create_default_pixmap_object(self.image_url_list)
-                self.img_job.img_pixmap = display_pixmap
-            else:
-                display_pixmap = self.img_job.img_pixmap
-        else:
+        if self.edit_images.has_preview_edits():
             self.is_previewing_default = False
             self.button_toggle_preview.setEnabled(True)
-            display_pixmap = self.img_job.img_enhanced_pixmap
+            display_pixmap = self.edit_images.get_enhanced_pixmap()
+        else:
+            self.is_previewing_default = True
+            self.button_toggle_preview.setEnabled(False)
+            display_pixmap = self.edit_images.get_default_pixmap()
+
+        if display_pixmap is None:
+            self.edit_images.request_preview_render(self.display_rendered_preview, self.is_previewing_default)
 
         return display_pixmap
 
@@ -427,11 +673,11 @@ class GuiMain(QWidget):
 
         self.label_resolution.setText(f"Original Resolution: {orig_width} x {orig_height}")
 
-        self.line_edit_y_res.setText(orig_height) if self.img_job.img_new_height == "" else (
-            self.line_edit_y_res.setText(self.img_job.img_new_height))
+        self.line_edit_y_res.setText(str(orig_height)) if self.img_job.img_new_height == 0 else (
+            self.line_edit_y_res.setText(str(self.img_job.img_new_height)))
 
-        self.line_edit_x_res.setText(orig_width) if self.img_job.img_new_width == "" else (
-            self.line_edit_x_res.setText(self.img_job.img_new_width))
+        self.line_edit_x_res.setText(str(orig_width)) if self.img_job.img_new_width == 0 else (
+            self.line_edit_x_res.setText(str(self.img_job.img_new_width)))
 
         self.spinbox_rotate.setValue(self.img_job.img_rotation)
 
@@ -458,10 +704,13 @@ class GuiMain(QWidget):
         to calculate the height based on aspect ratio checkbox state.
         :return:
         """
-        if self.label_image_preview.pixmap() is not None and self.checkbox_keep_aspect_ratio.isChecked():
+        if self.label_image_preview.pixmap() is not None and self.img_job is not None:
             new_img_width = int(self.line_edit_x_res.text())
-            new_img_height = self.edit_images.calc_img_wh(new_img_width, True)
-            self.line_edit_y_res.setText(str(new_img_height))
+            if self.checkbox_keep_aspect_ratio.isChecked():
+                new_img_height = self.edit_images.calc_img_wh(new_img_width, True)
+                self.line_edit_y_res.setText(str(new_img_height))
+            else:
+                self.edit_images.set_img_job_res(new_img_width, int(self.line_edit_y_res.text()))
 
     def refresh_img_width(self):
         """
@@ -469,10 +718,13 @@ class GuiMain(QWidget):
         based on aspect ratio checkbox state.
         :return:
         """
-        if self.label_image_preview.pixmap() is not None and self.checkbox_keep_aspect_ratio.isChecked():
+        if self.label_image_preview.pixmap() is not None and self.img_job is not None:
             new_img_height = int(self.line_edit_y_res.text())
-            new_img_width = self.edit_images.calc_img_wh(new_img_height, False)
-            self.line_edit_x_res.setText(str(new_img_width))
+            if self.checkbox_keep_aspect_ratio.isChecked():
+                new_img_width = self.edit_images.calc_img_wh(new_img_height, False)
+                self.line_edit_x_res.setText(str(new_img_width))
+            else:
+                self.edit_images.set_img_job_res(int(self.line_edit_x_res.text()), new_img_height)
 
     def refresh_pixmap_img(self):
         self.button_toggle_preview.setEnabled(True)
@@ -482,29 +734,51 @@ class GuiMain(QWidget):
             sharpness_value = self.spinbox_sharpness.value()
             brightness_value = self.spinbox_brightness.value()
 
-            is_exporting_image = False
-            pil_img = self.edit_images.convert_pixmap_to_pil(is_exporting_image)
-
-            enhanced_pixmap = self.edit_images.calc_img_enhance(rotation_value, contrast_value,
-                                                                sharpness_value, brightness_value, pil_img)
             self.edit_images.set_img_job_attr(rotation_value, contrast_value, sharpness_value, brightness_value)
-            self.label_image_preview.setPixmap(enhanced_pixmap)
+            self.edit_images.request_preview_render(self.display_rendered_preview)
+
+    def display_rendered_preview(self, generation, img_job, cache_key, shared_img):
+        """
+        Receives finished preview renders from the background worker.  Only the latest render of the active image is
+        shown.
+        :param generation: (int) Render request generation
+        :param img_job: (ImageJob) Job the render belongs to
+        :param cache_key: (tuple) Pixmap cache key of the render
+        :param shared_img: (SharedImage) Rendered preview
+        :return:
+        """
+        preview_pixmap = self.edit_images.apply_preview_render(generation, img_job, cache_key, shared_img)
+        if preview_pixmap is not None:
+            self.label_image_preview.setPixmap(preview_pixmap)
 
     def toggle_image_preview(self):
         """
         Called when user clicks on the Toggle Image Preview button.  Swaps between the default pixmap and the
-        enhanced pixmap (if exists), ensuring that both adopt the proper rotation value.
+        enhanced pixmap (if exists), ensuring that both adopt the proper rotation value.  Pixmaps no longer in the
+        cache are rendered in the background and shown once ready.
         :return:
         """
         # TODO: Not working
         if self.label_image_preview is not None:
-            if self.is_previewing_default:
-                self.label_image_preview.setPixmap(self.img_job.img_enhanced_pixmap)
+            if self.is_previewing_default and self.edit_images.has_preview_edits():
+                self.show_preview_pixmap(self.edit_images.get_enhanced_pixmap(), False)
                 self.label_displayed_image.setText("Displayed: Edited")
             else:
-                self.label_image_preview.setPixmap(self.img_job.img_pixmap)
+                self.show_preview_pixmap(self.edit_images.get_default_pixmap(), True)
                 self.label_displayed_image.setText("Displayed: Original")
 
+    def show_preview_pixmap(self, preview_pixmap, is_default):
+        """
+        Show a preview pixmap taken from the pixmap cache, or request its render when it was not cached.
+        :param preview_pixmap: None on a cache miss
+        :param is_default: (bool) The pixmap is the unedited preview
+        :return:
+        """
+        if preview_pixmap is None:
+            self.edit_images.request_preview_render(self.display_rendered_preview, is_default)
+        else:
+            self.label_image_preview.setPixmap(preview_pixmap)
+
     def browse_to_export_directory(self):
         """
         Executed when user clicks on the button to browse to a specific export directory
@@ -528,7 +802,8 @@ class GuiMain(QWidget):
 
     def export_image_to_file(self):
         """
-        Executed when the user clicks on the button to process export on the images.
+        Executed when the user clicks on the button to process export on the images.  Every image is decoded from its
+        original file and its recorded edit operations are applied once, at full resolution.
         :return:
         """
         is_safe_to_save = self.export_error_checks()
@@ -538,15 +813,14 @@ class GuiMain(QWidget):
             export_dir = self.line_edit_export_dir.text()
             prefix = self.line_edit_prefix.text() if self.line_edit_prefix.text() != "" else ""
             suffix = self.line_edit_suffix.text() if self.line_edit_suffix.text() != "" else ""
+            batch_settings = self.create_batch_settings(chosen_file_format, export_dir, prefix, suffix)
 
             if self.combobox_export_all_or_one.currentIndex() == 0:
                 if self.combobox_active_image.currentIndex() == 0:
                     self.open_dialog_box("Please choose an edited image from the Edit tab dropdown menu to export")
                 if self.img_job is not None:
-                    if self.img_job.img_enhanced_pixmap is not None:
-                        filename_with_format = self.establish_filename(chosen_file_format, export_dir,
-                                                                       prefix, suffix)
-                        self.resize_and_save(True, export_dir, filename_with_format)
+                    if self.img_job.img_edit_ops:
+                        self.save_img_job(self.img_job, batch_settings)
                     else:
                         self.open_dialog_box("The current image has no edits.  Please edit it first.")
                 else:
@@ -556,14 +830,97 @@ class GuiMain(QWidget):
                 if not all_image_jobs:
                     self.open_dialog_box(f"No images found.  Please load and edit some images.")
                 else:
-                    for job in all_image_jobs:
-                        if job.img_enhanced_pixmap is None:
-                            self.open_dialog_box(f"This image [{job.img_name}] has no edits.  "
-                                                 f"Please edit it first.  Skipping.")
-                        else:
-                            filename_with_format = self.establish_filename(chosen_file_format, export_dir,
-                                                                           prefix, suffix, job)
-                            self.resize_and_save(True, export_dir, filename_with_format)
+                    self.start_export_all(all_image_jobs, batch_settings)
+
+    def start_export_all(self, all_image_jobs, batch_settings):
+        """
+        Export every edited image job in the background.  Images without edits are skipped and listed in the summary
+        shown once the export has finished.
+        :param all_image_jobs: (JobTable) Loaded image jobs
+        :param batch_settings: (BatchSettings)
+        :return:
+        """
+        export_jobs = [job for job in all_image_jobs if job.img_edit_ops]
+        self.export_warnings = [f"[{job.img_name}] has no edits.  Skipped." for job in all_image_jobs
+                                if not job.img_edit_ops]
+        if not export_jobs:
+            self.show_export_summary([])
+            return
+
+        decode_workers = min(os.cpu_count() or 1, export_scheduler_func.GUI_EXPORT_MAX_DECODE_WORKERS)
+        self.export_scheduler = export_scheduler_func.ExportScheduler(batch_settings, decode_workers)
+        self.export_worker = ExportWorker(self.export_scheduler, export_jobs)
+        self.export_worker.signals.progress.connect(self.update_export_progress)
+        self.export_worker.signals.finished.connect(self.show_export_summary)
+        self.export_worker.signals.failed.connect(self.export_failed)
+
+        self.button_export_files.setEnabled(False)
+        self.button_cancel_export.setEnabled(True)
+        self.progress_bar_export.setRange(0, len(export_jobs))
+        self.progress_bar_export.setValue(0)
+        self.label_export_progress.setText(f"Exporting {len(export_jobs)} images...")
+        QThreadPool.globalInstance().start(self.export_worker)
+
+    def cancel_export(self):
+        if self.export_scheduler is not None:
+            self.export_scheduler.cancel()
+            self.button_cancel_export.setEnabled(False)
+            self.label_export_progress.setText("Cancelling, waiting for the images in progress to finish...")
+
+    def update_export_progress(self, completed, total, images_per_second, eta_seconds):
+        """
+        Receives the export progress from the export worker after every finished image.
+        :param completed: (int)
+        :param total: (int)
+        :param images_per_second: (float)
+        :param eta_seconds: (float) None until the first image has finished
+        :return:
+        """
+        self.progress_bar_export.setValue(completed)
+        if self.export_scheduler is not None and self.export_scheduler.is_cancelled():
+            return
+
+        eta_text = "--:--" if eta_seconds is None else "{:d}:{:02d}".format(*divmod(int(eta_seconds), 60))
+        self.label_export_progress.setText(f"{completed}/{total} images, {images_per_second:.1f} images/s, "
+                                           f"ETA {eta_text}")
+
+    def finish_export(self):
+        self.export_scheduler = None
+        self.export_worker = None
+        self.button_export_files.setEnabled(True)
+        self.button_cancel_export.setEnabled(False)
+
+    def show_export_summary(self, results):
+        """
+        Show one popup summarizing the export, listing every image that was skipped, failed or cancelled.
+        :param results: (list) Result dicts from the export scheduler
+        :return:
+        """
+        self.finish_export()
+
+        succeeded = len([result for result in results if result["status"] == "ok"])
+        cancelled = len([result for result in results if result["status"] == "cancelled"])
+        up_to_date = len([result for result in results if result["status"] == "up_to_date"])
+        message_list = list(self.export_warnings)
+        for result in results:
+            if result["status"] == "failed":
+                message_list.append(f"[{result['source']}] could not be exported.  {result['message']}")
+        if cancelled:
+            message_list.append(f"{cancelled} images were not exported, the export was cancelled.")
+
+        summary = f"Exported {succeeded} of {len(results) + len(self.export_warnings)} images."
+        if up_to_date:
+            summary += f"  {up_to_date} were already up to date."
+        self.label_export_progress.setText(summary)
+        self.export_warnings = []
+        if message_list:
+            message_dialog_box = ExportDialogBox("\n".join(message_list), "Export Finished", summary)
+            message_dialog_box.exec_()
+
+    def export_failed(self, error_message):
+        self.finish_export()
+        self.label_export_progress.setText("Export failed.")
+        self.open_dialog_box(f"The export could not run.\n{error_message}")
 
     def export_error_checks(self):
         """
@@ -601,32 +958,39 @@ class GuiMain(QWidget):
         message_dialog_box = ExportDialogBox(message_list)
         message_dialog_box.exec_()
 
-    def establish_filename(self, *args):
-        """
-        Configure the filename and call func to begin save image process.
-        :param args: (chosen_file_format, export_dir, prefix, suffix, job)
-        :return:
-        """
+    def create_batch_settings(self, *args):
+        """
+        Read the export tab widgets into a BatchSettings object for the export engine.
+        :param args: (chosen_file_format, export_dir, prefix, suffix)
+        :return batch_settings: (BatchSettings)
+        """
+        batch_settings = batch_process_func.BatchSettings()
+        batch_settings.file_format = args[0]
+        batch_settings.export_dir = args[1]
+        batch_settings.prefix = args[2]
+        batch_settings.suffix = args[3]
+        batch_settings.append_number = self.checkbox_append_number.isChecked()
+        batch_settings.resize_quality = self.combobox_resize_quality.currentText().lower()
+        batch_settings.encoder_profile = self.combobox_encoder_profile.currentText().lower()
+        batch_settings.max_kb = self.spinbox_max_kb.value()
+        batch_settings.skip_up_to_date = self.checkbox_skip_up_to_date.isChecked()
         if not self.checkbox_use_orig_filename.isChecked():
-            base_filename = self.line_edit_filename.text()
-        else:
-            base_filename = self.img_job.img_name if self.combobox_export_all_or_one.currentIndex() == 0 else (
-                args[4].img_name)
+            batch_settings.base_filename = self.line_edit_filename.text()
 
-        filename_with_inserts = self.export_images.get_filename_with_inserts(base_filename, args[2], args[3])
+        return batch_settings
 
-        if self.checkbox_append_number.isChecked():
-            filename_with_format = self.export_images.get_filename_with_increm_num(args[1],
-                                                                                   filename_with_inserts,
-                                                                                   args[0],
-                                                                                   "")
-            return filename_with_format
-        else:
-            filename_with_format = f"{filename_with_inserts}.{args[0]}"
-            return filename_with_format
-
-    def resize_and_save(self, is_exporting_image, export_dir, filename_with_format):
-        # Convert enhanced_pixmap from img_job to pillow image and save new file.
-        pil_img = self.edit_images.convert_pixmap_to_pil(is_exporting_image)
-        resized_pil_img = pil_img.resize((int(self.line_edit_x_res.text()), int(self.line_edit_y_res.text())))
-        self.export_images.save_image_out(resized_pil_img, export_dir, filename_with_format)
+    def save_img_job(self, job, batch_settings):
+        """
+        Export the image job through the export scheduler, in this thread, and let the user know if it failed.  As for
+        an export of every image, an output that is up to date with the export manifest is not exported again when
+        the skip option is on, and the manifest records the new output.
+        :param job: (ImageJob)
+        :param batch_settings: (BatchSettings)
+        :return:
+        """
+        export_scheduler = export_scheduler_func.ExportScheduler(batch_settings, decode_workers=1, encode_workers=1)
+        result = export_scheduler.run([job])[0]
+        if result["status"] == "up_to_date":
+            self.open_dialog_box(f"This image [{job.img_name}] is already up to date in the export folder.")
+        elif result["status"] != "ok":
+            self.open_dialog_box(f"This image [{job.img_name}] could not be exported.\n{result['message']}")
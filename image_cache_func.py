@@ -0,0 +1,254 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+from PIL import Image
+import instrumentation_func
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                         "image_editor")
+CACHE_DB_NAME = "image_cache.sqlite3"
+CACHE_MAX_ENTRIES = 200000
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Eviction trims the cache to this fraction of its limits so it does not run again on the very next insert
+CACHE_EVICT_TARGET = 0.9
+THUMBNAIL_JPEG_QUALITY = 85
+# Stored as the database user_version.  Bump when the thumbnails of unchanged files would come out differently, the
+# cached ones are dropped once on open.  Version 1 turns thumbnails upright by their EXIF orientation.
+THUMBNAIL_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_cache (
+    path TEXT PRIMARY KEY,
+    file_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    format TEXT,
+    orientation INTEGER NOT NULL DEFAULT 1,
+    thumbnail BLOB,
+    thumbnail_bytes INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_cache_last_access ON image_cache (last_access);
+"""
+
+
+def get_file_signature(file):
+    """
+    Size and modification time of a file.  Together with the absolute path they form the cache key.
+    :param file: Absolute path to the image file
+    :return (file_size, mtime_ns):
+    """
+    file_stat = os.stat(file)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+class ImageCache:
+    """
+    This class contains the logic for the persistent on-disk cache of image metadata and preview thumbnails.  Entries
+    are keyed by absolute path, file size and modification time, so an edited or replaced file is never served from
+    the cache.  Safe to share between threads.
+    """
+    def __init__(self, db_path=None, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.logger = instrumentation_func.get_logger(__name__)
+
+        self.db_path = db_path if db_path else os.path.join(CACHE_DIR, CACHE_DB_NAME)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if self.db_path != ":memory:":
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < THUMBNAIL_VERSION:
+            self.connection.execute("UPDATE image_cache SET thumbnail = NULL, thumbnail_bytes = 0")
+            self.connection.execute(f"PRAGMA user_version = {THUMBNAIL_VERSION}")
+            self.connection.commit()
+
+    @staticmethod
+    def normalize_path(file):
+        return os.path.abspath(file).replace("\\", "/")
+
+    def get_metadata(self, file, file_signature=None):
+        """
+        Look up the cached header values of a file.  Entries whose size or mtime no longer match are dropped.
+        :param file: Absolute path to the image file
+        :param file_signature: (tuple) (file_size, mtime_ns) if already known
+        :return metadata: (dict) width, height, img_format, orientation.  None on a miss.
+        """
+        path = self.normalize_path(file)
+        file_size, mtime_ns = file_signature if file_signature else get_file_signature(path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT file_size, mtime_ns, width, height, format, orientation FROM image_cache WHERE path = ?",
+                (path,)).fetchone()
+            if row is None:
+                instrumentation_func.count(instrumentation_func.COUNTER_IMAGE_CACHE_MISSES)
+                return None
+            if (row[0], row[1]) != (file_size, mtime_ns):
+                self.connection.execute("DELETE FROM image_cache WHERE path = ?", (path,))
+                self.connection.commit()
+                instrumentation_func.count(instrumentation_func.COUNTER_IMAGE_CACHE_MISSES)
+                return None
+        instrumentation_func.count(instrumentation_func.COUNTER_IMAGE_CACHE_HITS)
+
+        return {"width": row[2], "height": row[3], "img_format": row[4], "orientation": row[5]}
+
+    def put_metadata_many(self, metadata_list):
+        """
+        Store the header values of several files in one transaction.  Existing thumbnails are kept as long as the
+        file has not changed.
+        :param metadata_list: (list) (file, (file_size, mtime_ns), width, height, format, orientation) tuples
+        :return:
+        """
+        if not metadata_list:
+            return
+
+        now = time.time()
+        rows = [(self.normalize_path(file), file_size, mtime_ns, width, height, img_format, orientation, now)
+                for file, (file_size, mtime_ns), width, height, img_format, orientation in metadata_list]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT INTO image_cache (path, file_size, mtime_ns, width, height, format, orientation, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "thumbnail = CASE WHEN file_size = excluded.file_size AND mtime_ns = excluded.mtime_ns "
+                "THEN thumbnail ELSE NULL END, "
+                "thumbnail_bytes = CASE WHEN file_size = excluded.file_size AND mtime_ns = excluded.mtime_ns "
+                "THEN thumbnail_bytes ELSE 0 END, "
+                "file_size = excluded.file_size, mtime_ns = excluded.mtime_ns, width = excluded.width, "
+                "height = excluded.height, format = excluded.format, orientation = excluded.orientation, "
+                "last_access = excluded.last_access",
+                rows)
+            self.connection.commit()
+            self.evict()
+
+    def touch_many(self, files):
+        """
+        Mark cache entries as recently used so eviction keeps them.
+        :param files: (list) Absolute image paths
+        :return:
+        """
+        if not files:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("UPDATE image_cache SET last_access = ? WHERE path = ?",
+                                        [(now, self.normalize_path(file)) for file in files])
+            self.connection.commit()
+
+    def get_thumbnail(self, file):
+        """
+        Load the cached preview thumbnail of a file.
+        :param file: Absolute path to the image file
+        :return thumbnail_img: (Image) None on a miss or if the file changed since it was cached
+        """
+        path = self.normalize_path(file)
+        try:
+            file_size, mtime_ns = get_file_signature(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT thumbnail FROM image_cache WHERE path = ? AND file_size = ? AND mtime_ns = ?",
+                (path, file_size, mtime_ns)).fetchone()
+            if row is None or row[0] is None:
+                instrumentation_func.count(instrumentation_func.COUNTER_THUMBNAIL_CACHE_MISSES)
+                return None
+            self.connection.execute("UPDATE image_cache SET last_access = ? WHERE path = ?", (time.time(), path))
+            self.connection.commit()
+        instrumentation_func.count(instrumentation_func.COUNTER_THUMBNAIL_CACHE_HITS)
+
+        thumbnail_img = Image.open(io.BytesIO(row[0]))
+        thumbnail_img.load()
+
+        return thumbnail_img
+
+    def put_thumbnail(self, file, thumbnail_img):
+        """
+        Store a preview-sized thumbnail for a file that already has its metadata cached.
+        :param file: Absolute path to the image file
+        :param thumbnail_img: (Image) L, RGB or RGBA image
+        :return:
+        """
+        path = self.normalize_path(file)
+        buffer = io.BytesIO()
+        if thumbnail_img.mode == "RGBA":
+            thumbnail_img.save(buffer, format="PNG")
+        else:
+            thumbnail_img.save(buffer, format="JPEG", quality=THUMBNAIL_JPEG_QUALITY)
+        thumbnail_bytes = buffer.getvalue()
+
+        with self.lock:
+            self.connection.execute(
+                "UPDATE image_cache SET thumbnail = ?, thumbnail_bytes = ?, last_access = ? WHERE path = ?",
+                (thumbnail_bytes, len(thumbnail_bytes), time.time(), path))
+            self.connection.commit()
+            self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used entries once the entry count or thumbnail bytes go over their limits.  Caller
+        must hold self.lock.
+        :return:
+        """
+        entry_count, total_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(thumbnail_bytes), 0) FROM image_cache").fetchone()
+        if entry_count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        target_entries = int(self.max_entries * CACHE_EVICT_TARGET)
+        target_bytes = int(self.max_bytes * CACHE_EVICT_TARGET)
+        evict_paths = []
+        cursor = self.connection.execute("SELECT path, thumbnail_bytes FROM image_cache ORDER BY last_access")
+        for path, thumbnail_bytes in cursor:
+            if entry_count <= target_entries and total_bytes <= target_bytes:
+                break
+            evict_paths.append((path,))
+            entry_count -= 1
+            total_bytes -= thumbnail_bytes
+
+        self.connection.executemany("DELETE FROM image_cache WHERE path = ?", evict_paths)
+        self.connection.commit()
+        self.logger.info(f"Evicted {len(evict_paths)} entries from the image cache.")
+
+    def invalidate(self, file=None):
+        """
+        Remove a single file, every file below a folder, or (with no argument) everything from the cache.
+        :param file: Absolute path to an image file or folder.  None clears the whole cache.
+        :return removed_count: (int)
+        """
+        with self.lock:
+            if file is None:
+                cursor = self.connection.execute("DELETE FROM image_cache")
+            else:
+                path = self.normalize_path(file)
+                prefix = path.rstrip("/") + "/"
+                cursor = self.connection.execute(
+                    "DELETE FROM image_cache WHERE path = ? OR substr(path, 1, ?) = ?", (path, len(prefix), prefix))
+            self.connection.commit()
+            if file is None:
+                self.connection.execute("VACUUM")
+
+        return cursor.rowcount
+
+    def get_stats(self):
+        """
+        :return stats: (dict) entries, thumbnails and thumbnail_bytes currently stored
+        """
+        with self.lock:
+            entry_count, thumbnail_count, total_bytes = self.connection.execute(
+                "SELECT COUNT(*), COUNT(thumbnail), COALESCE(SUM(thumbnail_bytes), 0) FROM image_cache").fetchone()
+
+        return {"entries": entry_count, "thumbnails": thumbnail_count, "thumbnail_bytes": total_bytes}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,20 +1,36 @@
+import itertools
+
+# Unique per session, used to key the image job's entries in the pixmap cache and the job table
+IMAGE_JOB_IDS = itertools.count(1)
+
+
 class ImageJob:
+    # Slots keep each job small when hundreds of thousands of them are loaded
+    __slots__ = ("img_id", "img_path", "img_name", "img_orig_height", "img_orig_width", "img_aspect_ratio",
+                 "img_aspect_ratio_inv", "img_format", "img_orientation", "img_proxy_from_cache", "img_new_height",
+                 "img_new_width", "img_rotation", "img_contrast", "img_sharpness", "img_brightness", "img_edit_ops")
+
     def __init__(self):
         # Initial image attributes
+        self.img_id = next(IMAGE_JOB_IDS)
         self.img_path = ""
         self.img_name = ""
-        self.img_orig_height = ""
-        self.img_orig_width = ""
+        self.img_orig_height = 0
+        self.img_orig_width = 0
         self.img_aspect_ratio = 0
         self.img_aspect_ratio_inv = 0
         self.img_format = ""
-        self.img_pixmap = None
+        self.img_orientation = 1
+        # True while the proxy pyramid was built from a cached thumbnail instead of the file
+        self.img_proxy_from_cache = False
 
         # Modifiable attributes
-        self.img_new_height = ""
-        self.img_new_width = ""
+        self.img_new_height = 0
+        self.img_new_width = 0
         self.img_rotation = 0
         self.img_contrast = 1
         self.img_sharpness = 1
         self.img_brightness = 1
-        self.img_enhanced_pixmap = None
+
+        # Ordered (op_name, value) edit operations, applied to the original file at export time
+        self.img_edit_ops = []
@@ -0,0 +1,44 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+
+class ImageProbeSignals(QObject):
+    """
+    Signals for ImageProbeWorker.  QRunnable is not a QObject so it cannot own signals itself.
+    """
+    # (probe generation, list of ImageJob) probed jobs, in the order their paths were passed in
+    batch_ready = Signal(int, object)
+    # (probe generation, list of (path, error message)) files that could not be read
+    failed = Signal(int, object)
+    finished = Signal()
+
+
+class ImageProbeWorker(QRunnable):
+    """
+    Probes image file headers off the GUI thread and hands the resulting image jobs back in batches, so the UI can
+    show the first images while the rest of a large folder is still being read.
+    """
+    def __init__(self, load_images_obj, file_list, generation):
+        """
+        :param load_images_obj: LoadImages() class object doing the probing
+        :param file_list: (list) Absolute image paths to probe
+        :param generation: (int) Probe generation of load_images_obj this worker was started for.  It stops once the
+        image jobs are cleared and the generation moves on.
+        """
+        super().__init__()
+
+        self.load_images_obj = load_images_obj
+        self.file_list = file_list
+        self.generation = generation
+        self.signals = ImageProbeSignals()
+
+    def run(self):
+        failed_files = []
+        for img_job_batch, failed_batch in self.load_images_obj.iter_image_job_batches(self.file_list,
+                                                                                       self.generation):
+            if img_job_batch:
+                self.signals.batch_ready.emit(self.generation, img_job_batch)
+            failed_files.extend(failed_batch)
+
+        if failed_files and not self.load_images_obj.is_probe_stale(self.generation):
+            self.signals.failed.emit(self.generation, failed_files)
+        self.signals.finished.emit()
@@ -0,0 +1,287 @@
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s: %(module)s: %(levelname)s: %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+METRIC_PREFIX = "image_editor"
+METRICS_FORMAT_JSON_LINES = "jsonl"
+METRICS_FORMAT_PROMETHEUS = "prometheus"
+
+# Stages timed with span(), listed in pipeline order for the summary
+STAGE_DECODE = "decode"
+STAGE_CONVERT = "convert"
+STAGE_GEOMETRY = "geometry"
+STAGE_ENHANCE = "enhance"
+STAGE_ROTATE = "rotate"
+STAGE_SCALE = "scale"
+STAGE_ENCODE = "encode"
+STAGE_ORDER = (STAGE_DECODE, STAGE_CONVERT, STAGE_GEOMETRY, STAGE_ENHANCE, STAGE_ROTATE, STAGE_SCALE,
+               STAGE_ENCODE)
+
+COUNTER_BYTES_READ = "bytes_read"
+COUNTER_BYTES_WRITTEN = "bytes_written"
+COUNTER_IMAGE_CACHE_HITS = "image_cache_hits"
+COUNTER_IMAGE_CACHE_MISSES = "image_cache_misses"
+COUNTER_THUMBNAIL_CACHE_HITS = "thumbnail_cache_hits"
+COUNTER_THUMBNAIL_CACHE_MISSES = "thumbnail_cache_misses"
+COUNTER_PIXMAP_CACHE_HITS = "pixmap_cache_hits"
+COUNTER_PIXMAP_CACHE_MISSES = "pixmap_cache_misses"
+COUNTER_PROXY_CACHE_HITS = "proxy_cache_hits"
+COUNTER_PROXY_CACHE_MISSES = "proxy_cache_misses"
+COUNTER_STAGE_CACHE_HITS = "stage_cache_hits"
+COUNTER_STAGE_CACHE_MISSES = "stage_cache_misses"
+
+# One stdout handler shared by every logger, created on first use
+LOG_HANDLER = None
+
+
+def get_logger(name):
+    """
+    Get a logger writing to stdout in the application's format.  Loggers share one handler and it is only attached
+    once per logger, however many objects ask for it.
+    :param name: (str) Logger name, usually __name__
+    :return logger: (Logger)
+    """
+    global LOG_HANDLER
+    if LOG_HANDLER is None:
+        LOG_HANDLER = logging.StreamHandler(sys.stdout)
+        LOG_HANDLER.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+
+    logger = logging.getLogger(name)
+    if LOG_HANDLER not in logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(LOG_HANDLER)
+
+    return logger
+
+
+class Metrics:
+    """
+    This class contains the process wide store of stage timings and counters.  Recording is off by default, while off
+    span() and count() return before touching the store.  Safe to share between threads.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # {stage: [calls, total seconds, max seconds]}
+        self.stages = {}
+        # {counter name: value}
+        self.counters = {}
+        self.started_at = time.time()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.started_at = time.time()
+
+    def record_span(self, stage, seconds):
+        with self.lock:
+            stage_stats = self.stages.get(stage)
+            if stage_stats is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                stage_stats[0] += 1
+                stage_stats[1] += seconds
+                stage_stats[2] = max(stage_stats[2], seconds)
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        :return snapshot: (dict) Copy of every stage and counter, safe to pickle to another process
+        """
+        with self.lock:
+            return {
+                "stages": {stage: {"calls": calls, "total_seconds": total_seconds, "max_seconds": max_seconds}
+                           for stage, (calls, total_seconds, max_seconds) in self.stages.items()},
+                "counters": dict(self.counters),
+                "uptime_seconds": time.time() - self.started_at,
+            }
+
+    def pop_snapshot(self):
+        """
+        Take a snapshot and reset, i.e. in a worker process handing its measurements back after each image.
+        :return snapshot: (dict)
+        """
+        snapshot = self.snapshot()
+        self.reset()
+
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Add the measurements of a snapshot taken elsewhere, i.e. in a worker process.
+        :param snapshot: (dict) From snapshot() or pop_snapshot()
+        :return:
+        """
+        with self.lock:
+            for stage, stage_snapshot in snapshot["stages"].items():
+                stage_stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                stage_stats[0] += stage_snapshot["calls"]
+                stage_stats[1] += stage_snapshot["total_seconds"]
+                stage_stats[2] = max(stage_stats[2], stage_snapshot["max_seconds"])
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+
+METRICS = Metrics()
+
+
+class Span:
+    """
+    Context manager timing one run of a stage.
+    """
+    __slots__ = ("stage", "start_time")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        METRICS.record_span(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+# Handed out while recording is off, so a disabled span costs one attribute check and no allocation
+NULL_SPAN = contextlib.nullcontext()
+
+
+def span(stage):
+    """
+    Time a block of code as a run of a stage: with instrumentation_func.span(STAGE_DECODE): ...
+    :param stage: (str) One of the STAGE_* names
+    :return: Context manager
+    """
+    if not METRICS.enabled:
+        return NULL_SPAN
+
+    return Span(stage)
+
+
+def count(name, value=1):
+    """
+    Add to a counter.
+    :param name: (str) One of the COUNTER_* names
+    :param value: (int)
+    :return:
+    """
+    if METRICS.enabled:
+        METRICS.add(name, value)
+
+
+def is_enabled():
+    return METRICS.enabled
+
+
+def enable(enabled=True):
+    METRICS.enable(enabled)
+
+
+def get_ordered_stages(snapshot):
+    """
+    :param snapshot: (dict)
+    :return stages: (list) Stage names of the snapshot, pipeline stages first in STAGE_ORDER
+    """
+    return ([stage for stage in STAGE_ORDER if stage in snapshot["stages"]] +
+            sorted(stage for stage in snapshot["stages"] if stage not in STAGE_ORDER))
+
+
+def format_summary(snapshot=None):
+    """
+    Human readable table of the stage timings and counters, i.e. for the GUI.
+    :param snapshot: (dict) Defaults to the current measurements
+    :return summary: (str)
+    """
+    snapshot = snapshot or METRICS.snapshot()
+    lines = [f"{'stage':<10} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+    for stage in get_ordered_stages(snapshot):
+        stage_snapshot = snapshot["stages"][stage]
+        mean_ms = stage_snapshot["total_seconds"] / stage_snapshot["calls"] * 1000
+        lines.append(f"{stage:<10} {stage_snapshot['calls']:>8} {stage_snapshot['total_seconds']:>10.3f} "
+                     f"{mean_ms:>10.2f} {stage_snapshot['max_seconds'] * 1000:>10.2f}")
+
+    lines.append("")
+    for name, value in sorted(snapshot["counters"].items()):
+        if name.startswith("bytes_"):
+            lines.append(f"{name:<24} {value / (1024 * 1024):>12.2f} MB")
+        else:
+            lines.append(f"{name:<24} {value:>12}")
+
+    return "\n".join(lines)
+
+
+def to_json_lines(snapshot=None):
+    """
+    One JSON object per stage and per counter, all stamped with the same time.
+    :param snapshot: (dict) Defaults to the current measurements
+    :return text: (str)
+    """
+    snapshot = snapshot or METRICS.snapshot()
+    timestamp = time.time()
+    lines = [json.dumps({"time": timestamp, "type": "span", "stage": stage, **snapshot["stages"][stage]})
+             for stage in get_ordered_stages(snapshot)]
+    lines.extend(json.dumps({"time": timestamp, "type": "counter", "name": name, "value": value})
+                 for name, value in sorted(snapshot["counters"].items()))
+
+    return "".join(line + "\n" for line in lines)
+
+
+def to_prometheus(snapshot=None):
+    """
+    The measurements in the Prometheus text exposition format.  Stages are summaries, counters are counters.
+    :param snapshot: (dict) Defaults to the current measurements
+    :return text: (str)
+    """
+    snapshot = snapshot or METRICS.snapshot()
+    stage_metric = f"{METRIC_PREFIX}_stage_seconds"
+    lines = [f"# HELP {stage_metric} Time spent per pipeline stage.", f"# TYPE {stage_metric} summary"]
+    for stage in get_ordered_stages(snapshot):
+        stage_snapshot = snapshot["stages"][stage]
+        lines.append(f'{stage_metric}_sum{{stage="{stage}"}} {stage_snapshot["total_seconds"]:.6f}')
+        lines.append(f'{stage_metric}_count{{stage="{stage}"}} {stage_snapshot["calls"]}')
+    lines.append(f"# HELP {stage_metric}_max Longest single run per pipeline stage.")
+    lines.append(f"# TYPE {stage_metric}_max gauge")
+    for stage in get_ordered_stages(snapshot):
+        lines.append(f'{stage_metric}_max{{stage="{stage}"}} {snapshot["stages"][stage]["max_seconds"]:.6f}')
+
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = f"{METRIC_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    return "".join(line + "\n" for line in lines)
+
+
+def write_metrics(path, snapshot=None, metrics_format=None):
+    """
+    Write the measurements to a file.  Prometheus text replaces the file, JSON lines are appended to it.
+    :param path: Output file path
+    :param snapshot: (dict) Defaults to the current measurements
+    :param metrics_format: (str) METRICS_FORMAT_PROMETHEUS or METRICS_FORMAT_JSON_LINES.  By default .prom and .txt
+    paths get Prometheus text, every other path JSON lines.
+    :return:
+    """
+    if metrics_format is None:
+        is_prometheus = path.lower().endswith((".prom", ".txt"))
+        metrics_format = METRICS_FORMAT_PROMETHEUS if is_prometheus else METRICS_FORMAT_JSON_LINES
+
+    if metrics_format == METRICS_FORMAT_PROMETHEUS:
+        with open(path, "w") as metrics_file:
+            metrics_file.write(to_prometheus(snapshot))
+    else:
+        with open(path, "a") as metrics_file:
+            metrics_file.write(to_json_lines(snapshot))
@@ -0,0 +1,106 @@
+import numpy as np
+import util_func
+
+JOB_TABLE_DTYPE = np.dtype([
+    ("img_id", np.int64),
+    ("orig_width", np.int32),
+    ("orig_height", np.int32),
+])
+JOB_TABLE_MIN_CAPACITY = 1024
+
+
+class JobTable:
+    """
+    Array-backed store of every loaded image job.  The numeric header values live in a NumPy structured array, while
+    the ImageJob records keep the per-job edit values.  Behaves like a list of ImageJob for index access, iteration
+    and len(), with O(1) lookup by path and by id.  Paths are looked up by util_func.get_path_key(), as LoadImages
+    dedupes them.
+    """
+    def __init__(self):
+        self.jobs = []
+        self.columns = np.zeros(JOB_TABLE_MIN_CAPACITY, dtype=JOB_TABLE_DTYPE)
+        self.path_index = {}
+        self.id_index = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(self.jobs)
+
+    def __getitem__(self, row):
+        return self.jobs[row]
+
+    def get_column(self, name):
+        """
+        View of one column for the rows in use, in job order.
+        :param name: (str) Field name of JOB_TABLE_DTYPE
+        :return column: (ndarray)
+        """
+        return self.columns[name][:len(self.jobs)]
+
+    def append(self, img_job):
+        self.extend([img_job])
+
+    def extend(self, img_job_batch):
+        """
+        Add a batch of image jobs to the end of the table.
+        :param img_job_batch: (list) ImageJob objects
+        :return:
+        """
+        start_row = len(self.jobs)
+        end_row = start_row + len(img_job_batch)
+        if end_row > len(self.columns):
+            # Grow geometrically so appending n jobs one batch at a time stays O(n) overall
+            new_columns = np.zeros(max(end_row, len(self.columns) * 2), dtype=JOB_TABLE_DTYPE)
+            new_columns[:start_row] = self.columns[:start_row]
+            self.columns = new_columns
+
+        self.columns[start_row:end_row] = [(job.img_id, job.img_orig_width, job.img_orig_height)
+                                           for job in img_job_batch]
+        for row, job in enumerate(img_job_batch, start_row):
+            self.jobs.append(job)
+            self.path_index[util_func.get_path_key(job.img_path)] = job.img_id
+            self.id_index[job.img_id] = row
+
+    def remove_rows(self, rows):
+        """
+        Remove the jobs at the given rows.  Rows after them move up, as in the list widget.
+        :param rows: (iterable) Row indexes
+        :return removed_jobs: (list) ImageJob objects that were removed
+        """
+        row_count = len(self.jobs)
+        keep_mask = np.ones(row_count, dtype=bool)
+        keep_mask[list(rows)] = False
+        removed_jobs = [job for job, keep in zip(self.jobs, keep_mask) if not keep]
+
+        kept_count = int(keep_mask.sum())
+        self.columns[:kept_count] = self.columns[:row_count][keep_mask]
+        self.jobs = [job for job, keep in zip(self.jobs, keep_mask) if keep]
+
+        for job in removed_jobs:
+            self.path_index.pop(util_func.get_path_key(job.img_path), None)
+        self.id_index = {job.img_id: row for row, job in enumerate(self.jobs)}
+
+        return removed_jobs
+
+    def clear(self):
+        self.jobs = []
+        self.columns = np.zeros(JOB_TABLE_MIN_CAPACITY, dtype=JOB_TABLE_DTYPE)
+        self.path_index = {}
+        self.id_index = {}
+
+    def get_row(self, img_id):
+        """
+        :param img_id: (int) ImageJob.img_id
+        :return row: (int) None if the job is not in the table
+        """
+        return self.id_index.get(img_id)
+
+    def get_by_id(self, img_id):
+        row = self.id_index.get(img_id)
+        return None if row is None else self.jobs[row]
+
+    def get_by_path(self, img_path):
+        img_id = self.path_index.get(util_func.get_path_key(img_path))
+        return None if img_id is None else self.get_by_id(img_id)
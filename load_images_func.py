@@ -1,12 +1,22 @@
 from PySide6.QtWidgets import QFileDialog
+from PySide6.QtCore import QThreadPool
+from concurrent.futures import ThreadPoolExecutor
 import os
-from PIL import Image
-import image_job
+import threading
+import batch_process_func
+import folder_scan_func
+import geometry_func
+import image_cache_func
+import instrumentation_func
+import job_table
 import util_func
-import logging
-import sys
+from image_probe_worker import ImageProbeWorker
+import sqlite3
 
 NAME_FILTERS = "Images (*.png *.jpg *.jpeg *.bmp *.gif)"
+# Header probing is I/O bound, so use more threads than cores to hide network share latency
+PROBE_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+PROBE_BATCH_SIZE = 64
 
 
 class LoadImages:
@@ -16,24 +26,27 @@ class LoadImages:
     """
     def __init__(self):
         self.selected_files_abs_paths = []
-        self.dir_selected_files_abs_paths = []
         self.refined_file_list = []
-        self.all_image_jobs = []
+        self.all_image_jobs = job_table.JobTable()
+        # Normalized paths of every loaded image, plus those still being probed, for O(1) duplicate checks.  Probe
+        # threads reserve paths in it while the GUI thread adds and removes jobs, always under path_index_lock.
+        self.loaded_path_index = set()
+        self.path_index_lock = threading.Lock()
+        # Bumped whenever the list is cleared.  Probes started for an earlier generation stop, and neither reserve
+        # paths nor hand over jobs any longer.
+        self.probe_generation = 0
 
-        self.logger = logging.getLogger(__name__)
-        self.setup_logger()
+        self.logger = instrumentation_func.get_logger(__name__)
+
+        try:
+            self.image_cache = image_cache_func.ImageCache()
+        except (OSError, sqlite3.Error) as err:
+            self.logger.warning(f"Image cache unavailable, every file will be probed: {err}")
+            self.image_cache = None
 
         self.file_dialog = QFileDialog()
         self.file_dialog.setOption(QFileDialog.Option.DontUseNativeDialog, True)
 
-    def setup_logger(self):
-        log_format = logging.Formatter("%(asctime)s: %(module)s: %(levelname)s: %(message)s",
-                                       datefmt="%Y-%m-%d %H:%M:%S")
-        self.logger.setLevel(logging.DEBUG)
-        stream_handler = logging.StreamHandler(sys.stdout)
-        stream_handler.setFormatter(log_format)
-        self.logger.addHandler(stream_handler)
-
     def browse_for_files(self):
         """
         Open the Qt file dialog to allow the user to select 1 or more files.  Ensure the files are of image
@@ -49,69 +62,232 @@ class LoadImages:
 
     def browse_for_folder(self):
         """
-        Open the Qt file dialog to allow the user to select a folder and load all the files found within.
-        Ensure the files are of image format.
-        :return:
+        Open the Qt file dialog to allow the user to select a folder.  Its files are scanned while they load, see
+        start_folder_probe.
+        :return selected_dir: Absolute path of the folder, empty if the dialog was cancelled
         """
         self.file_dialog.setFileMode(QFileDialog.Option.Directory)
 
-        # Returns the absolute file path with a filter for image file types only
-        selected_dir = self.file_dialog.getExistingDirectory()
-
-        if selected_dir:
-            get_existing_files = os.listdir(selected_dir)
-            for file in get_existing_files:
-                file_abs_path = os.path.join(selected_dir, file)
-                if os.path.isfile(file_abs_path):
-                    if util_func.is_file_image(file_abs_path):
-                        norm_path = file_abs_path.replace("\\", "/")
-                        self.dir_selected_files_abs_paths.append(norm_path)
-                    else:
-                        self.logger.warning(f"This file [{file}] is not an image.  Skipping.")
+        return self.file_dialog.getExistingDirectory()
 
-    def check_list_for_duplicates(self, list_widget, file_list):
+    def check_list_for_duplicates(self, file_list):
         """
-        Checks for duplicates that already exist in the list widget.  If no duplicates exist,
-        add to the refined list and return it.
-        :param list_widget: image_url_list in GuiMain()
+        Checks for duplicates of images already loaded, or repeated within file_list itself.  Paths that are not
+        duplicates are added to the refined list and reserved in the loaded path index.
         :param file_list: list of absolute path of file images
         """
-        list_widget_item_num = list_widget.count()
-        list_item_text = []
-
-        if list_widget_item_num > 0:
-            for n in range(list_widget_item_num):
-                item = list_widget.item(n)
-                list_item_text.append(item.text())
+        self.refined_file_list.extend(self.filter_duplicate_paths(file_list))
 
-            for path in file_list:
-                if path in list_item_text:
+    def filter_duplicate_paths(self, paths, generation=None):
+        """
+        Lazily drop the paths that are already loaded or were already seen, reserving the others in the loaded path
+        index.  Works on any iterable, i.e. a folder scan still in progress, and stops once the list it was started
+        for has been cleared.
+        :param paths: (iterable) Absolute image paths
+        :param generation: (int) Probe generation the paths are reserved for, None to never stop
+        :return: Generator of the paths that are not duplicates
+        """
+        for path in paths:
+            path_key = util_func.get_path_key(path)
+            with self.path_index_lock:
+                if self.is_probe_stale(generation):
+                    return
+                if path_key in self.loaded_path_index:
                     continue
-                else:
-                    self.refined_file_list.append(path)
-        else:
-            self.refined_file_list = file_list
+                self.loaded_path_index.add(path_key)
+            yield path
+
+    def is_probe_stale(self, generation):
+        return generation is not None and generation != self.probe_generation
+
+    def add_image_jobs(self, img_job_batch, generation=None):
+        """
+        Store probed image jobs and record their paths in the loaded path index.  Batches of a probe started before the
+        list was last cleared are dropped.
+        :param img_job_batch: (list) ImageJob objects
+        :param generation: (int) Probe generation the batch comes from, None to always store it
+        :return is_added: (bool)
+        """
+        with self.path_index_lock:
+            if self.is_probe_stale(generation):
+                return False
+            self.all_image_jobs.extend(img_job_batch)
+            self.loaded_path_index.update(util_func.get_path_key(img_job.img_path) for img_job in img_job_batch)
+
+        return True
+
+    def release_paths(self, paths, generation=None):
+        """
+        Drop paths from the loaded path index so they can be loaded again.  Paths of a stale probe are left alone, the
+        index was cleared since and may hold the same path for a newer load.
+        :param paths: (iterable) Absolute image paths
+        :param generation: (int) Probe generation the paths were reserved for, None for the current one
+        :return:
+        """
+        with self.path_index_lock:
+            if not self.is_probe_stale(generation):
+                self.loaded_path_index.difference_update(util_func.get_path_key(path) for path in paths)
+
+    def remove_image_jobs(self, rows):
+        """
+        Remove the image jobs at the given rows and release their paths so they can be loaded again.
+        :param rows: (iterable) Row indexes, as in the list widget
+        :return removed_jobs: (list) ImageJob objects that were removed
+        """
+        removed_jobs = self.all_image_jobs.remove_rows(rows)
+        self.release_paths(img_job.img_path for img_job in removed_jobs)
+
+        return removed_jobs
+
+    def clear_image_jobs(self):
+        """
+        Remove every image job.  Probes still running are cancelled, they stop at their next file and whatever they
+        still hand over is dropped.
+        :return:
+        """
+        with self.path_index_lock:
+            self.probe_generation += 1
+            self.all_image_jobs.clear()
+            self.loaded_path_index.clear()
 
     def reset_load_attributes(self):
         self.selected_files_abs_paths = []
-        self.dir_selected_files_abs_paths = []
         self.refined_file_list = []
 
+    def probe_image_file(self, file):
+        """
+        Read the header values of a single image file, from the image cache if the file has not changed since it was
+        last seen.  Never raises so a corrupt file cannot stop a load.
+        :param file: Absolute path to the image file
+        :return (img_job, error_message, new_metadata): img_job is None if the file could not be read.  new_metadata
+        holds the values to add to the image cache, None on a cache hit.
+        """
+        try:
+            file_signature = image_cache_func.get_file_signature(file)
+            if self.image_cache is not None:
+                metadata = self.image_cache.get_metadata(file, file_signature)
+                if metadata is not None:
+                    return batch_process_func.create_image_job_from_header(file, **metadata), "", None
+
+            img_job_obj = batch_process_func.create_image_job(file)
+            # The cache holds the size as stored in the file, the job's is turned upright
+            header_size = geometry_func.calc_oriented_size((img_job_obj.img_orig_width, img_job_obj.img_orig_height),
+                                                           img_job_obj.img_orientation)
+            new_metadata = (file, file_signature, *header_size, img_job_obj.img_format, img_job_obj.img_orientation)
+            return img_job_obj, "", new_metadata
+        except Exception as err:
+            return None, f"{type(err).__name__}: {err}", None
+
+    def iter_image_job_batches(self, file_list, generation=None):
+        """
+        Probe the headers of every file on a thread pool and yield the results in batches, in the same order as the
+        file list.  The file list is consumed a chunk at a time, so a folder scan feeding it can still be running.
+        The image cache is updated once per batch.
+        :param file_list: (iterable) Absolute image paths
+        :param generation: (int) Probe generation, probing stops once the list has been cleared.  None to never stop.
+        :return: Generator of (img_job_batch, failed_batch).  failed_batch holds (path, error message) tuples.
+        """
+        with ThreadPoolExecutor(max_workers=PROBE_MAX_WORKERS) as executor:
+            img_job_batch = []
+            failed_batch = []
+            new_metadata_list = []
+            cached_files = []
+            for file_chunk in folder_scan_func.iter_chunks(file_list):
+                probe_results = executor.map(self.probe_image_file, file_chunk)
+                for file, (img_job_obj, error_message, new_metadata) in zip(file_chunk, probe_results):
+                    if self.is_probe_stale(generation):
+                        return
+                    if img_job_obj is None:
+                        self.logger.warning(f"Could not read [{file}]: {error_message}.  Skipping.")
+                        failed_batch.append((file, error_message))
+                        self.release_paths([file], generation)
+                    else:
+                        img_job_batch.append(img_job_obj)
+                        if new_metadata is None:
+                            cached_files.append(file)
+                        else:
+                            new_metadata_list.append(new_metadata)
+
+                    if len(img_job_batch) + len(failed_batch) >= PROBE_BATCH_SIZE:
+                        self.update_image_cache(new_metadata_list, cached_files)
+                        yield img_job_batch, failed_batch
+                        img_job_batch = []
+                        failed_batch = []
+                        new_metadata_list = []
+                        cached_files = []
+
+                # Hand over what is ready before waiting on the scan for the next chunk
+                if img_job_batch or failed_batch:
+                    self.update_image_cache(new_metadata_list, cached_files)
+                    yield img_job_batch, failed_batch
+                    img_job_batch = []
+                    failed_batch = []
+                    new_metadata_list = []
+                    cached_files = []
+
+    def update_image_cache(self, new_metadata_list, cached_files):
+        if self.image_cache is None:
+            return
+
+        try:
+            self.image_cache.put_metadata_many(new_metadata_list)
+            self.image_cache.touch_many(cached_files)
+        except sqlite3.Error as err:
+            self.logger.warning(f"Could not update the image cache: {err}")
+
+    def start_folder_probe(self, selected_dir, on_batch_ready, on_failed, include_globs=None, exclude_globs=None,
+                           max_depth=None):
+        """
+        Scan a folder tree and probe its image files in the background, both streaming, so the first images are
+        handed to on_batch_ready while the rest of the tree is still being scanned.
+        :param selected_dir: Folder to load
+        :param on_batch_ready: Slot receiving (probe generation, list of ImageJob)
+        :param on_failed: Slot receiving (probe generation, list of (path, error message))
+        :param include_globs: (list) Only load files matching one of these patterns
+        :param exclude_globs: (list) Skip files and folders matching one of these patterns
+        :param max_depth: (int) Levels of subfolders to scan, 0 for the top level only, None for no limit
+        :return worker: (ImageProbeWorker)
+        """
+        image_files = folder_scan_func.iter_image_files(selected_dir, include_globs, exclude_globs, max_depth,
+                                                        self.log_skipped_file)
+        generation = self.probe_generation
+
+        return self.start_image_probe(self.filter_duplicate_paths(image_files, generation), on_batch_ready, on_failed,
+                                      generation)
+
+    def log_skipped_file(self, file):
+        self.logger.warning(f"This file [{os.path.basename(file)}] is not an image.  Skipping.")
+
+    def start_image_probe(self, refined_file_list, on_batch_ready, on_failed, generation=None):
+        """
+        Probe the files in the background.  Image jobs are handed to on_batch_ready on the GUI thread as they become
+        ready, unreadable files are reported once at the end through on_failed.  Clearing the image jobs cancels the
+        probe.
+        :param refined_file_list: (iterable) Absolute image paths, already checked for duplicates
+        :param on_batch_ready: Slot receiving (probe generation, list of ImageJob), see add_image_jobs()
+        :param on_failed: Slot receiving (probe generation, list of (path, error message))
+        :param generation: (int) Probe generation the paths were reserved for, defaults to the current one
+        :return worker: (ImageProbeWorker)
+        """
+        if generation is None:
+            generation = self.probe_generation
+        worker = ImageProbeWorker(self, refined_file_list, generation)
+        worker.signals.batch_ready.connect(on_batch_ready)
+        worker.signals.failed.connect(on_failed)
+        QThreadPool.globalInstance().start(worker)
+
+        return worker
+
     def create_image_jobs(self, refined_file_list):
         """
-        For each file selected to load in, create an img_job object and setup default attribute values.
+        For each file selected to load in, create an img_job object and setup default attribute values.  Blocks
+        until every file has been probed, unreadable files are skipped.
         :param refined_file_list:
-        :return:
+        :return failed_files: (list) (path, error message) of the files that could not be read
         """
-        for file in refined_file_list:
-            img_job_obj = image_job.ImageJob()
-            with Image.open(file) as ip:
-                img_job_obj.img_orig_height = img_job_obj.img_new_height = str(ip.height)
-                img_job_obj.img_orig_width = img_job_obj.img_new_width = str(ip.width)
-                img_job_obj.img_aspect_ratio = ip.height / ip.width
-                img_job_obj.img_aspect_ratio_inv = ip.width / ip.height
-                img_job_obj.img_format = ip.format
-                img_job_obj.img_path = file
-                img_job_obj.img_name = file.rpartition("/")[2].split(".")[0]
-
-            self.all_image_jobs.append(img_job_obj)
+        failed_files = []
+        for img_job_batch, failed_batch in self.iter_image_job_batches(refined_file_list):
+            self.add_image_jobs(img_job_batch)
+            failed_files.extend(failed_batch)
+
+        return failed_files
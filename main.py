@@ -1,10 +1,110 @@
+import argparse
+import os
 import sys
-from PySide6.QtWidgets import QApplication
-from gui_main import GuiMain
+
+
+def parse_args(argv):
+    """
+    Parse the command line.  Without --batch the GUI is launched and any unknown arguments are handed on to Qt.
+    :param argv: sys.argv[1:]
+    :return args, qt_args:
+    """
+    parser = argparse.ArgumentParser(description="Downsize and edit images through the GUI or headless in batch.")
+    parser.add_argument("--batch", metavar="INPUT_DIR", default="",
+                        help="Process every image in INPUT_DIR without opening the GUI.")
+    parser.add_argument("--output", metavar="EXPORT_DIR", default="",
+                        help="Export directory for --batch.  Defaults to INPUT_DIR/export.")
+    parser.add_argument("--recursive", action="store_true", help="Also process images in the subfolders of INPUT_DIR.")
+    parser.add_argument("--max-depth", type=int, default=-1,
+                        help="Levels of subfolders searched with --recursive.  -1 for no limit.")
+    parser.add_argument("--include", default="", help="Only process files matching these globs, i.e. '*.jpg;2024/*'.")
+    parser.add_argument("--exclude", default="",
+                        help="Skip files and folders matching these globs, i.e. 'export;.*'.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes for --batch.")
+    parser.add_argument("--encode-jobs", type=int, default=0,
+                        help="Number of encode/write threads for --batch.  0 uses half of --jobs.")
+    parser.add_argument("--memory-budget-mb", type=int, default=1024,
+                        help="Memory ceiling in MB for the images in flight during --batch.")
+    parser.add_argument("--tile-memory-mb", type=int, default=512,
+                        help="Process images needing more working memory than this many MB in tiles.  0 never tiles.")
+    parser.add_argument("--format", default="jpeg", choices=["png", "jpeg", "bmp", "gif", "webp"],
+                        help="Export file format.")
+    parser.add_argument("--max-long-edge", type=int, default=0,
+                        help="Downsize so the longest side is at most this many pixels.  0 keeps the original size.")
+    parser.add_argument("--resize-quality", default="balanced", choices=["fast", "balanced", "best"],
+                        help="Downscale quality/speed trade-off.  fast and balanced decode JPEGs at reduced scale.")
+    parser.add_argument("--encoder-profile", default="default", choices=["default", "web", "smallest", "archive"],
+                        help="Named set of encoder options (quality, progressive, compression level).")
+    parser.add_argument("--max-kb", type=int, default=0,
+                        help="Export each image at the highest quality that fits in this many KB.  0 for no limit.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip images whose output in EXPORT_DIR is up to date with their source and edits.")
+    parser.add_argument("--fingerprint", default="stat", choices=["stat", "content"],
+                        help="How --incremental detects changed sources: size and mtime, or a hash of the contents.")
+    parser.add_argument("--prefix", default="", help="Prefix added to exported file names.")
+    parser.add_argument("--suffix", default="", help="Suffix added to exported file names.")
+    parser.add_argument("--filename", default="", help="Use this file name instead of the original one.")
+    parser.add_argument("--append-number", action="store_true", help="Append an incremental number to file names.")
+    parser.add_argument("--rotation", type=int, default=0, help="Rotation in degrees.")
+    parser.add_argument("--contrast", type=float, default=1, help="Contrast factor, 1.0 is the original.")
+    parser.add_argument("--sharpness", type=float, default=1, help="Sharpness factor, 1.0 is the original.")
+    parser.add_argument("--brightness", type=float, default=1, help="Brightness factor, 1.0 is the original.")
+    parser.add_argument("--clear-cache", nargs="?", const="", default=None, metavar="PATH",
+                        help="Remove PATH (a file or folder), or everything, from the image cache and exit.")
+    parser.add_argument("--pixmap-cache-mb", type=int, default=512,
+                        help="Memory budget in MB for the preview pixmaps kept by the GUI.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running after --batch and export new images as they arrive in INPUT_DIR.  --output "
+                             "must be another folder.")
+    parser.add_argument("--watch-seconds", type=float, default=0,
+                        help="Stop --watch after this many seconds, 0 runs until interrupted.")
+    parser.add_argument("--poll", action="store_true", help="Poll INPUT_DIR for --watch instead of using inotify.")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between checks for --watch.")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="Seconds a new file must stay unchanged before --watch exports it.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Record per stage timings and counters.  Shown in the GUI's Metrics tab.")
+    parser.add_argument("--metrics-out", default="",
+                        help="With --batch, write the metrics here at the end, Prometheus text for .prom/.txt paths, "
+                             "JSON lines otherwise.  Implies --metrics.")
+    parser.add_argument("--report", default="",
+                        help="Path of the JSON summary report, '-' for stdout.  Defaults to "
+                             "EXPORT_DIR/batch_report.json.")
+
+    args, qt_args = parser.parse_known_args(argv)
+    if args.batch and not args.output:
+        args.output = os.path.join(args.batch, "export")
+
+    return args, qt_args
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    gui_instance = GuiMain()
+    args, qt_args = parse_args(sys.argv[1:])
+
+    if args.clear_cache is not None:
+        import image_cache_func
+        image_cache = image_cache_func.ImageCache()
+        removed_count = image_cache.invalidate(args.clear_cache if args.clear_cache else None)
+        print(f"Removed {removed_count} entries from the image cache.")
+        sys.exit(0)
+
+    if args.metrics or args.metrics_out:
+        import instrumentation_func
+        instrumentation_func.enable()
+
+    if args.batch and args.watch:
+        import watch_folder_func
+        sys.exit(watch_folder_func.run_watch_cli(args))
+
+    if args.batch:
+        import batch_process_func
+        sys.exit(batch_process_func.run_batch_cli(args))
+
+    from PySide6.QtWidgets import QApplication
+    from gui_main import GuiMain
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    gui_instance = GuiMain(args.pixmap_cache_mb * 1024 * 1024)
     gui_instance.show()
     sys.exit(app.exec())
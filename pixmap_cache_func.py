@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+import instrumentation_func
+
+PIXMAP_CACHE_BUDGET_BYTES = 512 * 1024 * 1024
+# Decoded preview proxies, kept apart from the pixmaps so the threads filling it never touch a pixmap
+PROXY_CACHE_BUDGET_BYTES = 256 * 1024 * 1024
+# Intermediate stage outputs of the preview renders, only ever written to from the render thread
+STAGE_CACHE_BUDGET_BYTES = 128 * 1024 * 1024
+
+
+def calc_entry_bytes(value):
+    """
+    Estimate the resident size of a cached value.
+    :param value: QPixmap, QImage, pillow Image, SharedImage, ndarray or a list/tuple of them
+    :return nbytes: (int)
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return sum(calc_entry_bytes(item) for item in value)
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if hasattr(value, "getbands"):
+        return value.width * value.height * len(value.getbands())
+    if hasattr(value, "depth"):
+        return value.width() * value.height() * value.depth() // 8
+
+    return 0
+
+
+class PixmapCache:
+    """
+    This class contains the logic for a memory-budgeted LRU cache of the previews of every image job, i.e. their
+    pixmaps or their proxy images.  Once the resident bytes go over the budget the least recently used entries are
+    dropped, they are rebuilt on demand from the file and the job's edit values.  Entries are released on the thread
+    that puts or discards them, so a cache holding pixmaps must only be written to from the GUI thread.
+    """
+    def __init__(self, budget_bytes=PIXMAP_CACHE_BUDGET_BYTES,
+                 hit_counter=instrumentation_func.COUNTER_PIXMAP_CACHE_HITS,
+                 miss_counter=instrumentation_func.COUNTER_PIXMAP_CACHE_MISSES):
+        """
+        :param budget_bytes: (int) Resident bytes kept at most
+        :param hit_counter: (str) instrumentation_func counter of the lookups that hit
+        :param miss_counter: (str) instrumentation_func counter of the lookups that miss
+        """
+        self.budget_bytes = budget_bytes
+        self.hit_counter = hit_counter
+        self.miss_counter = miss_counter
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as the most recently used.
+        :param key: (tuple) i.e. (img_id, kind)
+        :return value: None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                instrumentation_func.count(self.miss_counter)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        instrumentation_func.count(self.hit_counter)
+
+        return entry[0]
+
+    def contains(self, key):
+        """
+        Check for an entry without counting a hit or miss or changing its place in the LRU order.
+        :param key: (tuple) i.e. (img_id, kind)
+        :return: (bool)
+        """
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value, nbytes=None):
+        """
+        Store an entry then evict least recently used entries until the cache fits its budget again.  Entries bigger
+        than the whole budget are not stored.
+        :param key: (tuple) i.e. (img_id, kind)
+        :param value: Value to cache
+        :param nbytes: (int) Resident size, estimated from the value if not given
+        :return value: The passed in value
+        """
+        if nbytes is None:
+            nbytes = calc_entry_bytes(value)
+
+        with self.lock:
+            self.discard_entry(key)
+            if nbytes > self.budget_bytes:
+                return value
+
+            self.entries[key] = (value, nbytes)
+            self.resident_bytes += nbytes
+            while self.resident_bytes > self.budget_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+                self.evictions += 1
+
+        return value
+
+    def discard_entry(self, key):
+        """
+        Remove an entry if it exists.  Caller must hold self.lock.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+
+    def discard(self, img_id):
+        """
+        Remove every entry belonging to an image job.
+        :param img_id: (int) ImageJob.img_id
+        :return:
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == img_id]:
+                self.discard_entry(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.resident_bytes = 0
+
+    def get_stats(self):
+        """
+        :return stats: (dict) hits, misses, evictions, entries, resident_bytes and budget_bytes
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "resident_bytes": self.resident_bytes,
+                "budget_bytes": self.budget_bytes,
+            }
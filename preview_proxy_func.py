@@ -0,0 +1,132 @@
+import math
+import os
+from PIL import Image
+import geometry_func
+import instrumentation_func
+
+# The largest proxy level is decoded so its long edge covers the preview label this many times over, which leaves
+# room for rotated previews without going back to the original file.
+PROXY_BASE_SCALE = 2
+PROXY_MIN_EDGE = 64
+# Image jobs either side of the active one whose proxies are decoded ahead of being selected
+PREFETCH_RADIUS = 2
+# Most image jobs prefetched for one selection or scroll position, neighbours and visible list rows together
+PREFETCH_MAX_JOBS = 8
+
+
+def decode_proxy_base(img_path, min_long_edge, orientation=1):
+    """
+    Decode the image at the smallest size whose long edge is still at least min_long_edge.  JPEGs are decoded at
+    1/2, 1/4 or 1/8 scale in the DCT domain through draft(), other formats are decoded fully then reduced.
+    :param img_path: Absolute path to the image file
+    :param min_long_edge: (int) Smallest acceptable long edge in pixels
+    :param orientation: (int) EXIF orientation of the file, the proxy is turned upright once reduced
+    :return base_img: (Image) RGB, RGBA or L image
+    """
+    with Image.open(img_path) as ip:
+        long_edge = max(ip.size)
+        if ip.format == "JPEG" and long_edge > min_long_edge:
+            scale = min_long_edge / long_edge
+            ip.draft("RGB", (math.ceil(ip.width * scale), math.ceil(ip.height * scale)))
+        with instrumentation_func.span(instrumentation_func.STAGE_DECODE):
+            ip.load()
+        if instrumentation_func.is_enabled():
+            instrumentation_func.count(instrumentation_func.COUNTER_BYTES_READ, os.path.getsize(img_path))
+
+        if ip.mode in ("RGB", "RGBA", "L"):
+            base_img = ip.copy()
+        else:
+            base_img = ip.convert("RGBA" if "transparency" in ip.info or "A" in ip.mode else "RGB")
+
+    factor = max(base_img.size) // min_long_edge
+    if factor >= 2:
+        base_img = base_img.reduce(factor)
+
+    return geometry_func.apply_orientation(base_img, orientation)
+
+
+def build_proxy_pyramid(img_path, label_size, orientation=1):
+    """
+    Build the preview proxy pyramid for an image.  Level 0 is the largest proxy, every following level is half the
+    size of the previous one, down to PROXY_MIN_EDGE.
+    :param img_path: Absolute path to the image file
+    :param label_size: (tuple) (width, height) of the preview label
+    :param orientation: (int) EXIF orientation of the file
+    :return proxy_pyramid: (list) Pillow images, largest first, upright
+    """
+    base_img = decode_proxy_base(img_path, max(label_size) * PROXY_BASE_SCALE, orientation)
+
+    return build_proxy_pyramid_from_img(base_img)
+
+
+def build_proxy_pyramid_from_img(base_img):
+    """
+    Build a proxy pyramid from an already decoded image, i.e. a cached thumbnail.
+    :param base_img: (Image) Level 0 of the pyramid
+    :return proxy_pyramid: (list) Pillow images, largest first
+    """
+    proxy_pyramid = [base_img]
+
+    while min(proxy_pyramid[-1].size) >= 2 and max(proxy_pyramid[-1].size) // 2 >= PROXY_MIN_EDGE:
+        proxy_pyramid.append(proxy_pyramid[-1].reduce(2))
+
+    return proxy_pyramid
+
+
+def select_proxy_level(proxy_pyramid, label_size, rotation=0):
+    """
+    Pick the smallest proxy level that still fills the preview label once rotated, so edits run on as few pixels as
+    possible without the preview being upscaled.
+    :param proxy_pyramid: (list) Pillow images, largest first
+    :param label_size: (tuple) (width, height) of the preview label
+    :param rotation: (int) Degrees the preview will be rotated by
+    :return level: (int) Index into proxy_pyramid
+    """
+    for level in range(len(proxy_pyramid) - 1, -1, -1):
+        if is_proxy_filling(proxy_pyramid[level], label_size, rotation):
+            return level
+
+    return 0
+
+
+def is_proxy_filling(proxy_img, label_size, rotation=0):
+    """
+    Check whether the label would show the proxy, once rotated, at or below the proxy's own resolution.
+    :param proxy_img: (Image)
+    :param label_size: (tuple) (width, height) of the preview label
+    :param rotation: (int) Degrees
+    :return: (bool)
+    """
+    label_width, label_height = label_size
+    rotated_width, rotated_height = geometry_func.calc_rotated_size(proxy_img.size, rotation)
+
+    # Either side reaching the label means it is the side the image is fitted by
+    return rotated_width >= label_width or rotated_height >= label_height
+
+
+def calc_prefetch_order(active_index, job_count, direction=1, visible_rows=(), radius=PREFETCH_RADIUS,
+                        max_jobs=PREFETCH_MAX_JOBS):
+    """
+    Predict the image jobs most likely to be selected next, most likely first.  The neighbours of the active job come
+    first, nearest first and starting on the side the user last stepped towards, followed by the rows scrolled into
+    view in the image list.
+    :param active_index: (int) Index of the active image job, -1 when none is active
+    :param job_count: (int) Number of image jobs
+    :param direction: (int) 1 when the user last stepped forward through the images, -1 when back
+    :param visible_rows: (iterable) Indices of the image jobs showing in the image list
+    :param radius: (int) Neighbours to take on each side of the active job
+    :param max_jobs: (int) Most indices to return
+    :return indices: (list) Image job indices, never the active one
+    """
+    indices = []
+    if active_index >= 0:
+        for distance in range(1, radius + 1):
+            indices.extend((active_index + direction * distance, active_index - direction * distance))
+    indices.extend(visible_rows)
+
+    prefetch_indices = []
+    for index in indices:
+        if 0 <= index < job_count and index != active_index and index not in prefetch_indices:
+            prefetch_indices.append(index)
+
+    return prefetch_indices[:max_jobs]
@@ -0,0 +1,61 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+import instrumentation_func
+from shared_image import SharedImage
+
+
+class PreviewRenderSignals(QObject):
+    """
+    Signals for PreviewRenderWorker.  QRunnable is not a QObject so it cannot own signals itself.
+    """
+    # (generation, img_job, pixmap cache key, SharedImage fitted to the label)
+    finished = Signal(int, object, object, object)
+    # (generation, error message)
+    failed = Signal(int, str)
+
+
+class PreviewRenderWorker(QRunnable):
+    """
+    Renders the preview of an image job off the GUI thread, from loading its proxy to the last edit operation.  No
+    pixmap is touched here, the result is a SharedImage and the pixmap is created from it back on the GUI thread once
+    it arrives.
+    """
+    def __init__(self, generation, img_job, edit_ops, cache_key, label_size, is_stale, render_func):
+        """
+        :param generation: (int) Render request counter this worker was created for
+        :param img_job: (ImageJob) Job being previewed, passed back with the result
+        :param edit_ops: (list) (op_name, value) edit operations to apply, empty for the unedited preview
+        :param cache_key: (tuple) Pixmap cache key of the result, passed back with it
+        :param label_size: (tuple) (width, height) to fit the result to
+        :param is_stale: (callable) Takes the generation, returns True once a newer request has been made
+        :param render_func: (callable) Takes (img_job, edit_ops, label_size, should_stop), returns the rendered pillow
+        image or None once should_stop() returned True
+        """
+        super().__init__()
+
+        self.generation = generation
+        self.img_job = img_job
+        self.edit_ops = edit_ops
+        self.cache_key = cache_key
+        self.label_size = label_size
+        self.is_stale = is_stale
+        self.render_func = render_func
+        self.signals = PreviewRenderSignals()
+
+    def should_stop(self):
+        return self.is_stale(self.generation)
+
+    def run(self):
+        if self.should_stop():
+            return
+
+        try:
+            # Drops out between stages as soon as the user has moved on
+            preview_img = self.render_func(self.img_job, self.edit_ops, self.label_size, self.should_stop)
+            if preview_img is None or self.should_stop():
+                return
+
+            with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+                shared_img = SharedImage.from_pil(preview_img)
+            self.signals.finished.emit(self.generation, self.img_job, self.cache_key, shared_img)
+        except Exception as err:
+            self.signals.failed.emit(self.generation, f"{type(err).__name__}: {err}")
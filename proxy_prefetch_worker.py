@@ -0,0 +1,35 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+
+class ProxyPrefetchSignals(QObject):
+    """
+    Signals for ProxyPrefetchWorker.  QRunnable is not a QObject so it cannot own signals itself.
+    """
+    # (img_job, error message)
+    failed = Signal(object, str)
+
+
+class ProxyPrefetchWorker(QRunnable):
+    """
+    Decodes the preview proxy of an image job the user is likely to select next, off the GUI thread.  The proxy goes
+    straight into the proxy cache, so selecting the image job later does not touch the file.  No pixmap is created or
+    released here.
+    """
+    def __init__(self, img_job, label_size, prefetch_func):
+        """
+        :param img_job: (ImageJob) Job to prefetch
+        :param label_size: (tuple) (width, height) of the preview label, read on the GUI thread
+        :param prefetch_func: (callable) Takes (img_job, label_size) and caches the job's proxy pyramid
+        """
+        super().__init__()
+
+        self.img_job = img_job
+        self.label_size = label_size
+        self.prefetch_func = prefetch_func
+        self.signals = ProxyPrefetchSignals()
+
+    def run(self):
+        try:
+            self.prefetch_func(self.img_job, self.label_size)
+        except Exception as err:
+            self.signals.failed.emit(self.img_job, f"{type(err).__name__}: {err}")
@@ -0,0 +1,130 @@
+import numpy as np
+from PySide6.QtGui import QImage, QPixmap
+from PIL import Image
+
+# Pillow modes and the QImage formats with the same byte layout, four bytes per pixel in R, G, B, A order.  Pillow
+# can only map these modes onto memory it does not own, every other mode is copied on the way in.
+SHARED_QIMAGE_FORMATS = {
+    "RGBA": QImage.Format_RGBA8888,
+    "RGBX": QImage.Format_RGBX8888,
+}
+SHARED_PIL_MODES = {q_image_format: mode for mode, q_image_format in SHARED_QIMAGE_FORMATS.items()}
+BYTES_PER_PIXEL = 4
+
+
+class SharedImage:
+    """
+    This class contains the logic for one pixel buffer shared by Qt, Pillow and NumPy.  The pixels are stored once in
+    a fixed four bytes per pixel layout and as_array(), to_pil() and to_qimage() are views of that same memory rather
+    than copies.  A view is only valid while its SharedImage is referenced.  Pillow images handed out keep a
+    reference themselves, QImages are only safe to use while the SharedImage is alive.
+    """
+    def __init__(self, buffer, size, mode, owner=None):
+        """
+        :param buffer: Object exposing the buffer protocol, width * height * 4 bytes without row padding
+        :param size: (tuple) (width, height)
+        :param mode: (str) "RGBA", or "RGBX" when the fourth byte is unused
+        :param owner: Object the buffer memory belongs to, i.e. a QImage, kept alive as long as this image
+        """
+        if mode not in SHARED_QIMAGE_FORMATS:
+            raise ValueError(f"Unsupported shared image mode [{mode}]")
+
+        self.size = tuple(size)
+        self.mode = mode
+        self.owner = owner
+        width, height = self.size
+        self.array = np.frombuffer(buffer, dtype=np.uint8, count=width * height * BYTES_PER_PIXEL).reshape(
+            height, width, BYTES_PER_PIXEL)
+        self.pil_img = None
+        self.q_image = owner if isinstance(owner, QImage) else None
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    @classmethod
+    def allocate(cls, size, has_alpha=True):
+        """
+        New zero filled, writable image, i.e. to fill from NumPy.
+        :param size: (tuple) (width, height)
+        :param has_alpha: (bool)
+        :return shared_img: (SharedImage)
+        """
+        return cls(np.zeros(size[1] * size[0] * BYTES_PER_PIXEL, dtype=np.uint8), size,
+                   "RGBA" if has_alpha else "RGBX")
+
+    @classmethod
+    def from_pil(cls, pil_img):
+        """
+        Copy a pillow image into a shared image.  This is the one copy, Pillow packs its pixels straight into the
+        shared layout.  The views of the result are read-only.
+        :param pil_img: (Image)
+        :return shared_img: (SharedImage)
+        """
+        if "A" in pil_img.getbands() or "transparency" in pil_img.info:
+            mode = "RGBA"
+            if pil_img.mode != "RGBA":
+                pil_img = pil_img.convert("RGBA")
+        else:
+            mode = "RGBX"
+            if pil_img.mode not in ("RGB", "RGBX"):
+                pil_img = pil_img.convert("RGB")
+
+        return cls(pil_img.tobytes("raw", mode), pil_img.size, mode)
+
+    @classmethod
+    def from_qimage(cls, q_image):
+        """
+        Wrap the pixels of a QImage.  QImages already in a shared format are not copied, others are converted once.
+        The views of the result are read-only.
+        :param q_image: (QImage)
+        :return shared_img: (SharedImage)
+        """
+        if q_image.format() not in SHARED_PIL_MODES:
+            q_image = q_image.convertToFormat(
+                QImage.Format_RGBA8888 if q_image.hasAlphaChannel() else QImage.Format_RGBX8888)
+
+        # constBits() does not detach the QImage, bits() would copy it when its data is shared
+        return cls(q_image.constBits(), (q_image.width(), q_image.height()), SHARED_PIL_MODES[q_image.format()],
+                   owner=q_image)
+
+    def as_array(self):
+        """
+        :return array: (ndarray) uint8 view of shape (height, width, 4)
+        """
+        return self.array
+
+    def to_pil(self):
+        """
+        :return pil_img: (Image) RGBA or RGBX view of the buffer.  Pillow copies it before any in place edit.
+        """
+        if self.pil_img is None:
+            self.pil_img = Image.frombuffer(self.mode, self.size, self.array, "raw", self.mode, 0, 1)
+            # The buffer of a QImage does not keep the QImage alive, the pillow view keeps its owner instead
+            self.pil_img.shared_image = self
+
+        return self.pil_img
+
+    def to_qimage(self):
+        """
+        :return q_image: (QImage) View of the buffer
+        """
+        if self.q_image is None:
+            self.q_image = QImage(self.array, self.width, self.height, self.width * BYTES_PER_PIXEL,
+                                  SHARED_QIMAGE_FORMATS[self.mode])
+
+        return self.q_image
+
+    def to_pixmap(self):
+        """
+        :return pixmap: (QPixmap) Pixmaps live in the window system's memory, so this is always a copy
+        """
+        return QPixmap.fromImage(self.to_qimage())
@@ -0,0 +1,54 @@
+import itertools
+import unittest
+import numpy as np
+from PIL import Image, ImageEnhance
+import enhance_kernel_func
+
+CONTRAST_FACTORS = (0.5, 0.7, 1, 1.3, 1.8)
+BRIGHTNESS_FACTORS = (0.7, 1, 1.4, 1.9)
+
+
+def chained_enhance(pil_img, contrast, sharpness, brightness):
+    enhanced_img = ImageEnhance.Contrast(pil_img).enhance(contrast)
+    enhanced_img = ImageEnhance.Sharpness(enhanced_img).enhance(sharpness)
+    return ImageEnhance.Brightness(enhanced_img).enhance(brightness)
+
+
+def calc_max_diff(pil_img, other_img):
+    return int(np.abs(np.asarray(pil_img, dtype=np.int16) - np.asarray(other_img, dtype=np.int16)).max())
+
+
+class FusedEnhanceTest(unittest.TestCase):
+    """
+    The fused kernel must give what the chained ImageEnhance calls give.
+    """
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.rgb_img = Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=np.uint8))
+        self.rgba_img = Image.fromarray(rng.integers(0, 256, (48, 64, 4), dtype=np.uint8))
+
+    def test_ramp_lut_matches_every_level(self):
+        ramp_img = Image.new("L", (256, 1))
+        ramp_img.putdata(range(256))
+        for brightness in (0.7, 1.4):
+            self.assertEqual(enhance_kernel_func.build_band_lut(1, brightness, 0),
+                             list(ImageEnhance.Brightness(ramp_img).enhance(brightness).getdata()))
+
+    def test_tone_only_is_identical(self):
+        for pil_img in (self.rgb_img, self.rgba_img, self.rgb_img.convert("L")):
+            for contrast, brightness in itertools.product(CONTRAST_FACTORS, BRIGHTNESS_FACTORS):
+                with self.subTest(mode=pil_img.mode, contrast=contrast, brightness=brightness):
+                    self.assertEqual(calc_max_diff(enhance_kernel_func.apply_fused_enhance(pil_img, contrast, 1,
+                                                                                           brightness),
+                                                   chained_enhance(pil_img, contrast, 1, brightness)), 0)
+
+    def test_sharpened_is_within_three_levels(self):
+        for contrast, sharpness, brightness in itertools.product((0.7, 1.3), (0.5, 1.5, 3), (0.7, 1.4)):
+            with self.subTest(contrast=contrast, sharpness=sharpness, brightness=brightness):
+                self.assertLessEqual(calc_max_diff(enhance_kernel_func.apply_fused_enhance(self.rgb_img, contrast,
+                                                                                           sharpness, brightness),
+                                                   chained_enhance(self.rgb_img, contrast, sharpness, brightness)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
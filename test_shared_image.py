@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+from PIL import Image
+from PySide6.QtGui import QColor, QImage
+import benchmarks
+from shared_image import SharedImage
+
+TEST_FRAME_SIZE = (4000, 3000)
+
+
+def get_address(buffer):
+    return np.frombuffer(buffer, dtype=np.uint8).ctypes.data
+
+
+class SharedImageTest(unittest.TestCase):
+    """
+    The NumPy, Pillow and QImage views of a SharedImage must be views of one buffer, never copies of it.
+    """
+    def test_views_share_one_buffer(self):
+        shared_img = SharedImage.allocate((64, 48))
+        array = shared_img.as_array()
+        pil_img = shared_img.to_pil()
+        q_image = shared_img.to_qimage()
+
+        self.assertEqual(get_address(q_image.constBits()), array.ctypes.data)
+        array[1, 2] = (10, 20, 30, 40)
+        self.assertEqual(pil_img.getpixel((2, 1)), (10, 20, 30, 40))
+        self.assertEqual(q_image.pixelColor(2, 1).getRgb(), (10, 20, 30, 40))
+
+    def test_from_qimage_wraps_shared_formats(self):
+        shared_img = SharedImage.allocate((64, 48))
+        q_shared_img = SharedImage.from_qimage(shared_img.to_qimage())
+
+        self.assertEqual(q_shared_img.as_array().ctypes.data, shared_img.as_array().ctypes.data)
+        shared_img.as_array()[3, 4] = (1, 2, 3, 4)
+        self.assertEqual(q_shared_img.to_pil().getpixel((4, 3)), (1, 2, 3, 4))
+
+    def test_from_qimage_converts_other_formats(self):
+        # QPixmap.toImage() hands out RGB32, which has no Pillow mode to map it with, so it is converted once
+        q_image = QImage(8, 6, QImage.Format_RGB32)
+        q_image.fill(QColor(0x10, 0x20, 0x30))
+        q_shared_img = SharedImage.from_qimage(q_image)
+
+        self.assertEqual(q_shared_img.mode, "RGBX")
+        self.assertNotEqual(q_shared_img.as_array().ctypes.data, get_address(q_image.constBits()))
+        self.assertEqual(q_shared_img.to_pil().convert("RGB").getpixel((7, 5)), (0x10, 0x20, 0x30))
+
+    def test_pil_view_keeps_qimage_alive(self):
+        q_image = QImage(16, 16, QImage.Format_RGBA8888)
+        q_image.fill(QColor(0x40, 0x50, 0x60))
+        pil_img = SharedImage.from_qimage(q_image).to_pil()
+        del q_image
+
+        self.assertEqual(pil_img.getpixel((15, 15))[:3], (0x40, 0x50, 0x60))
+
+    def test_from_pil_qimage_is_a_view(self):
+        shared_img = SharedImage.from_pil(Image.new("RGB", (64, 48), (5, 6, 7)))
+        q_image = shared_img.to_qimage()
+
+        self.assertEqual(get_address(q_image.constBits()), shared_img.as_array().ctypes.data)
+        self.assertEqual(q_image.pixelColor(5, 7).getRgb()[:3], (5, 6, 7))
+        self.assertEqual(shared_img.to_pil().getpixel((5, 7))[:3], (5, 6, 7))
+
+    @unittest.skipIf(benchmarks.get_rss_bytes() is None, "resident memory is not readable on this platform")
+    def test_views_do_not_grow_resident_memory(self):
+        shared_img = SharedImage.allocate(TEST_FRAME_SIZE)
+        shared_img.as_array()[...] = 255
+
+        rss_before = benchmarks.get_rss_bytes()
+        q_shared_img = SharedImage.from_qimage(shared_img.to_qimage())
+        pil_img = shared_img.to_pil()
+        q_pil_img = q_shared_img.to_pil()
+        rss_after = benchmarks.get_rss_bytes()
+
+        self.assertEqual(pil_img.size, q_pil_img.size)
+        self.assertLess(rss_after - rss_before, shared_img.nbytes // 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,367 @@
+import math
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+import batch_process_func
+import downscale_func
+import edit_pipeline_func
+import encoder_profile_func
+import enhance_kernel_func
+import export_scheduler_func
+import geometry_func
+import instrumentation_func
+
+# Working memory an image job may use before it is processed in tiles, 0 turns tiling off
+TILE_MEMORY_DEFAULT_MB = 512
+TILE_MIN_EDGE = 256
+TILE_EDGE_STEP = 64
+# Heap bytes a tile in flight holds per pixel: the tile cropped with its margin, the enhance passes and the result
+# pasted back, at four bytes each
+TILE_BYTES_PER_PIXEL = 16
+# Reach of the 3x3 sharpen kernel, every enhance tile reads this many pixels of its neighbours on each side
+SHARPEN_MARGIN = 1
+# Modes a mapped image can hold and their bytes per pixel, Pillow keeps RGB in four bytes too
+MAPPED_MODE_BYTES = {"L": 1, "RGB": 4, "RGBA": 4}
+
+
+def is_tiled_job(img_job, settings):
+    """
+    An image job is processed in tiles when tiling is on and the memory estimate of processing it whole is over the
+    tile memory budget.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return: (bool)
+    """
+    if not settings.tile_memory_mb:
+        return False
+
+    return export_scheduler_func.calc_job_bytes(img_job, settings) > settings.tile_memory_mb * 1024 * 1024
+
+
+def create_mapped_img(mode, size, temp_dir=None):
+    """
+    New black image whose pixels live in a memory mapped temporary file instead of on the heap.  The OS writes its
+    pages out to the file and drops them under memory pressure, so a mapped image does not count against the working
+    memory however big it is.  The file is deleted with the image.
+    :param mode: (str) One of MAPPED_MODE_BYTES
+    :param size: (tuple) (width, height)
+    :param temp_dir: Folder for the temporary file, the system default when None
+    :return mapped_img: (Image)
+    """
+    nbytes = size[0] * size[1] * MAPPED_MODE_BYTES[mode]
+    with tempfile.TemporaryFile(dir=temp_dir) as temp_file:
+        temp_file.truncate(nbytes)
+        # The map holds its own handle, the file lives on until the map is released
+        buffer = np.memmap(temp_file, dtype=np.uint8, mode="r+", shape=(nbytes,))
+
+    # Image.frombuffer() only maps RGBA and RGBX and hands out read-only images, this maps every mode writable
+    return Image.Image()._new(Image.core.map_buffer(buffer, tuple(size), "raw", 0, (mode, 0, 1)))
+
+
+def render_image_job_tiled(img_job, settings):
+    """
+    Tiled counterpart of batch_process_func.render_image_job() for images too big to process whole.
+    :param img_job: (ImageJob)
+    :param settings: (BatchSettings)
+    :return pil_img: (Image) Mapped image, already in a mode the export format can hold
+    """
+    edit_ops = edit_pipeline_func.replace_resize_op(img_job.img_edit_ops,
+                                                    batch_process_func.calc_output_size(img_job, settings))
+    tiled_process = TiledProcess(settings.tile_memory_mb * 1024 * 1024, resize_quality=settings.resize_quality,
+                                 temp_dir=settings.export_dir or None)
+    with Image.open(img_job.img_path) as ip:
+        pil_img = tiled_process.apply_edit_ops(ip, edit_ops, settings.file_format, img_job.img_orientation)
+    if instrumentation_func.is_enabled():
+        instrumentation_func.count(instrumentation_func.COUNTER_BYTES_READ, os.path.getsize(img_job.img_path))
+
+    return pil_img
+
+
+class TiledProcess:
+    """
+    This class contains the logic to run the edit operations of one image in tiles, so the working memory stays under
+    a fixed budget however big the image is.  The decoded image and the result of every stage are mapped images backed
+    by temporary files, only the tiles in flight are on the heap.  Tiles run on a thread pool, Pillow releases the GIL
+    while it processes pixels so they use every core.  Enhance tiles overlap their neighbours by the reach of the
+    sharpen kernel and the contrast mean is taken over the whole image first, so the result matches the untiled
+    pipeline.  Resizing a tile from its own region of the source agrees with resizing the whole image to within
+    rounding.
+    """
+    def __init__(self, memory_budget, workers=None, resize_quality=downscale_func.RESIZE_QUALITY_DEFAULT,
+                 temp_dir=None):
+        """
+        :param memory_budget: (int) Bytes of working memory for the tiles in flight
+        :param workers: (int) Tiles processed at once.  Defaults to the CPU count, fewer when the budget cannot fit a
+        tile of TILE_MIN_EDGE per worker.
+        :param resize_quality: (str) One of the downscale_func.RESIZE_QUALITY_* settings
+        :param temp_dir: Folder for the mapped images, the system default when None
+        """
+        self.memory_budget = memory_budget
+        min_tile_bytes = TILE_MIN_EDGE * TILE_MIN_EDGE * TILE_BYTES_PER_PIXEL
+        self.workers = max(1, min(workers or os.cpu_count() or 1, memory_budget // min_tile_bytes))
+        self.resize_quality = resize_quality
+        self.temp_dir = temp_dir
+
+    def calc_tile_edge(self, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+        """
+        :param bytes_per_pixel: (int) Heap bytes a tile holds per pixel while it is processed
+        :return tile_edge: (int) Edge of the biggest square tile that fits the budget with every worker busy
+        """
+        tile_pixels = self.memory_budget // (bytes_per_pixel * self.workers)
+
+        return max(TILE_MIN_EDGE, math.isqrt(tile_pixels) // TILE_EDGE_STEP * TILE_EDGE_STEP)
+
+    @staticmethod
+    def get_tile_boxes(size, tile_edge):
+        """
+        :param size: (tuple) (width, height) of the image to cover
+        :param tile_edge: (int)
+        :return tile_boxes: (list) (left, top, right, bottom) of every tile, row by row
+        """
+        width, height = size
+        return [(left, top, min(left + tile_edge, width), min(top + tile_edge, height))
+                for top in range(0, height, tile_edge) for left in range(0, width, tile_edge)]
+
+    def run_tiles(self, tile_func, size, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+        """
+        Call tile_func with the box of every tile of an image of the given size.
+        :param tile_func: Called with (left, top, right, bottom)
+        :param size: (tuple) (width, height)
+        :param bytes_per_pixel: (int) Heap bytes a tile holds per pixel, decides the tile size
+        :return results: (list) What tile_func returned, in tile order
+        """
+        tile_boxes = self.get_tile_boxes(size, self.calc_tile_edge(bytes_per_pixel))
+        if self.workers == 1 or len(tile_boxes) == 1:
+            return [tile_func(tile_box) for tile_box in tile_boxes]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(tile_func, tile_boxes))
+
+    def convert(self, src_img, mode):
+        """
+        :param src_img: (Image)
+        :param mode: (str) One of MAPPED_MODE_BYTES
+        :return mapped_img: (Image) src_img converted to mode
+        """
+        mapped_img = create_mapped_img(mode, src_img.size, self.temp_dir)
+
+        def convert_tile(tile_box):
+            mapped_img.paste(src_img.crop(tile_box).convert(mode), tile_box[:2])
+
+        with instrumentation_func.span(instrumentation_func.STAGE_CONVERT):
+            self.run_tiles(convert_tile, src_img.size)
+
+        return mapped_img
+
+    def decode(self, ip):
+        """
+        Decode an opened image straight into a mapped image, so the decoded original is never on the heap.  Modes a
+        mapped image cannot hold are decoded as usual and converted into one in tiles.  Images already in memory are
+        copied into a mapped image.
+        :param ip: (Image) Opened, not yet loaded image
+        :return mapped_img: (Image) L, RGB or RGBA
+        """
+        if ip.mode in MAPPED_MODE_BYTES and getattr(ip, "fp", None) is not None:
+            mapped_img = create_mapped_img(ip.mode, ip.size, self.temp_dir)
+            # ImageFile.load() decodes into the image memory already set rather than allocating its own
+            ip.im = mapped_img.im
+            edit_pipeline_func.decode_img(ip)
+            if ip.im is mapped_img.im:
+                return mapped_img
+            # The decoder brought its own memory after all, i.e. an uncompressed file mapped as it is
+            return self.convert(ip, ip.mode)
+        if ip.mode in MAPPED_MODE_BYTES:
+            return self.convert(ip, ip.mode)
+
+        # Palette, CMYK and the like, converted to the mode edit_pipeline_func.convert_to_edit_mode() would pick
+        edit_pipeline_func.decode_img(ip)
+        return self.convert(ip, "RGBA" if "transparency" in ip.info or "A" in ip.mode else "RGB")
+
+    def reduce(self, src_img, factor):
+        """
+        Tiled Image.reduce().  Output tiles start on whole multiples of the factor, so every tile averages the same
+        blocks of pixels as reducing the whole image.
+        :param src_img: (Image)
+        :param factor: (tuple) (x, y) whole reduction factors
+        :return mapped_img: (Image)
+        """
+        factor_x, factor_y = factor
+        width, height = src_img.size
+        mapped_img = create_mapped_img(src_img.mode, (math.ceil(width / factor_x), math.ceil(height / factor_y)),
+                                       self.temp_dir)
+
+        def reduce_tile(tile_box):
+            left, top, right, bottom = tile_box
+            reduce_box = (left * factor_x, top * factor_y, min(right * factor_x, width), min(bottom * factor_y, height))
+            mapped_img.paste(src_img.reduce(factor, box=reduce_box), (left, top))
+
+        self.run_tiles(reduce_tile, mapped_img.size)
+
+        return mapped_img
+
+    def transpose(self, src_img, method):
+        """
+        Tiled Image.transpose().  Every output tile is the transpose of its own region of the source.
+        :param src_img: (Image)
+        :param method: (Image.Transpose)
+        :return mapped_img: (Image)
+        """
+        output_size = ((src_img.height, src_img.width) if method in geometry_func.SWAPPING_TRANSPOSES
+                       else src_img.size)
+        mapped_img = create_mapped_img(src_img.mode, output_size, self.temp_dir)
+
+        def transpose_tile(tile_box):
+            source_box = geometry_func.calc_untransposed_box(tile_box, src_img.size, method)
+            mapped_img.paste(src_img.crop(source_box).transpose(method), tile_box[:2])
+
+        self.run_tiles(transpose_tile, output_size)
+
+        return mapped_img
+
+    def apply_geometry(self, src_img, target_size, rotation):
+        """
+        Tiled geometry_func.apply_geometry() of the whole image.  Every output tile is resampled from its own region
+        of the source.
+        :param src_img: (Image)
+        :param target_size: (tuple) (width, height) once scaled, before rotating
+        :param rotation: (float) Clockwise degrees
+        :return mapped_img: (Image) Of geometry_func.calc_expanded_size(target_size, rotation)
+        """
+        rotation %= 360
+        target_size = tuple(target_size)
+        _, reducing_gap, resample = downscale_func.RESIZE_QUALITY_PRESETS[self.resize_quality]
+        ratio_x, ratio_y = src_img.width / target_size[0], src_img.height / target_size[1]
+        is_right_angle = geometry_func.is_right_angle(rotation)
+        if is_right_angle:
+            # Same whole factors Image.resize() reduces by for its reducing gap
+            reduce_factor = ((max(1, int(ratio_x / reducing_gap)), max(1, int(ratio_y / reducing_gap)))
+                             if reducing_gap else (1, 1))
+        else:
+            reduce_factor = (max(1, int(min(ratio_x, ratio_y))),) * 2
+            resample = geometry_func.GEOMETRY_RESAMPLE[self.resize_quality]
+
+        source_size = src_img.size
+        if reduce_factor != (1, 1):
+            src_img = self.reduce(src_img, reduce_factor)
+            source_size = (source_size[0] / reduce_factor[0], source_size[1] / reduce_factor[1])
+
+        mapped_img = create_mapped_img(src_img.mode, geometry_func.calc_expanded_size(target_size, rotation),
+                                       self.temp_dir)
+        scale_x, scale_y = source_size[0] / target_size[0], source_size[1] / target_size[1]
+
+        if is_right_angle:
+            is_scaled = source_size != target_size
+
+            def geometry_tile(tile_box):
+                left, top, right, bottom = geometry_func.calc_unrotated_box(tile_box, target_size, rotation)
+                if is_scaled:
+                    tile = src_img.resize((right - left, bottom - top), resample,
+                                          box=(left * scale_x, top * scale_y, right * scale_x, bottom * scale_y))
+                else:
+                    tile = src_img.crop((left, top, right, bottom))
+                if rotation:
+                    tile = tile.transpose(geometry_func.RIGHT_ANGLE_TRANSPOSES[rotation])
+                mapped_img.paste(tile, tile_box[:2])
+
+            # The first resize pass keeps every source row the tile reaches
+            bytes_per_pixel = TILE_BYTES_PER_PIXEL + MAPPED_MODE_BYTES["RGBA"] * math.ceil(max(scale_x, scale_y))
+        else:
+            matrix = geometry_func.build_geometry_matrix((0, 0, *source_size), target_size, rotation,
+                                                         mapped_img.size)
+
+            def geometry_tile(tile_box):
+                left, top, right, bottom = tile_box
+                tile = src_img.transform((right - left, bottom - top), Image.AFFINE,
+                                         geometry_func.offset_matrix(matrix, left, top), resample=resample)
+                mapped_img.paste(tile, (left, top))
+
+            bytes_per_pixel = TILE_BYTES_PER_PIXEL
+
+        self.run_tiles(geometry_tile, mapped_img.size, bytes_per_pixel)
+
+        return mapped_img
+
+    def calc_contrast_mean(self, src_img, coverage=None):
+        """
+        Contrast mean of the whole image, from the grey histograms of its tiles.
+        :param src_img: (Image)
+        :param coverage: (tuple) (target_size, rotation) the image was rotated with, None when it covers the image
+        :return mean: (int)
+        """
+        def histogram_tile(tile_box):
+            mask = geometry_func.build_coverage_mask(*coverage, tile_box) if coverage is not None else None
+            return enhance_kernel_func.calc_grey_histogram(src_img.crop(tile_box), mask)
+
+        histograms = self.run_tiles(histogram_tile, src_img.size)
+
+        return enhance_kernel_func.calc_histogram_mean([sum(counts) for counts in zip(*histograms)])
+
+    def apply_enhance(self, src_img, enhance_values, coverage=None):
+        """
+        Tiled enhance_kernel_func.apply_fused_enhance().  Tiles are cut with a margin for the sharpen kernel to read,
+        the margin is dropped again before the tile is pasted.
+        :param src_img: (Image)
+        :param enhance_values: (tuple) (contrast, sharpness, brightness)
+        :param coverage: (tuple) (target_size, rotation) the image was rotated with, None when it covers the image
+        :return mapped_img: (Image)
+        """
+        contrast, sharpness, brightness = enhance_values
+        contrast_mean = self.calc_contrast_mean(src_img, coverage) if contrast != 1 else None
+        margin = SHARPEN_MARGIN if sharpness != 1 else 0
+        width, height = src_img.size
+        mapped_img = create_mapped_img(src_img.mode, src_img.size, self.temp_dir)
+
+        def enhance_tile(tile_box):
+            left, top, right, bottom = tile_box
+            margin_box = (max(0, left - margin), max(0, top - margin),
+                          min(width, right + margin), min(height, bottom + margin))
+            mask = geometry_func.build_coverage_mask(*coverage, margin_box) if coverage is not None else None
+            tile = enhance_kernel_func.apply_fused_enhance(src_img.crop(margin_box), contrast, sharpness, brightness,
+                                                           mask, contrast_mean)
+            mapped_img.paste(tile.crop((left - margin_box[0], top - margin_box[1],
+                                        right - margin_box[0], bottom - margin_box[1])), (left, top))
+
+        self.run_tiles(enhance_tile, src_img.size)
+
+        return mapped_img
+
+    def apply_edit_ops(self, ip, edit_ops, file_format=None, orientation=1):
+        """
+        Tiled edit_pipeline_func.apply_edit_ops().  Resizing and rotation are fused into one geometry op and enhance
+        ops into one, each runs as a pass over the tiles of the image.
+        :param ip: (Image) Opened, not yet loaded image
+        :param edit_ops: (list) (op_name, value) tuples, sizes are of the image turned upright
+        :param file_format: (str) Export format, the result is converted to a mode it can hold.  None keeps the mode.
+        :param orientation: (int) EXIF orientation of ip, it is turned upright once decoded
+        :return mapped_img: (Image)
+        """
+        fused_edit_ops = edit_pipeline_func.fuse_edit_ops(edit_pipeline_func.fuse_geometry_ops(edit_ops))
+        draft_size = edit_pipeline_func.get_geometry_target_size(fused_edit_ops)
+        if draft_size is not None:
+            downscale_func.prepare_downscale_decode(ip, geometry_func.calc_oriented_size(draft_size, orientation),
+                                                    self.resize_quality)
+        pil_img = self.decode(ip)
+        if orientation in geometry_func.EXIF_ORIENTATION_TRANSPOSES:
+            with instrumentation_func.span(instrumentation_func.STAGE_GEOMETRY):
+                pil_img = self.transpose(pil_img, geometry_func.EXIF_ORIENTATION_TRANSPOSES[orientation])
+
+        fused_edit_ops, coverage = edit_pipeline_func.order_edit_ops(fused_edit_ops, pil_img.size)
+        for op_name, value in fused_edit_ops:
+            if op_name == edit_pipeline_func.EDIT_OP_GEOMETRY:
+                target_size, rotation = value
+                with instrumentation_func.span(instrumentation_func.STAGE_GEOMETRY):
+                    pil_img = self.apply_geometry(pil_img, target_size or pil_img.size, rotation)
+            elif op_name == edit_pipeline_func.EDIT_OP_ENHANCE:
+                with instrumentation_func.span(instrumentation_func.STAGE_ENHANCE):
+                    pil_img = self.apply_enhance(pil_img, value, coverage)
+            else:
+                raise ValueError(f"Unsupported tiled edit operation [{op_name}]")
+
+        if file_format is not None:
+            format_mode = encoder_profile_func.get_format_mode(pil_img.mode, file_format)
+            if format_mode != pil_img.mode:
+                pil_img = self.convert(pil_img, format_mode)
+
+        return pil_img
@@ -17,6 +17,16 @@ def is_file_image(filepath):
     return True if ext.lower() in image_extensions else False
 
 
+def get_path_key(path):
+    """
+    Key identifying an image file however its path was spelled.  Case is folded on platforms with case-insensitive
+    paths.
+    :param path: Absolute or relative path to the image file
+    :return path_key: (str)
+    """
+    return os.path.normcase(os.path.abspath(path)).replace("\\", "/")
+
+
 def truncate_file_path(img_path):
     """
     Truncate the file paths in the passed in list so they can be displayed and fitted into the Edit Image combobox
@@ -31,3 +41,23 @@ def truncate_file_path(img_path):
         truncated_file_path = truncated_path
 
     return truncated_file_path
+
+
+def get_filename_with_inserts(base_filename, prefix, suffix):
+    """
+    If user has declared to use a prefix and/or suffix, detect the entered values and create the new name string
+    :param base_filename:
+    :param prefix:
+    :param suffix:
+    :return filename_with_inserts:
+    """
+    if prefix != "" and suffix == "":
+        filename_with_inserts = f"{prefix}_{base_filename}"
+    elif prefix != "" and suffix != "":
+        filename_with_inserts = f"{prefix}_{base_filename}_{suffix}"
+    elif prefix == "" and suffix != "":
+        filename_with_inserts = f"{base_filename}_{suffix}"
+    else:
+        filename_with_inserts = f"{base_filename}"
+
+    return filename_with_inserts
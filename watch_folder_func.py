@@ -0,0 +1,396 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import batch_process_func
+import folder_scan_func
+import image_cache_func
+import instrumentation_func
+import util_func
+
+WATCH_LEDGER_NAME = ".watch_ledger.jsonl"
+WATCH_POLL_INTERVAL = 2.0
+# A file counts as fully copied once its size and mtime have not changed for this long
+WATCH_SETTLE_SECONDS = 2.0
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    """
+    Minimal inotify binding through ctypes.  Watches a folder tree and reports the paths of files that were written or
+    moved in, and of folders that were created.  Raises OSError where inotify is not available.
+    """
+    def __init__(self, root_dir, exclude_globs=None, max_depth=None):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or libc_name is None:
+            raise OSError("inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.root_dir = os.path.abspath(root_dir)
+        self.exclude_globs = exclude_globs or []
+        self.max_depth = max_depth
+        # {watch descriptor: (folder path, depth)}
+        self.watch_dirs = {}
+        self.add_watch_tree(self.root_dir, 0)
+
+    def add_watch(self, dir_path, depth):
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), INOTIFY_WATCH_MASK)
+        if watch_descriptor < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for [{dir_path}]")
+        self.watch_dirs[watch_descriptor] = (dir_path, depth)
+
+    def add_watch_tree(self, dir_path, depth):
+        """
+        Watch a folder and, within the depth limit, every folder below it.
+        """
+        self.add_watch(dir_path, depth)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return
+
+        try:
+            with os.scandir(dir_path) as dir_entries:
+                sub_dirs = [entry.path for entry in dir_entries if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for sub_dir in sub_dirs:
+            rel_path = os.path.relpath(sub_dir, self.root_dir).replace("\\", "/")
+            if not folder_scan_func.matches_any_glob(rel_path, self.exclude_globs):
+                self.add_watch_tree(sub_dir, depth + 1)
+
+    def read_changes(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+        :param timeout: (float) Seconds
+        :return (changed_files, new_dirs, is_overflow): Paths of written files and created folders.  is_overflow is
+        True when the kernel dropped events, the caller should rescan the whole tree.
+        """
+        changed_files = set()
+        new_dirs = set()
+        is_overflow = False
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed_files, new_dirs, is_overflow
+
+        try:
+            event_buffer = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return changed_files, new_dirs, is_overflow
+
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(event_buffer):
+            watch_descriptor, mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(event_buffer, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = event_buffer[offset:offset + name_length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                is_overflow = True
+                continue
+            watch_dir = self.watch_dirs.get(watch_descriptor)
+            if watch_dir is None or not name:
+                continue
+
+            path = os.path.join(watch_dir[0], name)
+            if mask & IN_ISDIR:
+                new_dirs.add(path)
+                rel_path = os.path.relpath(path, self.root_dir).replace("\\", "/")
+                is_within_depth = self.max_depth is None or watch_dir[1] < self.max_depth
+                if is_within_depth and not folder_scan_func.matches_any_glob(rel_path, self.exclude_globs):
+                    try:
+                        self.add_watch_tree(path, watch_dir[1] + 1)
+                    except OSError:
+                        pass
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                changed_files.add(path.replace("\\", "/"))
+
+        return changed_files, new_dirs, is_overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StableFileTracker:
+    """
+    Tracks newly seen files until their size and mtime stop changing, so files still being copied into the watched
+    folder are not picked up half written.
+    """
+    def __init__(self, settle_seconds=WATCH_SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        # {path: ((file_size, mtime_ns), monotonic time the signature was first seen)}
+        self.pending_files = {}
+
+    def add(self, path):
+        if path not in self.pending_files:
+            self.pending_files[path] = (None, time.monotonic())
+
+    def pop_stable_files(self):
+        """
+        Re-check every pending file.
+        :return stable_files: (list) (path, (file_size, mtime_ns)) of the files that have settled, in path order
+        """
+        now = time.monotonic()
+        stable_files = []
+        for path, (last_signature, since_time) in list(self.pending_files.items()):
+            try:
+                file_signature = image_cache_func.get_file_signature(path)
+            except OSError:
+                del self.pending_files[path]
+                continue
+
+            if file_signature != last_signature or file_signature[0] == 0:
+                self.pending_files[path] = (file_signature, now)
+            elif now - since_time >= self.settle_seconds:
+                del self.pending_files[path]
+                stable_files.append((path, file_signature))
+
+        return sorted(stable_files)
+
+
+class WatchLedger:
+    """
+    Persisted record of the files the watch mode has already handled, as JSON lines appended to a file in the export
+    folder.  A file is handled again only if its size or mtime changed since.
+    """
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        # {path: (file_size, mtime_ns)}
+        self.handled_files = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.ledger_path):
+            return
+
+        with open(self.ledger_path) as ledger_file:
+            for line in ledger_file:
+                try:
+                    entry = json.loads(line)
+                    self.handled_files[entry["source"]] = (entry["file_size"], entry["mtime_ns"])
+                except (ValueError, KeyError):
+                    # A line cut short by a crash, every line before it is still valid
+                    continue
+
+    def is_handled(self, path, file_signature=None):
+        handled_signature = self.handled_files.get(path)
+        if handled_signature is None:
+            return False
+        if file_signature is None:
+            try:
+                file_signature = image_cache_func.get_file_signature(path)
+            except OSError:
+                return True
+
+        return tuple(handled_signature) == tuple(file_signature)
+
+    def record_many(self, entries):
+        """
+        Append handled files to the ledger.
+        :param entries: (list) (path, (file_size, mtime_ns), result dict) tuples
+        :return:
+        """
+        if not entries:
+            return
+
+        os.makedirs(os.path.dirname(self.ledger_path) or ".", exist_ok=True)
+        with open(self.ledger_path, "a") as ledger_file:
+            for path, (file_size, mtime_ns), result in entries:
+                ledger_file.write(json.dumps({"source": path, "file_size": file_size, "mtime_ns": mtime_ns,
+                                              "status": result["status"], "output": result["output"],
+                                              "handled_at": time.time()}) + "\n")
+                self.handled_files[path] = (file_size, mtime_ns)
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+
+
+class FolderWatcher:
+    """
+    This class contains the logic for the hot folder watch mode.  New image files arriving in the watched folder are
+    probed into image jobs and exported with the batch settings once they have finished copying.  Uses inotify where
+    available and falls back to polling the folder.
+    """
+    def __init__(self, root_dir, process_files, include_globs=None, exclude_globs=None, max_depth=None,
+                 ledger_path=None, poll_interval=WATCH_POLL_INTERVAL, settle_seconds=WATCH_SETTLE_SECONDS,
+                 use_inotify=True, export_dir=None):
+        """
+        :param root_dir: Folder to watch
+        :param process_files: Called with a list of stable, unhandled image paths.  Returns one result dict per path.
+        :param include_globs: (list) Only handle files matching one of these patterns
+        :param exclude_globs: (list) Skip files and folders matching one of these patterns
+        :param max_depth: (int) Levels of subfolders to watch, None for no limit
+        :param ledger_path: Path of the ledger file, defaults to WATCH_LEDGER_NAME inside root_dir
+        :param poll_interval: (float) Seconds between checks
+        :param settle_seconds: (float) Seconds a file must stay unchanged before it is handled
+        :param use_inotify: (bool) False forces polling
+        :param export_dir: Folder the exports are written to.  Files in it or below it are never handled, so the watch
+        does not pick up its own outputs.
+        """
+        self.logger = instrumentation_func.get_logger(__name__)
+
+        self.root_dir = os.path.abspath(root_dir)
+        self.process_files = process_files
+        self.include_globs = include_globs
+        self.exclude_globs = exclude_globs or []
+        self.max_depth = max_depth
+        self.export_dir_key = util_func.get_path_key(export_dir) if export_dir else None
+        self.poll_interval = poll_interval
+        self.ledger = WatchLedger(ledger_path if ledger_path else os.path.join(self.root_dir, WATCH_LEDGER_NAME))
+        self.stable_file_tracker = StableFileTracker(settle_seconds)
+        self.stop_event = threading.Event()
+
+        self.inotify_watcher = None
+        if use_inotify:
+            try:
+                self.inotify_watcher = InotifyWatcher(self.root_dir, self.exclude_globs, max_depth)
+            except (OSError, AttributeError) as err:
+                self.logger.info(f"inotify unavailable, polling every {poll_interval}s instead: {err}")
+
+    def stop(self):
+        """
+        Ask the watch loop to return after its current check.  Safe to call from any thread.
+        """
+        self.stop_event.set()
+
+    def is_export_path(self, path):
+        if self.export_dir_key is None:
+            return False
+        path_key = util_func.get_path_key(path)
+
+        return path_key == self.export_dir_key or path_key.startswith(self.export_dir_key.rstrip("/") + "/")
+
+    def add_candidates(self, paths):
+        for path in paths:
+            if self.is_export_path(path):
+                continue
+            if not folder_scan_func.is_scan_match(self.root_dir, path, self.include_globs, self.exclude_globs,
+                                                  self.max_depth):
+                continue
+            if not self.ledger.is_handled(path):
+                self.stable_file_tracker.add(path)
+
+    def scan_candidates(self, dir_path=None):
+        """
+        Queue every unhandled image below a folder, by default the whole watched tree.
+        """
+        dir_path = dir_path if dir_path else self.root_dir
+        rel_dir = os.path.relpath(dir_path, self.root_dir)
+        sub_depth = None if self.max_depth is None else self.max_depth - (0 if rel_dir == "." else
+                                                                           rel_dir.count(os.sep) + 1)
+        if sub_depth is not None and sub_depth < 0:
+            return
+        self.add_candidates(folder_scan_func.iter_image_files(dir_path, None, None, sub_depth))
+
+    def wait_for_candidates(self):
+        """
+        Wait up to one poll interval for new files and queue them.
+        """
+        if self.inotify_watcher is None:
+            self.stop_event.wait(self.poll_interval)
+            self.scan_candidates()
+            return
+
+        changed_files, new_dirs, is_overflow = self.inotify_watcher.read_changes(self.poll_interval)
+        if is_overflow:
+            self.logger.warning("inotify dropped events, rescanning the watched folder.")
+            self.scan_candidates()
+            return
+
+        self.add_candidates(changed_files)
+        # Files copied into a new folder before its watch was added raise no event of their own
+        for new_dir in new_dirs:
+            self.scan_candidates(new_dir)
+
+    def handle_stable_files(self):
+        """
+        Process every file that has finished copying and record it in the ledger.
+        :return handled_count: (int)
+        """
+        stable_files = self.stable_file_tracker.pop_stable_files()
+        if not stable_files:
+            return 0
+
+        results = self.process_files([path for path, _ in stable_files])
+        self.ledger.record_many([(path, file_signature, result)
+                                 for (path, file_signature), result in zip(stable_files, results)])
+
+        return len(stable_files)
+
+    def run(self, max_seconds=None):
+        """
+        Handle the files already in the folder that are not in the ledger, then keep handling new ones until stop()
+        is called or max_seconds have passed.
+        :param max_seconds: (float) None to run until stopped
+        :return:
+        """
+        start_time = time.monotonic()
+        self.logger.info(f"Watching [{self.root_dir}] for new images.")
+        self.scan_candidates()
+
+        try:
+            while not self.stop_event.is_set():
+                if max_seconds is not None and time.monotonic() - start_time >= max_seconds:
+                    break
+                self.handle_stable_files()
+                self.wait_for_candidates()
+        finally:
+            if self.inotify_watcher is not None:
+                self.inotify_watcher.close()
+
+
+def run_watch_cli(args):
+    """
+    Entry point for main.py --batch INPUT_DIR --watch.  Exports new images arriving in the input folder with the
+    command line settings until interrupted.
+    :param args: argparse namespace from main.py
+    :return exit_code: (int)
+    """
+    settings = batch_process_func.create_cli_settings(args)
+    if util_func.get_path_key(settings.export_dir) == util_func.get_path_key(args.batch):
+        # Every export would arrive in the watched folder as a new image and be exported again
+        instrumentation_func.get_logger(__name__).error("--watch needs an --output folder other than INPUT_DIR.")
+        return 2
+    include_globs, exclude_globs, max_depth = batch_process_func.get_cli_scan_options(args, settings)
+
+    batch_process = batch_process_func.BatchProcess(settings, args.jobs, args.encode_jobs,
+                                                    args.memory_budget_mb * 1024 * 1024)
+
+    def process_files(image_files):
+        batch_process.unreadable_files = []
+        all_image_jobs = batch_process_func.create_cli_image_jobs(image_files, args, batch_process)
+        results_by_path = {result["source"]: result for result in batch_process.run(all_image_jobs)}
+        for unreadable in batch_process.unreadable_files:
+            results_by_path[unreadable["source"]] = {"status": "unreadable", "output": ""}
+        batch_process.logger.info(f"Handled {len(image_files)} new images.")
+
+        return [results_by_path.get(file, {"status": "failed", "output": ""}) for file in image_files]
+
+    folder_watcher = FolderWatcher(args.batch, process_files, include_globs, exclude_globs, max_depth,
+                                   os.path.join(settings.export_dir, WATCH_LEDGER_NAME), args.poll_interval,
+                                   args.settle_seconds, not args.poll, settings.export_dir)
+    try:
+        folder_watcher.run(args.watch_seconds if args.watch_seconds > 0 else None)
+    except KeyboardInterrupt:
+        folder_watcher.logger.info("Stopped watching.")
+    finally:
+        if args.metrics_out:
+            instrumentation_func.write_metrics(args.metrics_out)
+
+    return 0